@@ -3,15 +3,17 @@ TarungBot
 Fasilkom UI 2017 bot
 '''
 
-import json
+import datetime
 import os
 import random
 import sys
+import threading
+import time
+from contextlib import contextmanager
 
 import dropbox
-import requests
 
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify, send_from_directory
 
 from linebot import (
     LineBotApi, WebhookHandler
@@ -24,6 +26,27 @@ from linebot.models import (
     SourceGroup, SourceRoom
 )
 
+from commands import NO_ARGUMENT, REQUIRED, Router
+from datasets import Dataset, Datasets, parse_rosters
+from dedup import Deduplicator, SQLiteSeen, event_key
+from events import EventLog, difficulty
+from game import Player, Roster
+from images import GENDERS, VARIANTS, ImageMirror
+import leaderboard
+from leaderboard import PERIODS
+from matching import Matcher
+from messaging import MAX_MESSAGES, Messenger
+from metrics import Collected, Histogram, Registry, Timed
+from linkcache import DropboxLinks, Prefetcher
+from persistence import WriteBehind
+from ratelimit import RateLimiter
+from registry import PlayerRegistry, SharedPlayerRegistry
+from rostersync import RosterPoller
+from scheduler import make as make_scheduler
+from storage import DropboxStorage, LogStorage, SQLiteStorage
+from tickets import DropboxTickets, TicketStore
+from workers import Dispatcher
+
 app = Flask(__name__)
 
 # Get channel_secret and channel_access_token from environment variable.
@@ -36,19 +59,102 @@ if channel_access_token is None:
     print('Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.')
     sys.exit(1)
 
-TarungBot = LineBotApi(channel_access_token)
+# Metrics exposed on /metrics. Most are filled in by hooks below.
+metrics = Registry()
+command_seconds = metrics.add(Histogram(
+    'tarungbot_command_seconds', 'Time taken to handle a chat command.',
+    ['command']))
+line_seconds = metrics.add(Histogram(
+    'tarungbot_line_api_seconds', 'Time taken by LINE API calls.',
+    ['kind', 'ok']))
+dropbox_seconds = metrics.add(Histogram(
+    'tarungbot_dropbox_seconds', 'Time taken by Dropbox API calls.',
+    ['method']))
+save_seconds = metrics.add(Histogram(
+    'tarungbot_save_seconds', 'Time taken to save a batch of players.'))
+save_players = metrics.add(Histogram(
+    'tarungbot_save_players', 'Players saved per batch.',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)))
+
+# Request bodies are logged for a sample of webhooks, cut to a size.
+request_log_rate = float(os.getenv('REQUEST_LOG_RATE', 0.01))
+request_log_size = int(os.getenv('REQUEST_LOG_SIZE', 1000))
+
+# Replies and pushes go through the messenger, which pools connections,
+# retries, rate limits and falls back to pushes for expired reply tokens.
+line_api_url = os.getenv('LINE_API_URL', 'https://api.line.me')
+line_timeout = float(os.getenv('LINE_TIMEOUT', 5))
+TarungBot = LineBotApi(channel_access_token, endpoint=line_api_url,
+                       timeout=line_timeout)
+messenger = Messenger(channel_access_token, endpoint=line_api_url,
+                      timeout=line_timeout,
+                      retries=int(os.getenv('LINE_RETRIES', 3)),
+                      rate=float(os.getenv('LINE_RATE', 100)))
 handler = WebhookHandler(channel_secret)
 
+
+def line_call(kind, seconds, ok):
+    '''
+    Record the time taken by a LINE API call.
+    '''
+    line_seconds.observe(seconds, kind=kind, ok='true' if ok else 'false')
+
+
+messenger.add_hook(line_call)
+
 dropbox_access_token = os.getenv('DROPBOX_ACCESS_TOKEN', None)
-dbx = dropbox.Dropbox(dropbox_access_token)
+dbx = Timed(dropbox.Dropbox(dropbox_access_token), dropbox_seconds)
 
 game_data_path = os.getenv('GAME_DATA_PATH', None)
+dropbox_api_url = os.getenv('DROPBOX_API_URL', 'https://api.dropboxapi.com')
+
+
+def link_fetcher(path):
+    '''
+    Return a function fetching temporary links to the images of a game
+    data folder.
+    '''
+    return dropbox_seconds.wrap(
+        DropboxLinks(dropbox_access_token, path, dropbox_api_url),
+        method='get_temporary_link')
+
+
+image_dir = os.getenv('IMAGE_DIR', None)
+public_url = os.getenv('PUBLIC_URL', None)
 save_file_path = os.getenv('SAVE_FILE_PATH', None)
+sqlite_path = os.getenv('SQLITE_PATH', None)
+save_log_path = os.getenv('SAVE_LOG_PATH', None)
+event_log_dir = os.getenv('EVENT_LOG_DIR', None)
+shared = bool(sqlite_path and os.getenv('SHARED_STATE_DIR', None))
+startup_timeout = float(os.getenv('STARTUP_TIMEOUT', 20))
+# Loading at startup is tried STARTUP_RETRIES more times, STARTUP_BACKOFF
+# seconds apart at first and twice as long each time, before the process
+# exits for its supervisor to restart it.
+startup_retries = int(os.getenv('STARTUP_RETRIES', 5))
+startup_backoff = float(os.getenv('STARTUP_BACKOFF', 1))
+# At most PLAYER_CACHE_SIZE players are kept in memory, and players idle for
+# PLAYER_IDLE_TTL seconds are dropped once saved. 0 keeps every player.
+player_cache_size = int(os.getenv('PLAYER_CACHE_SIZE', 10000)) or None
+player_idle_ttl = float(os.getenv('PLAYER_IDLE_TTL', 3600)) or None
+
+# Answer matching: extra common names and how many typos are forgiven.
+if os.getenv('COMMON_NAMES', None):
+    Matcher.common_names = tuple(
+        name.strip().lower() for name in os.getenv('COMMON_NAMES').split(','))
+Matcher.max_distance = int(os.getenv('FUZZY_DISTANCE', Matcher.max_distance))
+
+# Daily and weekly Leaderboards start at midnight UTC+LEADERBOARD_UTC_OFFSET
+# hours.
+leaderboard.TIMEZONE = datetime.timezone(datetime.timedelta(
+    hours=float(os.getenv('LEADERBOARD_UTC_OFFSET', 7))))
+
+# How questions are chosen: uniform, spaced or difficulty.
+scheduler_name = os.getenv('SCHEDULER', 'uniform')
+Player.scheduler = make_scheduler(scheduler_name)
 
 my_id = os.getenv('MY_USER_ID', None)
 tickets_path = os.getenv('TICKETS_FILE_PATH', None)
-tickets = json.loads(dbx.files_download(tickets_path)[1]
-                     .content.decode('utf-8'))
+tickets_lock = threading.Lock()
 
 about_msg = ("TarungBot\n"
              "---\n"
@@ -83,6 +189,8 @@ info_msg = ("How to play:\n"
             "If you add a wrong word, so it's e.g. 'Fatih Al-Muttaqin', "
             "it will still count as correct, but the bot will remind you "
             "about it.\n"
+            "A small typo in a word of 5 or more letters is forgiven, "
+            "like 'mutawakil'.\n"
             "You can see how this works in the source code.\n"
             "\n"
             "Scoring system:\n"
@@ -98,11 +206,10 @@ info_msg = ("How to play:\n"
             "\n"
             "Since this bot is running on free Heroku dynos, it will sleep "
             "if there's no activity in 30 minutes. "
-            "The game is saved every time someone answers 10 questions. "
+            "The game is saved a few seconds after every answer. "
             "If the bot awakens or the developer updates the bot's code, "
             "it will load the last saved progress.\n"
-            "So if you leave the game unfinished with progress % 10 != 0 "
-            "for more than 30 minutes, it's recommended to use /start "
+            "If you come back after more than 30 minutes, use /start "
             "so the bot will remind you what your current question is.\n"
             "\n"
             "You can send messages to the developer using /msg\n"
@@ -114,6 +221,8 @@ help_msg = ("/about : send the about message\n\n"
             "/bye : make me leave this chat room\n\n"
             "/start : start the game\n\n"
             "/restart : restart the game\n\n"
+            "/roster : list the rosters you can play\n\n"
+            "/roster <name> : start a new game with another roster\n\n"
             "/man : toggle between manual or automatic progression mode\n\n"
             "/next : send the next question (for manual progression mode)\n\n"
             "/n : short for /next\n\n"
@@ -128,175 +237,322 @@ help_msg = ("/about : send the about message\n\n"
             "Leaderboards.\n\n"
             "/stats : show your current game's statistics\n\n"
             "/lead : see the Leaderboards\n\n"
+            "/lead daily, /lead weekly : see today's or this week's "
+            "Leaderboards\n\n"
+            "/lead groups : see the Leaderboards of groups "
+            "(also /lead daily groups, ...)\n\n"
             "/msg <message> : send <message> to the developer")
 
 
-class Player:
+def load_player(player_id):
+    '''
+    Load a saved player on demand, or return None.
+    '''
+    record = storage.load_one(player_id)
+    return Player.fromJSON(record) if record is not None else None
+
+
+# Use a local SQLite database or save log if configured, otherwise the
+# Dropbox save file. Nothing is loaded here; see warm_up().
+if sqlite_path:
+    storage = SQLiteStorage(sqlite_path)
+elif save_log_path:
+    storage = LogStorage(save_log_path)
+else:
+    storage = DropboxStorage(dbx, save_file_path)
+# Messages for the developer are saved one by one next to the players if
+# the storage can, otherwise in the Dropbox tickets file.
+tickets = TicketStore(storage if storage.incremental
+                      else DropboxTickets(dbx, tickets_path))
+
+if shared:
+    # Several worker processes share the SQLite database. Each player is
+    # reloaded when its lock is taken and saved when it is released.
+    players = SharedPlayerRegistry(storage,
+                                   os.getenv('SHARED_STATE_DIR'),
+                                   Player.fromJSON, size=player_cache_size,
+                                   idle=player_idle_ttl)
+else:
+    # Players are saved before they are evicted, and loaded again on their
+    # next message.
+    players = PlayerRegistry(load=load_player, size=player_cache_size,
+                             idle=player_idle_ttl,
+                             clean=lambda player_id:
+                             not writer.pending(player_id))
+
+writer = WriteBehind(storage,
+                     interval=float(os.getenv('SAVE_INTERVAL', 5)),
+                     max_pending=int(os.getenv('SAVE_BATCH', 50)))
+writer.start()
+
+
+def saved(seconds, count):
     '''
-    A player
+    Record the time taken to save a batch of players.
     '''
-    guys = sorted([guy.name.replace('.jpg', '')
-                   for guy in dbx.files_list_folder(game_data_path + '/male')
-                   .entries])
-    gals = sorted([gal.name.replace('.jpg', '')
-                   for gal in dbx.files_list_folder(game_data_path + '/female')
-                   .entries])
+    save_seconds.observe(seconds)
+    save_players.observe(count)
+
+
+writer.add_hook(saved)
+# Saved players can be evicted now.
+writer.add_hook(lambda seconds, count: players.evict())
+
+# Every answer, game start and game end, for replays and analytics.
+event_log = EventLog(event_log_dir) if event_log_dir else None
+
+mirror = None
+if image_dir and public_url:
+    mirror = ImageMirror(dbx, game_data_path, image_dir, public_url)
+
+Roster.load = lambda version: storage.load_meta('roster:' + version)
+
+# The default roster is GAME_DATA_PATH. ROSTERS=name=path,... adds more,
+# which chats pick with /roster. Each has its own image links and top 10
+# players and groups, all-time and for the current day and week, updated
+# whenever a player is saved. Rosters follow their game data folders
+# through list-folder cursors, and other rosters than the default are only
+# listed once someone plays them.
+datasets = Datasets(Dataset(os.getenv('ROSTER_NAME', 'default').lower(),
+                            game_data_path, dbx, storage,
+                            link_fetcher(game_data_path)))
+for roster_name, roster_path in parse_rosters(os.getenv('ROSTERS')):
+    datasets.add(Dataset(roster_name, roster_path, dbx, storage,
+                         link_fetcher(roster_path),
+                         key='roster:sync:' + roster_name))
+Player.find_roster = datasets.roster
+prefetcher = Prefetcher(datasets.default.links)
+prefetcher.start()
+
+
+def load_roster():
+    '''
+    Fetch the changes to the default game data folders and switch to the
+    new roster if they changed it. Return True if it changed.
+    '''
+    dataset = datasets.default
+    if not dataset.refresh():
+        return False
+    # The roster is swapped in with a single assignment. Players move their
+    # progress onto it the next time they play; games in progress gain the
+    # added persons.
+    roster = Player.roster = dataset.roster
+    if mirror is not None:
+        # Serve question images from local disk.
+        mirror.update({'male': roster.guys, 'female': roster.gals})
+    return True
 
-    def __init__(self, name='Anonymous', pick='', progress=None, data=None):
-        self.name = name
-        self.pick = pick
-        if progress is None:
-            self.progress = Player.guys + Player.gals
-        else:
-            self.progress = progress
-        if data is None:
-            self.data = {'exact': 0, 'correct': 0, 'partial': 0,
-                         'wrong': 0, 'skipped': 0, 'count': 0,
-                         'score': 0, 'high_score': 0, 'manual': False}
-        else:
-            self.data = data
 
-    def finished(self):
-        '''
-        Check if a player has finished their game.
-        '''
-        if self.progress:
-            return False
-        return True
+def refresh_rosters():
+    '''
+    Fetch the changes to the default roster and every other roster that
+    has been loaded. Return the names of the rosters that changed.
+    '''
+    changed = [datasets.default.name] if load_roster() else []
+    for dataset in datasets:
+        if (dataset is not datasets.default and dataset.loaded() and
+                dataset.refresh()):
+            changed.append(dataset.name)
+    return changed
 
-    def next_link(self, repick=False):
-        '''
-        Get next random link.
-        '''
-        if not repick:
-            self.pick = random.choice(self.progress)
-        if self.pick in Player.guys:
-            gender = 'male'
-        else:
-            gender = 'female'
-        headers = {
-            'Authorization': 'Bearer {}'.format(dropbox_access_token),
-            'Content-Type': 'application/json',
-        }
-        data = '"path": "{}/{}/{}.jpg"'.format(game_data_path,
-                                               gender, self.pick)
-        data = '{' + data + '}'
-        data = data.encode('utf-8')
-        url = 'https://api.dropboxapi.com/2/files/get_temporary_link'
-        link = requests.post(url, headers=headers,
-                             data=data).json()['link']
-        return link
-
-    def answer(self, name):
-        '''
-        Answer current pick.
-        '''
-        if self.pick in Player.guys:
-            pronoun = ('He', 'him')
-        else:
-            pronoun = ('She', 'her')
-        specific = True
 
-        if name.lower() == 'pass':
-            msg = ("{} is {}. Remember {} next time!"
-                   .format(pronoun[0], self.pick, pronoun[1]))
-            self.data['skipped'] += 1
+# Pick up new and removed photos every ROSTER_SYNC_INTERVAL seconds once the
+# bot is ready.
+roster_poller = RosterPoller(refresh_rosters,
+                             float(os.getenv('ROSTER_SYNC_INTERVAL', 300)))
+
+# Set once the roster and tickets are loaded and games can be played.
+ready = threading.Event()
+# Set once every saved player has been loaded, e.g. for the Leaderboards.
+loaded = threading.Event()
+startup = {'started': time.time(), 'ready': None, 'loaded': None,
+           'error': None}
+
+
+def cache_players(records):
+    '''
+    Decode saved players into the registry one at a time, so at most the
+    cache size is in memory, and yield (chat ID, player) pairs.
+    '''
+    for each in records:
+        players.update({each: Player.fromJSON(records[each])})
+        # A player already in memory is kept rather than the decoded one.
+        yield each, players[each]
+
 
-        elif name == self.pick.lower():
-            msg = ("Wow, that's exactly right! {} is {}."
-                   .format(pronoun[0], self.pick))
-            self.data['exact'] += 1
+def load_tickets():
+    '''
+    Load the messages, the first time from the Dropbox tickets file if
+    the storage saves them itself.
+    '''
+    if (storage.incremental and tickets_path and
+            not storage.load_meta('tickets:seeded')):
+        storage.save_tickets(DropboxTickets(dbx, tickets_path)
+                             .load_tickets())
+        storage.save_meta('tickets:seeded', True)
+    tickets.load()
 
+
+def retried(load):
+    '''
+    Call load until it succeeds and return its result, keeping the last
+    error in startup['error'] meanwhile. Give up after startup_retries
+    retries by exiting, so the supervisor starts a fresh worker rather
+    than keeping one that will never be ready.
+    '''
+    for attempt in range(startup_retries + 1):
+        try:
+            result = load()
+        except Exception as error:  # pylint: disable=broad-except
+            app.logger.exception("Startup failed (attempt %d of %d)",
+                                 attempt + 1, startup_retries + 1)
+            startup['error'] = repr(error)
+            if attempt < startup_retries:
+                time.sleep(min(startup_backoff * 2 ** attempt, 60))
         else:
-            correct = False
-            entirely = True
-            specific = False
-            for word in name.split():
-                common = (word in 'muhammad' or
-                          word in 'muhamad' or
-                          word.title() in 'Naufal')
-                specific = len(word) >= 3 if not common else specific
-                correct = word in self.pick.lower() or correct
-                entirely = word in self.pick.lower() and entirely
-
-            if specific:
-                if correct and entirely:
-                    msg = ("You are correct! {} is {}."
-                           .format(pronoun[0], self.pick))
-                    self.data['correct'] += 1
-                elif correct and not entirely:
-                    msg = ("You are partially correct! "
-                           "{} is actually {}, not {}."
-                           .format(pronoun[0], self.pick, name.title()))
-                    self.data['partial'] += 1
-                elif not correct:
-                    msg = ("You are wrong! {} is {}. Remember {} next time!"
-                           .format(pronoun[0], self.pick, pronoun[1]))
-                    self.data['wrong'] += 1
-            else:
-                msg = ("Please be more specific. Try again!")
-
-        if specific:
-            self.progress.remove(self.pick)
-            self.data['count'] += 1
-            self.data['score'] = (5*self.data['exact'] +
-                                  3*self.data['correct'] +
-                                  3*self.data['partial'] -
-                                  1*self.data['wrong'])
-            if self.data['score'] > self.data['high_score']:
-                self.data['high_score'] = self.data['score']
-        return msg
-
-    def stats(self):
-        '''
-        Return a player's current game statistics.
-        '''
-        total = (self.data['exact'] + self.data['correct'] +
-                 self.data['partial'] + self.data['wrong'] +
-                 self.data['skipped'])
-        return ("{}/{} persons ({:.2f}%).\n"
-                "Exact: {} ({:.2f}%)\n"
-                "Correct: {} ({:.2f}%)\n"
-                "Partial: {} ({:.2f}%)\n"
-                "Wrong: {} ({:.2f}%)\n"
-                "Skipped: {} ({:.2f}%)\n"
-                "Current Score: {}\n"
-                "Highest Score: {}\n"
-                "Name: {}"
-                .format(total, len(Player.guys+Player.gals),
-                        total/len(Player.guys+Player.gals)*100,
-                        self.data['exact'],
-                        self.data['exact']/len(Player.guys+Player.gals)*100,
-                        self.data['correct'],
-                        self.data['correct']/len(Player.guys+Player.gals)*100,
-                        self.data['partial'],
-                        self.data['partial']/len(Player.guys+Player.gals)*100,
-                        self.data['wrong'],
-                        self.data['wrong']/len(Player.guys+Player.gals)*100,
-                        self.data['skipped'],
-                        self.data['skipped']/len(Player.guys+Player.gals)*100,
-                        self.data['score'],
-                        self.data['high_score'],
-                        self.name))
-
-    def toJSON(self):
-        '''
-        Return an instance's JSON-compatible dictionary representation.
-        '''
-        stats = {'name': self.name, 'pick': self.pick,
-                 'progress': self.progress, 'data': self.data}
-        return stats
+            startup['error'] = None
+            return result
+    give_up()
+
+
+def give_up():
+    '''
+    Save what is waiting and exit the process.
+    '''
+    app.logger.critical("Giving up on startup: %s", startup['error'])
+    try:
+        writer.flush()
+    finally:
+        os._exit(1)  # pylint: disable=protected-access
+
+
+def load_records():
+    '''
+    Return every saved player, the first time from the Dropbox save file if
+    the storage saves them itself.
+    '''
+    records = storage.load()
+    if storage.incremental and not records and save_file_path:
+        # First run: seed local storage from the Dropbox save file.
+        records = DropboxStorage(dbx, save_file_path).load()
+        storage.save(records)
+    return records
+
+
+def warm_up():
+    '''
+    Load the roster, tickets and save data in the background, so the
+    server can start accepting webhooks right away. Loads are retried; see
+    retried().
+    '''
+    retried(load_roster)
+    retried(load_tickets)
+    ready.set()
+    if roster_poller.interval > 0:
+        roster_poller.start()
+    startup['ready'] = time.time()
+
+    records = retried(load_records)
+    try:
+        if not shared:
+            datasets.rebuild(cache_players(records))
+        if event_log_dir and scheduler_name == 'difficulty':
+            # Start from every answer so far, not just this process's.
+            Player.scheduler.seed(difficulty(event_log_dir).by_name())
+    except Exception as error:  # pylint: disable=broad-except
+        app.logger.exception("Startup failed")
+        startup['error'] = repr(error)
+        give_up()
+    loaded.set()
+    startup['loaded'] = time.time()
+
+
+threading.Thread(target=warm_up, daemon=True, name='warm-up').start()
+
+
+def question_links(player, repick=False):
+    '''
+    Pick a player's next question and return its (original, preview) links.
+    '''
+    pick = player.next_pick(repick)
+    dataset = datasets.of(player)
+    # Only the default roster's images are mirrored.
+    local = mirror if dataset is datasets.default else None
+    if player.upcoming is not None:
+        gender = player.gender(player.upcoming)
+        if local is None or not local.has(gender, player.upcoming):
+            prefetcher.prefetch(gender, player.upcoming, dataset.links)
+    gender = player.gender(pick)
+    if local is not None and local.has(gender, pick):
+        return local.urls(gender, pick)
+    link = dataset.links.get(gender, pick)
+    return link, link
+
+
+def save_player(player_id):
+    '''
+    Update the Leaderboards with a player and queue it to be saved, unless
+    the shared registry saves it.
+    '''
+    player = players[player_id]
+    datasets.of(player).leaderboards.update(player_id, player)
+    if not shared:
+        writer.mark(player_id, players[player_id].toJSON())
+
+
+def log_event(player_id, kind=None):
+    '''
+    Record a player's last answer, or a game start or end, in the event log.
+    '''
+    if event_log is None:
+        return
+    player = players[player_id]
+    if kind is None:
+        event_log.answered(player_id, player)
+    else:
+        # Games of other rosters than the default name it in their start.
+        event_log.record(player_id, kind,
+                         answer=player.data.get('roster') if kind == 'start'
+                         else None,
+                         roster=player.current_roster())
+    writer.defer('events', event_log.flush)
+
+
+@contextmanager
+def tickets_locked():
+    '''
+    Hold the tickets lock, across processes when state is shared.
+    '''
+    if not shared:
+        with tickets_lock:
+            yield
+        return
+    with players.locked('tickets'):
+        # Another process may have changed the tickets.
+        tickets.load()
+        yield
 
 
-# Load JSON from Dropbox.
-players = json.loads(dbx.files_download(save_file_path)[1]
-                     .content.decode('utf-8'))
-# Convert JSON data to Player objects.
-for each in players:
-    players[each] = Player(name=players[each]['name'],
-                           pick=players[each]['pick'],
-                           progress=players[each]['progress'],
-                           data=players[each]['data'])
+def save_tickets():
+    '''
+    Save the added and removed tickets, in the background unless state is
+    shared.
+    '''
+    if shared:
+        tickets.flush()
+    else:
+        writer.defer('tickets', tickets.flush)
+
+
+def chat_id(source):
+    '''
+    Return the ID of the group, room or user a message came from.
+    '''
+    if isinstance(source, SourceGroup):
+        return source.group_id
+    if isinstance(source, SourceRoom):
+        return source.room_id
+    return source.user_id
 
 
 @app.route("/callback", methods=['POST'])
@@ -309,351 +565,799 @@ def callback():
 
     # Get request body as text.
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
-
-    # Handle webhook body.
+    if random.random() < request_log_rate:
+        app.logger.info("Request body (%d characters): %s", len(body),
+                        body[:request_log_size])
+
+    # Handle the webhook's events, or queue them for the worker threads.
+    # LINE redelivers events it thinks weren't received; those are dropped.
+    # An event the workers have no room for is forgotten and the webhook
+    # fails, so LINE delivers it again later.
     try:
-        handler.handle(body, signature)
+        for event in handler.parser.parse(body, signature):
+            key = event_key(event)
+            if deduplicator.seen(key):
+                app.logger.info("Dropping duplicate event %s", key)
+            elif throttled(event):
+                continue
+            elif dispatcher is None:
+                process_event(event)
+            elif not dispatcher.submit(chat_id(event.source), event):
+                deduplicator.forget(key)
+                abort(503)
     except InvalidSignatureError:
         abort(400)
 
     return 'OK'
 
 
-# pylint: disable=too-many-statements
-@handler.add(MessageEvent, message=TextMessage)
+@app.route("/ready")
+def readiness():
+    '''
+    Report whether the bot has finished loading. Not ready while a load is
+    failing, even once games can be played.
+    '''
+    def elapsed(key):
+        if startup[key] is None:
+            return None
+        return round(startup[key] - startup['started'], 3)
+
+    body = jsonify(ready=ready.is_set(), loaded=loaded.is_set(),
+                   ready_after=elapsed('ready'),
+                   loaded_after=elapsed('loaded'), error=startup['error'])
+    return body, 200 if ready.is_set() and not startup['error'] else 503
+
+
+@app.route("/status")
+def status():
+    '''
+    Report the state of the background save queue, webhook workers,
+    duplicate webhooks, the player cache, rate limiting and outgoing
+    messages.
+    '''
+    return jsonify(queue_depth=writer.depth(),
+                   last_flush_age=round(writer.last_flush_age(), 3),
+                   webhook_queue_depth=(dispatcher.depth()
+                                        if dispatcher else 0),
+                   webhook_dropped=dispatcher.dropped if dispatcher else 0,
+                   webhook_duplicates=deduplicator.stats(),
+                   player_cache=players.stats(),
+                   rate_limit=limiter.stats() if limiter else None,
+                   messages=messenger.stats())
+
+
+def active_players():
+    '''
+    Return the number of players in memory with a game in progress.
+    '''
+    # The base class doesn't reload shared players from storage.
+    return sum(not player.finished()
+               for _, player in PlayerRegistry.items(players))
+
+
+def link_count(result):
+    '''
+    Return the link cache hits or misses of every roster.
+    '''
+    return sum(getattr(dataset.links, result) for dataset in datasets)
+
+
+metrics.add(Collected('tarungbot_players', 'Players in memory.',
+                      lambda: len(players)))
+metrics.add(Collected('tarungbot_active_players',
+                      'Players in memory with a game in progress.',
+                      active_players))
+metrics.add(Collected('tarungbot_player_cache_total',
+                      'Player lookups by cache result, and evictions.',
+                      lambda: {('hit',): players.hits,
+                               ('miss',): players.misses,
+                               ('eviction',): players.evictions},
+                      kind='counter', labels=['result']))
+metrics.add(Collected('tarungbot_throttled_total',
+                      'Commands dropped by the rate limiter, by the bucket '
+                      'that ran out and command.',
+                      lambda: dict(limiter.throttled) if limiter else {},
+                      kind='counter', labels=['scope', 'command']))
+metrics.add(Collected('tarungbot_replies_assumed_total',
+                      'Replies taken as delivered after a retry found their '
+                      'token used.',
+                      lambda: messenger.assumed, kind='counter'))
+metrics.add(Collected('tarungbot_link_cache_requests_total',
+                      'Question image link requests by cache result.',
+                      lambda: {('hit',): link_count('hits'),
+                               ('miss',): link_count('misses')},
+                      kind='counter', labels=['result']))
+metrics.add(Collected('tarungbot_save_bytes_total',
+                      'Bytes written by the save backend.',
+                      lambda: storage.written, kind='counter'))
+metrics.add(Collected('tarungbot_save_queue_depth',
+                      'Writes waiting for the background saver.',
+                      writer.depth))
+metrics.add(Collected('tarungbot_webhook_events_total',
+                      'Webhook events received, by whether they were '
+                      'duplicates.',
+                      lambda: {('false',): deduplicator.checked -
+                               deduplicator.duplicates,
+                               ('true',): deduplicator.duplicates},
+                      kind='counter', labels=['duplicate']))
+
+
+@app.route("/metrics")
+def metrics_page():
+    '''
+    Report metrics in the Prometheus text format.
+    '''
+    return app.response_class(metrics.render(),
+                              mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/images/<variant>/<gender>/<path:name>")
+def image(variant, gender, name):
+    '''
+    Serve a mirrored question image.
+    '''
+    if mirror is None or variant not in VARIANTS or gender not in GENDERS:
+        abort(404)
+    return send_from_directory(os.path.join(mirror.directory,
+                                            variant, gender),
+                               name, max_age=7 * 24 * 60 * 60)
+
+
 def handle_text_message(event):
     '''
     Text message handler
     '''
-    text = event.message.text
-    if isinstance(event.source, SourceGroup):
-        player_id = event.source.group_id
-    elif isinstance(event.source, SourceRoom):
-        player_id = event.source.room_id
-    else:
-        player_id = event.source.user_id
+    if not ready.wait(startup_timeout):
+        messenger.reply(event.reply_token, TextSendMessage(
+            text="I'm still waking up. Please try again in a moment."),
+                        to=chat_id(event.source))
+        return
+    player_id = chat_id(event.source)
+    with players.locked(player_id):
+        before = snapshot(player_id)
+        handle_command(event)
+        # Some commands (/start, /next, /man, ...) only change the game in
+        # memory. Save them too, so the player can be evicted and loaded
+        # back as they are.
+        after = snapshot(player_id)
+        if after is not None and after != before:
+            save_player(player_id)
+
+
+def snapshot(player_id):
+    '''
+    Return what commands change about a player in memory, or None if the
+    player isn't in memory.
+    '''
+    player = players.cached(player_id)
+    if player is None:
+        return None
+    return player, player.pick, player.name, dict(player.data)
+
+
+def handle_command(event):
+    '''
+    Handle a text message while holding the chat's player lock.
+    '''
+    router.dispatch(Chat(event), event.message.text,
+                    admin=event.source.user_id == my_id)
 
-    def quickreply(msg):
-        '''
-        Reply a message with msg as reply content.
-        '''
-        TarungBot.reply_message(
-            event.reply_token,
-            TextSendMessage(text=msg)
-        )
 
-    def check(user_id):
+class Chat:
+    '''
+    The chat a message came from, passed to every command.
+    '''
+
+    def __init__(self, event):
+        self.event = event
+        self.player_id = chat_id(event.source)
+
+    @property
+    def player(self):
         '''
-        Check if a user is eligible for a game.
+        The chat's player.
         '''
-        if user_id not in players:
-            msg = "You've never played the game before."
-        elif players[user_id].finished():
-            msg = ("You have finished the game.\n"
-                   "Use /start to start a new one.")
-        else:
-            return True
-        quickreply(msg)
-        return False
+        return players[self.player_id]
 
-    def set_player(user_id, high_score=0):
+    def reply(self, messages):
         '''
-        Set a new player or reset an existing player.
+        Reply to the message, or push to the chat if that fails.
         '''
-        players[user_id] = Player()
-        players[user_id].data['high_score'] = high_score
+        messenger.reply(self.event.reply_token, messages, to=self.player_id)
 
-    def can_start_game(user_id):
+    def quickreply(self, msg):
         '''
-        Check if a user can start the game.
+        Reply a message with msg as reply content.
         '''
-        if user_id in players:
-            if not players[user_id].finished():
-                return False
+        self.reply(TextSendMessage(text=msg))
+
+
+def timed_command(name, seconds):
+    '''
+    Record the time taken by a command, and log it if over a second.
+    '''
+    command_seconds.observe(seconds, command=name)
+    if seconds > 1:
+        app.logger.warning("/%s took %.2f s", name, seconds)
+
+
+# Commands register themselves below; handle_command() doesn't change when
+# one is added.
+router = Router()
+router.add_hook(timed_command)
+
+# Commands take tokens from their user's bucket and, in groups and rooms,
+# from the chat's bucket: USER_RATE and GROUP_RATE tokens a second, in
+# bursts of up to USER_BURST and GROUP_BURST. Commands that fetch a new
+# question image cost more. Rate limiting is off unless a rate is set;
+# USER_RATE=1 and GROUP_RATE=3 suit a busy deployment.
+limits = {scope: (float(os.getenv(scope.upper() + '_RATE', 0)),
+                  float(os.getenv(scope.upper() + '_BURST', burst)))
+          for scope, burst in (('user', 20), ('group', 60))}
+limits = {scope: limit for scope, limit in limits.items() if limit[0] > 0}
+limiter = None
+if limits:
+    limiter = RateLimiter(limits,
+                          size=int(os.getenv('RATE_LIMIT_SIZE', 10000)))
+THROTTLED_MESSAGES = {
+    'user': "You're sending commands too fast. Please wait a moment.",
+    'group': ("This chat is sending commands too fast. "
+              "Please wait a moment."),
+}
+
+
+def check(chat):
+    '''
+    Check if a chat is eligible for a game.
+    '''
+    if chat.player_id not in players:
+        msg = "You've never played the game before."
+    elif chat.player.finished():
+        msg = ("You have finished the game.\n"
+               "Use /start to start a new one.")
+    else:
         return True
+    chat.quickreply(msg)
+    return False
 
-    def send_question(user_id, prev=None, reask=False):
-        '''
-        Send a question.
-        '''
-        if prev:
-            content = [TextSendMessage(text=prev)]
-        else:
-            content = []
-        link = players[user_id].next_link(reask)
-        TarungBot.reply_message(
-            event.reply_token, content + [
-                ImageSendMessage(
-                    original_content_url=link,
-                    preview_image_url=link
-                ),
-                TextSendMessage(text="Who is this person?")
-            ]
-        )
-
-    def start(user_id, force=False):
-        '''
-        Start a new game for the user.
-        '''
-        if not can_start_game(user_id) and not force:
-            msg = ("Your game is still in progress.\n"
-                   "Use /restart to restart your progress.\n"
-                   "Here's your current question:")
-            send_question(user_id, prev=msg, reask=True)
 
-        else:
-            try:
-                set_player(user_id, players[user_id].data['high_score'])
-            except KeyError:
-                set_player(user_id)
-            send_question(user_id, prev="Starting game...")
+def set_player(user_id, high_score=0, periods=None, roster=None, stash=None):
+    '''
+    Set a new player or reset an existing player, playing the named roster
+    or the default one.
+    '''
+    players[user_id] = Player(roster=roster)
+    players[user_id].data['high_score'] = high_score
+    players[user_id].data['periods'] = dict(periods or {})
+    if stash:
+        players[user_id].data['rosters'] = stash
+    datasets.of(players[user_id]).leaderboards.update(user_id,
+                                                      players[user_id])
 
-    def answer(user_id, name, manual=False):
-        '''
-        Answer a question.
-        '''
-        if check(user_id):
-            result = players[user_id].answer(name)
-            if not players[user_id].finished():
-                if 'Try again' in result or manual:
-                    quickreply(result)
-                elif not manual:
-                    send_question(user_id, prev=result)
-            else:
-                TarungBot.reply_message(
-                    event.reply_token, [
-                        TextSendMessage(text=result),
-                        TextSendMessage(text=(
-                            "You've finished the game!\n"
-                            + players[user_id].stats()))
-                    ]
-                )
-                players[user_id].data['count'] = 10
-            if players[user_id].data['count'] >= 10:
-                players[user_id].data['count'] = 0
-                dbx.files_upload(json.dumps({each: players[each].toJSON()
-                                             for each in players}, indent=4)
-                                 .encode('utf-8'), save_file_path,
-                                 dropbox.files.WriteMode.overwrite)
-
-    def end_game(user_id):
-        '''
-        End the current game.
-        '''
-        if check(user_id):
-            players[user_id].pick = ''
-            players[user_id].progress = []
-            quickreply("Game ended.\n" + players[user_id].stats())
 
-    def set_name(user_id, name):
-        '''
-        Change the name to be shown in Leaderboards.
-        '''
-        if check(user_id):
-            if len(name) <= 20:
-                if '(group)' not in name:
-                    players[user_id].name = name
-                    quickreply("Name set to {}.".format(name))
-                else:
-                    quickreply("You shouldn't put (group) in your name.")
-            else:
-                quickreply(("Too long.\n"
-                            "Name should consist of 20 characters or less."))
+def can_start_game(user_id):
+    '''
+    Check if a user can start the game.
+    '''
+    if user_id in players:
+        if not players[user_id].finished():
+            return False
+    return True
 
-    def see_leaderboards():
-        '''
-        Send current Leaderboards.
-        '''
-        msg = 'Leaderboards:'
-        lb = []
-        for player in players:
-            group = False if player[0] == 'U' else True
-            lb.append([players[player].data['high_score'],
-                       players[player].name, group])
-        lb.sort(reverse=True)
-        i = 0
-        for item in lb[:10]:
-            if item[2]:
-                msg += '\n{}. {} (group) [{}]'.format(i+1, item[1], item[0])
+
+def send_question(chat, prev=None, reask=False):
+    '''
+    Send a question.
+    '''
+    if prev:
+        content = [TextSendMessage(text=prev)]
+    else:
+        content = []
+    original, preview = question_links(chat.player, reask)
+    chat.reply(content + [
+        ImageSendMessage(
+            original_content_url=original,
+            preview_image_url=preview
+        ),
+        TextSendMessage(text="Who is this person?")
+    ])
+
+
+def start_game(chat, force=False):
+    '''
+    Start a new game for the chat.
+    '''
+    user_id = chat.player_id
+    if not can_start_game(user_id) and not force:
+        msg = ("Your game is still in progress.\n"
+               "Use /restart to restart your progress.\n"
+               "Here's your current question:")
+        send_question(chat, prev=msg, reask=True)
+
+    else:
+        try:
+            data = players[user_id].data
+            set_player(user_id, data['high_score'], data.get('periods'),
+                       data.get('roster'), data.get('rosters'))
+        except KeyError:
+            set_player(user_id)
+        log_event(user_id, 'start')
+        send_question(chat, prev="Starting game...")
+
+
+@router.default('answer')
+@router.command('answer', aliases=('a',), argument=REQUIRED,
+                parse=str.lower)
+def answer(chat, name):
+    '''
+    Answer a question.
+    '''
+    if check(chat):
+        user_id = chat.player_id
+        manual = players[user_id].data.get('manual', False)
+        result = players[user_id].answer(name)
+        log_event(user_id)
+        if not players[user_id].finished():
+            if 'Try again' in result or manual:
+                chat.quickreply(result)
             else:
-                msg += '\n{}. {} [{}]'.format(i+1, item[1], item[0])
-            i += 1
-        quickreply(msg)
+                send_question(chat, prev=result)
+        else:
+            chat.reply([
+                TextSendMessage(text=result),
+                TextSendMessage(text=("You've finished the game!\n"
+                                      + players[user_id].stats()))
+            ])
+        players[user_id].data['count'] = 0
+        save_player(user_id)
 
-    def bye():
-        '''
-        Leave a chat room.
-        '''
-        if isinstance(event.source, SourceGroup):
-            quickreply("Leaving group...")
-            TarungBot.leave_group(event.source.group_id)
 
-        elif isinstance(event.source, SourceRoom):
-            quickreply("Leaving room...")
-            TarungBot.leave_room(event.source.room_id)
+@router.command('pass', aliases=('p',), prefix=True)
+def skip(chat, _):
+    '''
+    Skip the current question.
+    '''
+    answer(chat, 'pass')
+
+
+@router.command('next', aliases=('n', ''), argument=NO_ARGUMENT, cost=2)
+def next_question(chat, _):
+    '''
+    Send the next question in manual mode.
+    '''
+    if not check(chat):
+        return
+    if chat.player.pick in chat.player.progress:
+        chat.quickreply(("You haven't answered the question.\n"
+                         "Use /pass if you want to skip it."))
+    else:
+        send_question(chat)
+
+
+@router.command('man', argument=NO_ARGUMENT)
+def toggle_manual(chat, _):
+    '''
+    Switch between manual and automatic progression.
+    '''
+    if chat.player_id not in players:
+        chat.quickreply("You've never played the game before.")
+        return
+    data = chat.player.data
+    data['manual'] = not data.get('manual', False)
+    if data['manual']:
+        chat.quickreply("Game mode changed from automatic to manual.")
+    else:
+        chat.quickreply("Game mode changed from manual to automatic.")
+
+
+@router.command('about', prefix=True)
+def about(chat, _):
+    '''
+    Send the about message.
+    '''
+    chat.quickreply(about_msg)
+
+
+@router.command('info', prefix=True)
+def info(chat, _):
+    '''
+    Send the info message.
+    '''
+    chat.quickreply(info_msg)
+
+
+@router.command('help', prefix=True)
+def show_help(chat, _):
+    '''
+    Send the help message.
+    '''
+    chat.quickreply(help_msg)
+
+
+@router.command('bye', prefix=True)
+def bye(chat, _):
+    '''
+    Leave a chat room.
+    '''
+    source = chat.event.source
+    if isinstance(source, SourceGroup):
+        chat.quickreply("Leaving group...")
+        TarungBot.leave_group(source.group_id)
+
+    elif isinstance(source, SourceRoom):
+        chat.quickreply("Leaving room...")
+        TarungBot.leave_room(source.room_id)
+
+    else:
+        chat.quickreply("I can't leave a 1:1 chat.")
+
+
+@router.command('start', prefix=True, cost=5)
+def start(chat, _):
+    '''
+    Start a new game, or resend the question of the current one.
+    '''
+    start_game(chat)
+
+
+@router.command('restart', prefix=True, cost=5)
+def restart(chat, _):
+    '''
+    Start a new game even if one is in progress.
+    '''
+    start_game(chat, force=True)
+
+
+@router.command('roster', parse=str.lower, cost=5)
+def choose_roster(chat, name):
+    '''
+    List the rosters, or start a new game with the named one.
+
+    Each roster has its own high scores: the current one's are stashed in
+    the player's data and the chosen one's are restored.
+    '''
+    current = (datasets.of(chat.player) if chat.player_id in players
+               else datasets.default)
+    if not name:
+        chat.quickreply("Rosters:\n" + '\n'.join(
+            each + (' (current)' if each == current.name else '')
+            for each in datasets.names()) +
+            "\nUse /roster <name> to play another one.")
+        return
+    if name not in datasets:
+        chat.quickreply("There's no roster named {}.".format(name))
+        return
+    if name == current.name:
+        chat.quickreply("You're already playing {}.\n"
+                        "Use /restart to start a new game.".format(name))
+        return
+    user_id = chat.player_id
+    if user_id in players:
+        high_score, periods = datasets.switch(players[user_id], name)
+        stash = players[user_id].data.get('rosters')
+    else:
+        high_score, periods, stash = 0, None, None
+    roster = None if datasets.get(name) is datasets.default else name
+    set_player(user_id, high_score, periods, roster, stash)
+    log_event(user_id, 'start')
+    save_player(user_id)
+    send_question(chat, prev="Switched to {}. Starting game...".format(name))
+
+
+@router.command('end', prefix=True)
+def end_game(chat, _):
+    '''
+    End the current game.
+    '''
+    if check(chat):
+        user_id = chat.player_id
+        players[user_id].end()
+        save_player(user_id)
+        log_event(user_id, 'end')
+        chat.quickreply("Game ended.\n" + players[user_id].stats())
+
 
+@router.command('name', argument=REQUIRED)
+def set_name(chat, name):
+    '''
+    Change the name to be shown in Leaderboards.
+    '''
+    if check(chat):
+        if len(name) <= 20:
+            if '(group)' not in name:
+                chat.player.name = name
+                save_player(chat.player_id)
+                chat.quickreply("Name set to {}.".format(name))
+            else:
+                chat.quickreply("You shouldn't put (group) in your name.")
         else:
-            quickreply("I can't leave a 1:1 chat.")
+            chat.quickreply(("Too long.\n"
+                             "Name should consist of 20 characters or less."))
 
-    def ticket_add(item):
-        '''
-        Add a ticket.
-        '''
-        if item in tickets:
-            quickreply("Message already exists.")
-            return
-        if len('num. \n'.join(tickets + [item])) > 2000:
-            quickreply(("There are currently too many messages.\n"
-                        "Please wait until the developer deletes "
-                        "some of them."))
-            return
 
-        tickets.append(item)
-        dbx.files_upload(json.dumps(tickets, indent=4).encode('utf-8'),
-                         tickets_path, dropbox.files.WriteMode.overwrite)
-        quickreply("Message sent!")
+@router.command('stats', prefix=True)
+def show_stats(chat, _):
+    '''
+    Send the current game's statistics.
+    '''
+    if check(chat):
+        chat.quickreply(chat.player.stats())
 
-    def ticket_get():
-        '''
-        Send current tickets.
-        '''
-        if not tickets:
-            quickreply("No messages.")
+
+@router.command('lead', prefix=True, parse=lambda text: text.lower().split(),
+                cost=2)
+def see_leaderboards(chat, options):
+    '''
+    Send current Leaderboards.
+
+    options may name a period (daily, weekly) and 'groups' for the
+    Leaderboards of groups instead of players.
+    '''
+    period = next((each for each in PERIODS if each in options), 'all')
+    board = 'user'
+    if 'group' in options or 'groups' in options:
+        board = 'group'
+    if shared:
+        # Other processes' scores are only seen through storage.
+        datasets.update(players.refresh_all())
+    dataset = (datasets.of(chat.player) if chat.player_id in players
+               else datasets.default)
+    msg = 'Leaderboards'
+    if period != 'all':
+        msg = period.title() + ' ' + msg
+    if board == 'group':
+        msg += ' (groups)'
+    if len(datasets.names()) > 1:
+        msg += ' of ' + dataset.name
+    if not loaded.is_set():
+        msg += ' (still loading)'
+    msg += ':'
+    for i, (score, name, _) in enumerate(
+            dataset.leaderboards.top(board, period)):
+        if board == 'group':
+            msg += '\n{}. {} (group) [{}]'.format(i+1, name, score)
+        else:
+            msg += '\n{}. {} [{}]'.format(i+1, name, score)
+    chat.quickreply(msg)
+
+
+@router.command('msg', argument=REQUIRED, cost=5)
+def ticket_add(chat, item):
+    '''
+    Add a ticket.
+    '''
+    with tickets_locked():
+        if tickets.add(item) is None:
+            chat.quickreply("Message already exists.")
             return
+        save_tickets()
+        chat.quickreply("Message sent!")
 
-        current_tickets = "Messages:"
-        for num, items in enumerate(tickets):
-            current_tickets += "\n{}. {}".format(num+1, items)
-        quickreply(current_tickets)
 
-    def ticket_rem(num):
-        '''
-        Remove a ticket.
-        '''
-        if not tickets:
-            quickreply("No messages.")
+@router.command('tix', prefix=True, admin=True)
+def ticket_get(chat, page):
+    '''
+    Send a page of current tickets, the first one by default.
+    '''
+    try:
+        page = int(page or 1)
+    except ValueError:
+        page = 0
+    if page < 1:
+        chat.quickreply("Wrong format.")
+        return
+    with tickets_locked():
+        if not len(tickets):
+            chat.quickreply("No messages.")
+            return
+        # The heading and four texts fill one reply.
+        texts, pages = tickets.page(page, messages=MAX_MESSAGES - 1)
+    if not texts:
+        chat.quickreply("There are only {} pages.".format(pages))
+        return
+    heading = "Messages ({} in total):".format(len(tickets))
+    if pages > 1:
+        heading = "Messages, page {} of {}:".format(page, pages)
+        if page < pages:
+            heading += "\nUse /tix {} for the next page.".format(page + 1)
+    chat.reply([TextSendMessage(text=text) for text in [heading] + texts])
+
+
+@router.command('rtix', argument=REQUIRED, admin=True)
+def ticket_rem(chat, num):
+    '''
+    Remove a ticket by the number /tix shows, or all of them.
+    '''
+    with tickets_locked():
+        if not len(tickets):
+            chat.quickreply("No messages.")
             return
         if num == 'all':
-            del tickets[:]
-            quickreply("Message list has been emptied.")
+            tickets.clear()
+            chat.quickreply("Message list has been emptied.")
         else:
             try:
                 num = int(num)
-                del tickets[num-1]
-            except IndexError:
-                quickreply("Message [{}] is not available.".format(num))
             except ValueError:
-                quickreply("Wrong format.")
-            else:
-                quickreply("Message [{}] has been removed.".format(num))
-        dbx.files_upload(json.dumps(tickets, indent=4).encode('utf-8'),
-                         tickets_path, dropbox.files.WriteMode.overwrite)
-
-    if text.lower().strip() in ('/', '/n', '/next'):
-        if players[player_id].pick in players[player_id].progress:
-            quickreply(("You haven't answered the question.\n"
-                        "Use /pass if you want to skip it."))
-        else:
-            send_question(player_id)
-
-    elif text.lower().strip() == '/man':
-        try:
-            conf = players[player_id].data['manual']
-        except KeyError:
-            conf = False
-        players[player_id].data['manual'] = False if conf else True
-        if players[player_id].data['manual']:
-            quickreply("Game mode changed from automatic to manual.")
-        else:
-            quickreply("Game mode changed from manual to automatic.")
-
-    elif text[0] == '/' and len(text) > 1:
-        command = text[1:]
-        cmd = command.lower().strip()
-
-        if cmd.startswith('about'):
-            quickreply(about_msg)
-
-        elif cmd.startswith('info'):
-            quickreply(info_msg)
+                chat.quickreply("Wrong format.")
+                return
+            if tickets.remove(num) is None:
+                chat.quickreply("Message [{}] is not available.".format(num))
+                return
+            chat.quickreply("Message [{}] has been removed.".format(num))
+        save_tickets()
 
-        elif cmd.startswith('help'):
-            quickreply(help_msg)
 
-        elif cmd.startswith('bye'):
-            bye()
+@router.command('set', argument=REQUIRED, admin=True)
+def set_pick(chat, name):
+    '''
+    Set the current question to a roster entry.
+    '''
+    if name not in chat.player.current_roster().ids:
+        chat.quickreply("{} is not in the roster.".format(name))
+    else:
+        chat.player.progress.add(name)
+        chat.player.pick = name
+        chat.quickreply("Current pick has been set to {}".format(name))
 
-        elif cmd.startswith('start'):
-            start(player_id)
 
-        elif cmd.startswith('restart'):
-            start(player_id, force=True)
+@router.command('export', prefix=True, admin=True)
+def export(chat, _):
+    '''
+    Upload a snapshot of the save data to Dropbox.
+    '''
+    if save_file_path and storage.incremental:
+        writer.flush()
+        storage.export(dbx, save_file_path)
+        chat.quickreply("Save data exported to Dropbox.")
+    else:
+        chat.quickreply("Save data is already stored on Dropbox.")
 
-        elif cmd.startswith('answer ') or cmd.split()[0] == 'a':
-            name = cmd.split(maxsplit=1)[1]
-            try:
-                answer(player_id, name,
-                       manual=players[player_id].data['manual'])
-            except KeyError:
-                answer(player_id, name)
 
-        elif cmd.startswith('pass') or cmd.split()[0] == 'p':
-            answer(player_id, 'pass')
+@router.command('reload', prefix=True, admin=True)
+def reload_roster(chat, _):
+    '''
+    Reload the rosters in use from Dropbox.
+    '''
+    changed = refresh_rosters()
+    if changed:
+        chat.quickreply("Roster reloaded: " + ', '.join(
+            '{} ({} persons)'.format(name, len(datasets.get(name).roster))
+            for name in changed) + '.')
+    else:
+        chat.quickreply("The roster hasn't changed.")
 
-        elif cmd.startswith('end'):
-            end_game(player_id)
 
-        elif cmd.startswith('name '):
-            name = command[len('name '):]
-            set_name(player_id, name)
+def player_and_name(text):
+    '''
+    Split a /cname argument into a player ID and a name.
+    '''
+    user_id, name = text.split(maxsplit=1)
+    return user_id, name
 
-        elif cmd.startswith('stats') and check(player_id):
-            quickreply(players[player_id].stats())
 
-        elif cmd.startswith('lead'):
-            see_leaderboards()
+@router.command('cname', argument=REQUIRED, parse=player_and_name,
+                admin=True)
+def change_name(chat, argument):
+    '''
+    Change the name of any player.
+    '''
+    user_id, name = argument
+    with players.locked(user_id):
+        try:
+            players[user_id].name = name
+        except KeyError:
+            chat.quickreply("That player doesn't exist.")
+        else:
+            save_player(user_id)
+            chat.quickreply("Name changed.")
 
-        elif cmd.startswith('msg '):
-            item = command[len('msg '):]
-            ticket_add(item)
 
-        elif cmd.startswith('tix') and event.source.user_id == my_id:
-            ticket_get()
+@router.command('hardest', prefix=True, admin=True)
+def hardest(chat, _):
+    '''
+    Send the 10 most missed persons according to the event log.
+    '''
+    if event_log is None:
+        chat.quickreply("The event log is disabled.")
+        return
+    event_log.flush()
+    stats = difficulty(event_log_dir)
+    counts = stats.by_name()
+    rates = stats.miss_rates()
+    msg = "Most missed:"
+    for i, name in enumerate(sorted(rates, key=rates.get,
+                                    reverse=True)[:10]):
+        asked, missed, seconds, timed = counts[name]
+        msg += "\n{}. {}: {}/{} missed".format(i+1, name, missed, asked)
+        if timed:
+            msg += ", {:.1f} s".format(seconds / timed)
+    chat.quickreply(msg)
+
+
+@router.command('tarung', argument=NO_ARGUMENT)
+def tarung(chat, _):
+    '''
+    Cheer.
+    '''
+    chat.quickreply('\U00100027 2017! \U001000a4')
 
-        elif cmd.startswith('rtix ') and event.source.user_id == my_id:
-            item = command[len('rtix '):]
-            ticket_rem(item)
 
-        elif cmd.startswith('set ') and event.source.user_id == my_id:
-            name = command[len('set '):]
-            players[player_id].progress.append(name)
-            players[player_id].pick = name
-            quickreply("Current pick has been set to {}".format(name))
+@router.command('tarung2017', argument=NO_ARGUMENT)
+def tarung2017(chat, _):
+    '''
+    Cheer louder.
+    '''
+    chat.quickreply(("Serang! \U001000a4\n"
+                     "Terjang! \U00100064\n"
+                     "Menang! \U00100073"))
 
-        elif cmd.startswith('cname ') and event.source.user_id == my_id:
-            cname = command.split(maxsplit=2)
-            try:
-                players[cname[1]].name = cname[2]
-            except KeyError:
-                quickreply("That player doesn't exist.")
-            else:
-                quickreply("Name changed.")
 
-        elif cmd == 'tarung':
-            quickreply('\U00100027 2017! \U001000a4')
+def process_event(event):
+    '''
+    Handle a webhook event. If it fails, a redelivery of the event isn't
+    dropped as a duplicate.
+    '''
+    if (isinstance(event, MessageEvent) and
+            isinstance(event.message, TextMessage)):
+        try:
+            handle_text_message(event)
+        except Exception:
+            deduplicator.forget(event_key(event))
+            raise
 
-        elif cmd == 'tarung2017':
-            quickreply(("Serang! \U001000a4\n"
-                        "Terjang! \U00100064\n"
-                        "Menang! \U00100073"))
 
-        else:
-            try:
-                answer(player_id, cmd,
-                       manual=players[player_id].data['manual'])
-            except KeyError:
-                answer(player_id, cmd)
+def throttled(event):
+    '''
+    Check if a command goes over its user's or chat's rate limit, telling
+    the chat the first time it does. The developer's messages and messages
+    that aren't commands are never throttled.
+    '''
+    if (limiter is None or not isinstance(event, MessageEvent) or
+            not isinstance(event.message, TextMessage)):
+        return False
+    source = event.source
+    admin = source.user_id == my_id
+    command, _ = router.resolve(event.message.text, admin)
+    if command is None or admin:
+        return False
+    keys = []
+    if source.user_id:
+        keys.append(('user', source.user_id))
+    if chat_id(source) != source.user_id:
+        keys.append(('group', chat_id(source)))
+    keys = [(scope, key) for scope, key in keys if scope in limiter.limits]
+    if not keys:
+        return False
+    result = limiter.check(keys, command.cost, command.name)
+    if result is None:
+        return False
+    scope, first = result
+    if first:
+        # Reply only, since pushes count against the message quota.
+        messenger.reply(event.reply_token, TextSendMessage(
+            text=THROTTLED_MESSAGES[scope]))
+    return True
+
+
+# Remember recent webhook event IDs to drop redeliveries. Processes sharing
+# state also check them against the database, as a redelivery can reach a
+# different process.
+dedup_path = os.getenv('DEDUP_PATH', sqlite_path if shared else None)
+deduplicator = Deduplicator(
+    ttl=float(os.getenv('DEDUP_TTL', 600)),
+    size=int(os.getenv('DEDUP_SIZE', 10000)),
+    store=SQLiteSeen(dedup_path) if dedup_path else None)
+
+# Handle webhook events in worker threads if configured.
+dispatcher = None
+if int(os.getenv('WEBHOOK_WORKERS', 0)) > 0:
+    dispatcher = Dispatcher(
+        process_event,
+        workers=int(os.getenv('WEBHOOK_WORKERS')),
+        max_pending=int(os.getenv('WEBHOOK_QUEUE_SIZE', 100)),
+        policy=os.getenv('WEBHOOK_BACKPRESSURE', 'block'))
+    dispatcher.start()
 
 
 if __name__ == "__main__":
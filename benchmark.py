@@ -0,0 +1,1637 @@
+'''
+TarungBot benchmarks
+
+Usage: python benchmark.py <benchmark> [options]
+'''
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+from fakes import bot_env, fake_roster, game_files, webhook
+
+
+def fake_record(roster, rng):
+    '''
+    Return a Player.toJSON()-like record halfway through a game.
+    '''
+    progress = rng.sample(roster, len(roster) // 2)
+    return {'name': 'Anonymous', 'pick': progress[0], 'progress': progress,
+            'data': {'exact': 10, 'correct': 50, 'partial': 40,
+                     'wrong': 60, 'skipped': 40, 'count': 0, 'score': 320,
+                     'high_score': 320, 'manual': False}}
+
+
+def percentile(samples, pct):
+    '''
+    Return the pct-th percentile of a list of samples.
+    '''
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def bench_save(args):
+    '''
+    Compare whole-file JSON saves with per-player SQLite saves.
+    '''
+    from storage import SQLiteStorage
+
+    roster = fake_roster()
+    rng = random.Random(0)
+    template = [fake_record(roster, rng) for _ in range(100)]
+    for count in args.players:
+        records = {'U{:032x}'.format(i): template[i % len(template)]
+                   for i in range(count)}
+        changed = next(iter(records))
+
+        start = time.perf_counter()
+        size = len(json.dumps(records, indent=4).encode('utf-8'))
+        whole = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db = SQLiteStorage(os.path.join(tmp, 'save.db'))
+            db.save(records)
+            samples = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                db.save({changed: records[changed]})
+                samples.append(time.perf_counter() - start)
+
+        print('{:>7} players: whole-file {:8.1f} ms ({:.1f} MB, '
+              'serialization only), sqlite p50 {:.3f} ms p99 {:.3f} ms'
+              .format(count, whole * 1000, size / 2**20,
+                      percentile(samples, 50) * 1000,
+                      percentile(samples, 99) * 1000))
+
+
+def bench_links(args):
+    '''
+    Measure next_link latency with and without the link cache.
+    '''
+    from fakes import FakeDropboxServer
+    from linkcache import DropboxLinks, LinkCache, Prefetcher
+
+    roster = fake_roster(args.roster)
+    with FakeDropboxServer(latency=args.latency) as server:
+        fetch = DropboxLinks('token', '/game', server.url)
+        for mode in ('uncached', 'cached', 'prefetch'):
+            cache = LinkCache(fetch)
+            prefetcher = Prefetcher(cache)
+            prefetcher.start()
+            rng = random.Random(0)
+            games = [(rng.sample(roster, len(roster)), [None])
+                     for _ in range(args.players)]
+            samples = []
+            for _ in range(args.questions):
+                for progress, upcoming in games:
+                    start = time.perf_counter()
+                    pick = upcoming[0] or progress[-1]
+                    if mode == 'uncached':
+                        fetch('male', pick)
+                    else:
+                        cache.get('male', pick)
+                    samples.append(time.perf_counter() - start)
+                    progress.remove(pick)
+                    upcoming[0] = rng.choice(progress)
+                    if mode == 'prefetch':
+                        prefetcher.prefetch('male', upcoming[0])
+                time.sleep(args.think)
+            print('{:>8}: hit rate {:5.1f}%, p50 {:6.2f} ms, p99 {:6.2f} ms'
+                  .format(mode, cache.hit_rate() * 100,
+                          percentile(samples, 50) * 1000,
+                          percentile(samples, 99) * 1000))
+
+
+def bench_stress(args):
+    '''
+    Time answers from one user in one group sent through the webhook from
+    many threads at once.
+
+    Webhooks go through Flask's test client and the bot's webhook workers,
+    with fakes for the LINE and Dropbox APIs as in `offline`. The order
+    and saved progress of these answers are checked in tests/test_stress.py.
+    '''
+    import threading
+    import dropbox
+    from fakes import FakeDropbox, FakeDropboxServer, FakeLineServer
+
+    roster = fake_roster(args.answers + 100)
+    fake = FakeDropbox(game_files(roster))
+    secret = 'stress-secret'
+    group = 'C{:032x}'.format(0)
+    source = {'type': 'group', 'groupId': group,
+              'userId': 'U{:032x}'.format(1)}
+    rng = random.Random(0)
+    bodies = [webhook(secret, rng.choice(('/pass', '/a zzzzzz')), source,
+                      token) for token in range(1, args.answers + 1)]
+
+    with FakeLineServer() as line, FakeDropboxServer() as links, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(bot_env(secret, line, links))
+        os.environ.update({'SQLITE_PATH': os.path.join(tmp, 'save.db'),
+                           'WEBHOOK_WORKERS': str(args.workers),
+                           'LINE_RATE': '100000'})
+        dropbox.Dropbox = lambda *args, **kwargs: fake
+        import app
+
+        if not app.loaded.wait(60):
+            print('The bot did not start: {}'.format(app.startup['error']))
+            return 1
+        errors = []
+
+        def post(client, item):
+            body, signature = item
+            response = client.post(
+                '/callback', data=body.encode('utf-8'),
+                headers={'Content-Type': 'application/json',
+                         'X-Line-Signature': signature})
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+        def replies(count, timeout=60):
+            deadline = time.time() + timeout
+            while len(line.sent) < count and time.time() < deadline:
+                time.sleep(0.01)
+
+        post(app.app.test_client(), webhook(secret, '/start', source))
+        replies(1)
+        barrier = threading.Barrier(args.threads)
+
+        def work(items):
+            client = app.app.test_client()
+            barrier.wait()
+            for item in items:
+                post(client, item)
+
+        threads = [threading.Thread(target=work,
+                                    args=(bodies[index::args.threads],))
+                   for index in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        accepted = time.perf_counter() - start
+        replies(len(bodies) + 1)
+        elapsed = time.perf_counter() - start
+        with app.players.locked(group):
+            app.writer.flush()
+
+    print('{} answers from {} threads: accepted in {:.2f} s, {} replies in '
+          '{:.2f} s ({:.0f} answers/s), {} errors'
+          .format(len(bodies), args.threads, accepted, len(line.sent) - 1,
+                  elapsed, len(bodies) / elapsed, len(errors)))
+    return 1 if errors or len(line.sent) != len(bodies) + 1 else 0
+
+
+def workload(secret, count, chats, seed=0, mix=None, names=('budi',)):
+    '''
+    Return count signed webhooks from a mix of users and groups.
+
+    mix maps message texts to their weights; {name} in a text is replaced
+    by one of names.
+    '''
+    rng = random.Random(seed)
+    texts = ['/start'] * 5 + ['/a budi', '/pass', '/'] * 20 + [
+        '/stats', '/lead', '/restart']
+    bodies = []
+    for token in range(count):
+        chat = rng.randrange(chats)
+        if chat % 4:
+            source = {'type': 'user', 'userId': 'U{:032x}'.format(chat)}
+        else:
+            source = {'type': 'group', 'groupId': 'C{:032x}'.format(chat),
+                      'userId': 'U{:032x}'.format(chat + 1)}
+        if mix is None:
+            text = rng.choice(texts)
+        else:
+            text = rng.choices(list(mix), list(mix.values()))[0].format(
+                name=rng.choice(names))
+        bodies.append(webhook(secret, text, source, token))
+    return bodies
+
+
+def replay(url, bodies, concurrency):
+    '''
+    POST signed webhooks to url and return (seconds, latencies, errors).
+    '''
+    import threading
+    import requests
+
+    latencies = []
+    errors = []
+    pending = iter(bodies)
+    lock = threading.Lock()
+
+    def work():
+        session = requests.Session()
+        while True:
+            with lock:
+                item = next(pending, None)
+            if item is None:
+                return
+            body, signature = item
+            start = time.perf_counter()
+            try:
+                response = session.post(
+                    url + '/callback', data=body.encode('utf-8'), timeout=30,
+                    headers={'Content-Type': 'application/json',
+                             'X-Line-Signature': signature})
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+            except requests.RequestException as error:
+                errors.append(error)
+            latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, errors
+
+
+def wait_for(url, timeout=60):
+    '''
+    Wait until a server answers HTTP requests at url with a 200.
+    '''
+    import requests
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('{} did not come up'.format(url))
+
+
+def fake_app():
+    '''
+    Import the bot with Dropbox replaced by a fakes.FakeDropbox holding
+    game_files() of a FAKE_ROSTER-entry roster, and return its Flask app.
+
+    For benchmarks that run the bot in its own processes, e.g. as
+    gunicorn 'benchmark:fake_app()'. LINE and question image links go to
+    LINE_API_URL and DROPBOX_API_URL, see bot_env().
+    '''
+    import dropbox
+    from fakes import FakeDropbox
+
+    fake = FakeDropbox(game_files(fake_roster(int(os.environ['FAKE_ROSTER']))))
+    dropbox.Dropbox = lambda *args, **kwargs: fake
+    from app import app
+    return app
+
+
+def bench_loadtest(args):
+    '''
+    Replay signed webhooks against gunicorn with several worker counts.
+
+    Workers share player state through SQLite as in production, and talk to
+    a fakes.FakeLineServer and fakes.FakeDropboxServer, with every other
+    Dropbox call going to a fakes.FakeDropbox in each worker.
+    '''
+    import subprocess
+    from fakes import FakeDropboxServer, FakeLineServer
+
+    roster = fake_roster(args.roster)
+    secret = 'loadtest-secret'
+    bodies = workload(secret, args.requests, args.chats, mix=OFFLINE_MIX,
+                      names=[name.lower() for name in roster])
+    for workers in args.workers:
+        url = 'http://127.0.0.1:{}'.format(args.port)
+        with FakeLineServer() as line, FakeDropboxServer() as links, \
+                tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, FAKE_ROSTER=str(args.roster),
+                       SQLITE_PATH=os.path.join(tmp, 'save.db'),
+                       SHARED_STATE_DIR=os.path.join(tmp, 'locks'),
+                       **bot_env(secret, line, links))
+            server = subprocess.Popen([
+                'gunicorn', 'benchmark:fake_app()',
+                '--workers', str(workers), '--threads', str(args.threads),
+                '--bind', '127.0.0.1:{}'.format(args.port),
+                '--log-level', 'warning'], env=env)
+            try:
+                wait_for(url + '/ready')
+                elapsed, latencies, errors = replay(url, bodies,
+                                                    args.concurrency)
+            finally:
+                server.terminate()
+                server.wait()
+            replies = len(line.sent)
+        print('{:>2} workers: {:7.1f} req/s, p50 {:6.1f} ms, '
+              'p99 {:6.1f} ms, {} replies, {} errors'
+              .format(workers, len(bodies) / elapsed,
+                      percentile(latencies, 50) * 1000,
+                      percentile(latencies, 99) * 1000, replies,
+                      len(errors)))
+
+
+def bench_startup(args):
+    '''
+    Measure how long a freshly started bot takes to answer webhooks.
+
+    The bot runs in its own process on Flask's server, with the fake
+    services of fake_app(), and `--players` saved players to load.
+    '''
+    import subprocess
+    import requests
+    from fakes import FakeDropboxServer, FakeLineServer
+
+    roster = fake_roster(args.roster)
+    secret = 'startup-secret'
+    url = 'http://127.0.0.1:{}'.format(args.port)
+    body, signature = webhook(secret, '/help',
+                              {'type': 'user', 'userId': 'U' + '0' * 32})
+    times = {}
+    with FakeLineServer() as line, FakeDropboxServer() as links, \
+            tempfile.TemporaryDirectory() as tmp:
+        from game import Player, Roster
+        from storage import SQLiteStorage
+
+        Player.roster = Roster(roster[::2], roster[1::2])
+        rng = random.Random(0)
+        path = os.path.join(tmp, 'save.db')
+        storage = SQLiteStorage(path)
+        storage.save({'U{:032x}'.format(index): Player.fromJSON(
+            fake_record(roster, rng)).toJSON()
+                      for index in range(args.players)})
+        storage.conn.close()
+        env = dict(os.environ, FAKE_ROSTER=str(args.roster),
+                   SQLITE_PATH=path, **bot_env(secret, line, links))
+        start = time.perf_counter()
+        server = subprocess.Popen([
+            sys.executable, '-c', 'import benchmark, logging; '
+            'logging.getLogger("werkzeug").setLevel(logging.WARNING); '
+            'benchmark.fake_app().run(port={})'.format(args.port)], env=env)
+        try:
+            while (len(times) < 4 and
+                   time.perf_counter() - start < args.timeout):
+                now = time.perf_counter() - start
+                try:
+                    ready = requests.get(url + '/ready', timeout=1)
+                    times.setdefault('listening', now)
+                    if ready.status_code == 200:
+                        times.setdefault('ready', now)
+                    if ready.json()['loaded']:
+                        times.setdefault('loaded', now)
+                    if 'first reply' not in times:
+                        reply = requests.post(
+                            url + '/callback', data=body.encode('utf-8'),
+                            timeout=args.timeout,
+                            headers={'Content-Type': 'application/json',
+                                     'X-Line-Signature': signature})
+                        if reply.status_code == 200 and line.sent:
+                            times['first reply'] = (time.perf_counter() -
+                                                    start)
+                except requests.RequestException:
+                    pass
+                time.sleep(0.05)
+        finally:
+            server.terminate()
+            server.wait()
+    for key in ('listening', 'first reply', 'ready', 'loaded'):
+        print('{:>12}: {}'.format(key, '{:.2f} s'.format(times[key])
+                                  if key in times else 'timed out'))
+
+
+def bench_progress(args):
+    '''
+    Compare memory and save size of list and bitset progress.
+    '''
+    import tracemalloc
+    from game import Player, Roster
+
+    roster = fake_roster(args.roster)
+    Player.roster = Roster(roster[::2], roster[1::2])
+    rng = random.Random(0)
+    records = [json.dumps(fake_record(roster, rng))
+               for _ in range(args.players)]
+
+    for fmt in ('list', 'bitset'):
+        tracemalloc.start()
+        if fmt == 'list':
+            # What loading the old save file produced.
+            players = [json.loads(record) for record in records]
+            saved = [json.dumps(player) for player in players]
+        else:
+            players = [Player.fromJSON(json.loads(record))
+                       for record in records]
+            saved = [json.dumps(player.toJSON()) for player in players]
+        memory = tracemalloc.get_traced_memory()[0]
+        memory -= sum(sys.getsizeof(record) for record in saved)
+        tracemalloc.stop()
+        print('{:>6}: {:8.1f} KB in memory, {:6.0f} bytes saved per player'
+              .format(fmt, memory / args.players / 1024,
+                      sum(map(len, saved)) / args.players))
+        del players, saved
+
+
+def judge_before(answer, pick):
+    '''
+    The answer matching TarungBot used before the Matcher, for comparison.
+    '''
+    if answer == pick.lower():
+        return 'exact'
+    correct = False
+    entirely = True
+    specific = False
+    for word in answer.split():
+        common = (word in 'muhammad' or
+                  word in 'muhamad' or
+                  word.title() in 'Naufal')
+        specific = len(word) >= 3 if not common else specific
+        correct = word in pick.lower() or correct
+        entirely = word in pick.lower() and entirely
+    if not specific:
+        return 'vague'
+    if not correct:
+        return 'wrong'
+    return 'correct' if entirely else 'partial'
+
+
+def match_corpus(roster, count, rng):
+    '''
+    Return count (answer, pick) pairs: mostly whole names and single words
+    of the pick, some with a typo, and some words of other names.
+    '''
+    cases = []
+    for _ in range(count):
+        pick = rng.choice(roster)
+        words = pick.lower().split()
+        kind = rng.random()
+        if kind < 0.3:
+            answer = pick.lower()
+        elif kind < 0.7:
+            answer = rng.choice(words)
+        elif kind < 0.85:
+            word = rng.choice(words)
+            index = rng.randrange(len(word))
+            answer = word[:index] + word[index + 1:]
+        else:
+            answer = rng.choice(rng.choice(roster).lower().split())
+        cases.append((answer, pick))
+    return cases
+
+
+def bench_match(args):
+    '''
+    Time the answer matcher against the matching TarungBot used before.
+
+    The verdicts themselves are checked in tests/test_matching.py.
+    '''
+    from game import Roster
+
+    names = fake_roster(args.roster)
+    roster = Roster(names, [])
+    cases = [(answer, pick, roster.ids[pick]) for answer, pick
+             in match_corpus(names, args.answers, random.Random(0))]
+    start = time.perf_counter()
+    for answer, pick, _ in cases:
+        judge_before(answer, pick)
+    before = time.perf_counter() - start
+    start = time.perf_counter()
+    for answer, _, index in cases:
+        roster.matcher.judge(answer, index)
+    after = time.perf_counter() - start
+    print('before: {:.2f} us/answer, matcher: {:.2f} us/answer'
+          .format(before / len(cases) * 1e6, after / len(cases) * 1e6))
+
+
+def bench_lead(args):
+    '''
+    Compare sorting every player with reading the top-K Leaderboards.
+    '''
+    from game import Player
+    from leaderboard import Leaderboards
+
+    rng = random.Random(0)
+    players = {}
+    for i in range(args.players):
+        player = Player(name='Player{}'.format(i))
+        player.data['high_score'] = rng.randrange(1000)
+        players['{}{:08d}'.format('UC'[i % 2], i)] = player
+    leaderboards = Leaderboards(size=10)
+
+    start = time.perf_counter()
+    leaderboards.rebuild(players.items())
+    rebuild = time.perf_counter() - start
+    start = time.perf_counter()
+    for chat, player in rng.sample(sorted(players.items()), args.updates):
+        player.data['high_score'] += rng.randrange(50)
+        leaderboards.update(chat, player)
+    update = (time.perf_counter() - start) / args.updates
+
+    start = time.perf_counter()
+    for _ in range(args.reads):
+        board = sorted(([player.data['high_score'], player.name,
+                         chat[0] != 'U']
+                        for chat, player in players.items()), reverse=True)
+    before = (time.perf_counter() - start) / args.reads
+    start = time.perf_counter()
+    for _ in range(args.reads):
+        users = leaderboards.top('user')
+        groups = leaderboards.top('group')
+    after = (time.perf_counter() - start) / args.reads
+
+    expected = [(score, name) for score, name, group in board if not group]
+    same = [entry[:2] for entry in users] == expected[:10]
+    expected = [(score, name) for score, name, group in board if group]
+    same = same and [entry[:2] for entry in groups] == expected[:10]
+    print('{} players: rebuild {:.1f} ms, update {:.1f} us'
+          .format(args.players, rebuild * 1e3, update * 1e6))
+    print('sort per /lead: {:.3f} ms, top-K per /lead: {:.3f} ms -> {}'
+          .format(before * 1e3, after * 1e3,
+                  'same' if same else 'DIFFERENT'))
+    return 0 if same else 1
+
+
+def bench_savelog(args):
+    '''
+    Compare bytes written per answer and load time of the whole-file JSON
+    save and the snapshot + log save.
+    '''
+    from game import Player, Roster
+    from storage import LogStorage
+
+    roster = fake_roster(args.roster)
+    Player.roster = Roster(roster[::2], roster[1::2])
+    rng = random.Random(0)
+    players = {}
+    for i in range(args.players):
+        player = Player.fromJSON(fake_record(roster, rng))
+        player.next_pick()
+        players['U{:032x}'.format(i)] = player
+    records = {chat: player.toJSON() for chat, player in players.items()}
+    whole = json.dumps(records, indent=4).encode('utf-8')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'save.jsonl')
+        storage = LogStorage(path, compact_size=args.compact_size)
+        storage.save(records)
+        storage.compact()
+        storage.written = storage.compactions = 0
+        chats = list(players)
+        for _ in range(args.answers):
+            chat = rng.choice(chats)
+            players[chat].answer(rng.choice(('pass', 'xyz', players[chat]
+                                             .pick.split()[0])))
+            players[chat].next_pick()
+            storage.save({chat: players[chat].toJSON()})
+        written = storage.written
+        compactions = storage.compactions
+
+        start = time.perf_counter()
+        json.loads(whole.decode('utf-8'))
+        whole_load = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = LogStorage(path).load()
+        log_load = time.perf_counter() - start
+        same = loaded == {chat: player.toJSON()
+                          for chat, player in players.items()}
+
+    print('{} players, {} answers, {} compactions'
+          .format(args.players, args.answers, compactions))
+    print('whole file: {:10.0f} bytes/answer, load {:7.1f} ms'
+          .format(len(whole), whole_load * 1000))
+    print('log:        {:10.0f} bytes/answer, load {:7.1f} ms -> {}'
+          .format(written / args.answers, log_load * 1000,
+                  'same' if same else 'DIFFERENT'))
+    return 0 if same else 1
+
+
+def bench_events(args):
+    '''
+    Check event log replays and time difficulty reports over many events.
+    '''
+    import events
+    from game import Player, Roster
+
+    roster = fake_roster(args.roster)
+    Player.roster = Roster(roster[::2], roster[1::2])
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Replay: play real games and rebuild them from their events.
+        log = events.EventLog(os.path.join(tmp, 'replay'))
+        players = {}
+        for i in range(args.chats):
+            chat = 'U{:032x}'.format(i)
+            players[chat] = Player()
+            log.record(chat, 'start')
+        for _ in range(args.replay):
+            chat = rng.choice(list(players))
+            player = players[chat]
+            if player.finished():
+                high_score = player.data['high_score']
+                players[chat] = player = Player()
+                player.data['high_score'] = high_score
+                log.record(chat, 'start')
+            player.next_pick()
+            guess = rng.choice(('pass', 'xyz', 'x', player.pick,
+                                player.pick.split()[0]))
+            player.answer(guess)
+            player.data['count'] = 0
+            log.answered(chat, player)
+        log.flush()
+        replayed = events.replay(log.directory)
+        same = all(replayed[chat].data == player.data and
+                   list(replayed[chat].progress) == list(player.progress)
+                   for chat, player in players.items())
+        print('replayed {} answers of {} chats -> {}'
+              .format(args.replay, args.chats,
+                      'same' if same else 'DIFFERENT'))
+
+        # Difficulty: write synthetic events straight to a segment.
+        directory = os.path.join(tmp, 'report')
+        log = events.EventLog(directory)
+        with log.lock:
+            strings = [log.intern('U{:032x}'.format(i))
+                       for i in range(args.chats)]
+            version = log.intern(Player.roster.version)
+        kinds = [events.KINDS.index(kind) for kind in
+                 ('exact', 'correct', 'partial', 'wrong', 'skipped')]
+        start = time.perf_counter()
+        for done in range(0, args.events, 100000):
+            log.pending = [events.RECORD.pack(
+                done + i, rng.choice(strings), version,
+                rng.randrange(len(roster)), rng.choice(kinds),
+                rng.random() * 20, events.NONE)
+                           for i in range(min(100000, args.events - done))]
+            log.flush()
+        print('wrote {} events in {:.1f} s ({:.1f} MB)'
+              .format(args.events, time.perf_counter() - start,
+                      os.path.getsize(log.path) / 2**20))
+
+        results = {}
+        for mode in ('numpy', 'python'):
+            numpy, events.numpy = events.numpy, (
+                events.numpy if mode == 'numpy' else None)
+            if mode == 'numpy' and numpy is None:
+                print('numpy: not installed')
+                continue
+            try:
+                start = time.perf_counter()
+                results[mode] = events.difficulty(directory).by_name()
+                print('{:>6}: difficulty report in {:.2f} s'
+                      .format(mode, time.perf_counter() - start))
+            finally:
+                events.numpy = numpy
+        if len(results) == 2:
+            close = all(
+                results['numpy'][name][:2] == counts[:2] and
+                abs(results['numpy'][name][2] - counts[2]) < 1e-3 * counts[2]
+                for name, counts in results['python'].items())
+            print('numpy and python reports', 'match' if close else 'DIFFER')
+            same = same and close
+    return 0 if same else 1
+
+
+def bench_schedule(args):
+    '''
+    Simulate players under each question scheduler.
+    '''
+    import scheduler
+    from game import Player, Roster
+
+    roster = fake_roster(args.roster)
+    Player.roster = Roster(roster[::2], roster[1::2])
+    rng = random.Random(0)
+    # How likely a player is to miss each person, skewed towards easy.
+    hardness = {name: rng.random() ** 2 for name in Player.roster.names}
+
+    for name in scheduler.SCHEDULERS:
+        Player.scheduler = scheduler.make(name)
+        # Start the difficulty weights from an earlier round of answers.
+        Player.scheduler.seed({each: (20, round(20 * rate))
+                               for each, rate in hardness.items()})
+        players = [Player() for _ in range(args.players)]
+        missed_before = [set() for _ in players]
+        asked = missed = repeated = 0
+        picking = 0.0
+        for _ in range(args.questions):
+            for player, before in zip(players, missed_before):
+                if player.finished():
+                    continue
+                start = time.perf_counter()
+                player.next_pick()
+                picking += time.perf_counter() - start
+                asked += 1
+                repeated += player.pick in before
+                if rng.random() < hardness[player.pick]:
+                    missed += 1
+                    before.add(player.pick)
+                    player.answer('pass')
+                else:
+                    player.answer(player.pick)
+        state = sum(len(json.dumps(player.data['review']))
+                    for player in players
+                    if player.data.get('review')) / len(players)
+        print('{:>10}: pick {:5.1f} us, {:5.1f} bytes/player of schedule '
+              'state, missed {:5.1%}, re-asked {:5.1%}'
+              .format(name, picking / asked * 1e6, state, missed / asked,
+                      repeated / asked))
+    Player.scheduler = scheduler.Scheduler()
+
+
+def bench_messages(args):
+    '''
+    Send replies to a fake LINE API that fails, expires tokens and rate
+    limits, and check that every message arrives exactly once.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    from fakes import FakeLineServer
+    from messaging import Messenger
+
+    rng = random.Random(0)
+    with FakeLineServer(latency=args.latency, fail_rate=args.fail_rate,
+                        rate_limit=args.server_limit) as line:
+        messenger = Messenger('token', endpoint=line.url, timeout=2,
+                              retries=args.retries, backoff=0.05,
+                              rate=args.rate)
+        tokens = ['{}{}'.format('expired' if rng.random() < args.expired
+                                else 'token', i)
+                  for i in range(args.count)]
+
+        def send(i):
+            return messenger.reply(tokens[i], [{'type': 'text',
+                                                'text': str(i)}],
+                                   to='U{}'.format(i))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            results = list(pool.map(send, range(args.count)))
+        elapsed = time.perf_counter() - start
+
+    delivered = {}
+    for _, _, messages in line.sent:
+        for message in messages:
+            delivered[message['text']] = delivered.get(message['text'],
+                                                       0) + 1
+    duplicates = sum(count - 1 for count in delivered.values())
+    stats = messenger.stats()
+    print('{} replies in {:.2f} s: {} sent, {} failed, {} pushed after '
+          'expired tokens, {} assumed delivered, {} duplicates'
+          .format(args.count, elapsed, sum(results),
+                  args.count - sum(results), stats['fallbacks'],
+                  stats['assumed'], duplicates))
+    for kind in ('reply', 'push'):
+        print('{:>5}: {calls} calls, error rate {error_rate:.1%}, '
+              'p50 {p50} s, p95 {p95} s'.format(kind, **stats[kind]))
+    return 0 if duplicates == 0 and all(results) else 1
+
+
+# The bot's commands as (name, aliases, prefix, argument, admin), for
+# bench_dispatch. app.py can't be imported without its credentials.
+COMMANDS = [
+    ('answer', ('a',), False, 'required', False),
+    ('pass', ('p',), True, 'optional', False),
+    ('next', ('n', ''), False, 'none', False),
+    ('man', (), False, 'none', False),
+    ('about', (), True, 'optional', False),
+    ('info', (), True, 'optional', False),
+    ('help', (), True, 'optional', False),
+    ('bye', (), True, 'optional', False),
+    ('start', (), True, 'optional', False),
+    ('restart', (), True, 'optional', False),
+    ('end', (), True, 'optional', False),
+    ('name', (), False, 'required', False),
+    ('stats', (), True, 'optional', False),
+    ('lead', (), True, 'optional', False),
+    ('msg', (), False, 'required', False),
+    ('tix', (), True, 'optional', True),
+    ('rtix', (), False, 'required', True),
+    ('set', (), False, 'required', True),
+    ('export', (), True, 'optional', True),
+    ('reload', (), True, 'optional', True),
+    ('cname', (), False, 'required', True),
+    ('hardest', (), True, 'optional', True),
+    ('tarung', (), False, 'none', False),
+    ('tarung2017', (), False, 'none', False),
+]
+
+DISPATCH_MESSAGES = [
+    '/', '/n', '/next', '/ ', '/next one', '/man', '/manual', '/about',
+    '/aboutme', '/info', '/help', '/bye', '/start', '/Starting',
+    '/restart', '/a Budi', '/answer budi santoso', '/answer', '/A budi',
+    '/pass', '/p', '/p later', '/pa', '/end', '/endgame', '/name Budi',
+    '/name', '/stats', '/lead', '/lead daily groups', '/leaderboard',
+    '/msg hi there', '/msg', '/tix', '/rtix 2', '/set Budi',
+    '/export', '/reload', '/cname U1 Budi', '/hardest', '/tarung',
+    '/tarung2017', '/tarung 2017', '/budi', '/Siti Aminah', 'hello',
+    'good game',
+]
+
+
+def dispatch_before(text, admin):
+    '''
+    The command the old if/elif chain of handle_command ran for a message,
+    'answer' for guesses, or None.
+    '''
+    # pylint: disable=too-many-return-statements,too-many-branches
+    if text.lower().strip() in ('/', '/n', '/next'):
+        return 'next'
+    if text.lower().strip() == '/man':
+        return 'man'
+    if not (text[0] == '/' and len(text) > 1):
+        return None
+    cmd = text[1:].lower().strip()
+    for name in ('about', 'info', 'help', 'bye', 'start', 'restart'):
+        if cmd.startswith(name):
+            return name
+    if cmd.startswith('answer ') or cmd.split()[0] == 'a':
+        return 'answer'
+    if cmd.startswith('pass') or cmd.split()[0] == 'p':
+        return 'pass'
+    if cmd.startswith('end'):
+        return 'end'
+    if cmd.startswith('name '):
+        return 'name'
+    for name in ('stats', 'lead'):
+        if cmd.startswith(name):
+            return name
+    if cmd.startswith('msg '):
+        return 'msg'
+    for name in ('tix', 'rtix ', 'set ', 'export', 'reload', 'cname ',
+                 'hardest'):
+        if cmd.startswith(name) and admin:
+            return name.strip()
+    if cmd in ('tarung', 'tarung2017'):
+        return cmd
+    return 'answer'
+
+
+def bench_dispatch(args):
+    '''
+    Time how long the command router and the old if/elif chain take to
+    pick the command of a message.
+
+    The commands the router picks are checked in tests/test_commands.py.
+    '''
+    from commands import Router
+
+    router = Router()
+    router.default('answer')(lambda context, argument: None)
+    for name, aliases, prefix, argument, admin in COMMANDS:
+        router.command(name, aliases, prefix=prefix, argument=argument,
+                       admin=admin)(lambda context, argument: None)
+
+    def after(text, admin):
+        command, _ = router.resolve(text, admin)
+        return command.name if command is not None else None
+
+    messages = DISPATCH_MESSAGES * args.repeat
+    for label, dispatch in (('if/elif chain', dispatch_before),
+                            ('router', after)):
+        start = time.perf_counter()
+        for text in messages:
+            dispatch(text, False)
+        elapsed = time.perf_counter() - start
+        print('{:>13}: {:.2f} us/message'
+              .format(label, elapsed / len(messages) * 1e6))
+
+
+# Share of each message in the offline workload. {name} is a random
+# roster entry, so most answers are wrong.
+OFFLINE_MIX = {'/start': 3, '/a {name}': 40, '/{name}': 10, '/pass': 15,
+               '/': 20, '/stats': 5, '/lead': 5, '/lead weekly groups': 1,
+               '/restart': 1}
+
+
+def rss():
+    '''
+    Return the resident set size of this process in bytes.
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def directory_size(path):
+    '''
+    Return the total size of the files under a directory.
+    '''
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def bench_offline(args):
+    '''
+    Replay a synthetic workload through the bot in this process, with local
+    fakes for the LINE and Dropbox APIs, and write the results as JSON.
+
+    Webhooks go through Flask's test client, so latencies leave out the
+    HTTP server. Replies go to a fakes.FakeLineServer, question image
+    links come from a fakes.FakeDropboxServer and every other Dropbox call
+    goes to a fakes.FakeDropbox.
+    '''
+    import threading
+    import dropbox
+    from fakes import FakeDropbox, FakeDropboxServer, FakeLineServer
+
+    roster = fake_roster(args.roster)
+    fake = FakeDropbox(game_files(roster))
+    secret = 'offline-secret'
+    bodies = workload(secret, args.requests, args.chats, mix=OFFLINE_MIX,
+                      names=[name.lower() for name in roster])
+
+    with FakeLineServer(latency=args.latency) as line, \
+            FakeDropboxServer(latency=args.latency) as links, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(bot_env(secret, line, links))
+        os.environ.update({
+            'EVENT_LOG_DIR': os.path.join(tmp, 'events'),
+            'WEBHOOK_WORKERS': str(args.workers),
+            'LINE_RATE': str(args.line_rate)})
+        if args.storage == 'sqlite':
+            os.environ['SQLITE_PATH'] = os.path.join(tmp, 'save.db')
+        elif args.storage == 'log':
+            os.environ['SAVE_LOG_PATH'] = os.path.join(tmp, 'save.jsonl')
+        dropbox.Dropbox = lambda *args, **kwargs: fake
+        import app
+
+        if not app.loaded.wait(60):
+            print('The bot did not start: {}'.format(app.startup['error']))
+            return 1
+        rss_before = rss()
+        latencies = []
+        errors = []
+        pending = iter(bodies)
+        lock = threading.Lock()
+
+        def work():
+            client = app.app.test_client()
+            while True:
+                with lock:
+                    item = next(pending, None)
+                if item is None:
+                    return
+                body, signature = item
+                start = time.perf_counter()
+                response = client.post(
+                    '/callback', data=body.encode('utf-8'),
+                    headers={'Content-Type': 'application/json',
+                             'X-Line-Signature': signature})
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+
+        threads = [threading.Thread(target=work)
+                   for _ in range(args.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if app.dispatcher is not None:
+            while app.dispatcher.depth():
+                time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        app.writer.flush()
+        if app.event_log is not None:
+            app.event_log.flush()
+
+        local = app.storage.written if args.storage != 'dropbox' else 0
+        persisted = {'storage': local, 'dropbox': fake.uploaded,
+                     'event_log': directory_size(os.path.join(tmp,
+                                                              'events'))}
+        commands = {}
+        for (name,), counts in app.command_seconds.values.items():
+            count = sum(counts[:-1])
+            commands[name] = {'count': count,
+                              'mean_ms': round(counts[-1] / count * 1000, 3)}
+        results = {
+            'benchmark': 'offline',
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'config': {'requests': args.requests, 'chats': args.chats,
+                       'concurrency': args.concurrency,
+                       'workers': args.workers, 'storage': args.storage,
+                       'roster': len(roster), 'latency': args.latency,
+                       'line_rate': args.line_rate,
+                       'python': sys.version.split()[0]},
+            'seconds': round(elapsed, 3),
+            'throughput': round(len(bodies) / elapsed, 1),
+            'latency_ms': {
+                'p50': round(percentile(latencies, 50) * 1000, 3),
+                'p95': round(percentile(latencies, 95) * 1000, 3),
+                'p99': round(percentile(latencies, 99) * 1000, 3),
+                'max': round(max(latencies) * 1000, 3)},
+            'errors': len(errors),
+            'replies': len(line.sent),
+            'players': len(app.players),
+            'rss_bytes': {'before': rss_before, 'after': rss()},
+            'persisted_bytes': dict(persisted,
+                                    total=sum(persisted.values())),
+            'commands': commands,
+        }
+
+    with open(args.output, 'w') as out:
+        json.dump(results, out, indent=2, sort_keys=True)
+    print('{} webhooks in {:.2f} s: {:.1f} req/s, p50 {:.2f} ms, '
+          'p99 {:.2f} ms, {} errors, RSS {:.1f} MiB, {} bytes persisted'
+          .format(len(bodies), elapsed, results['throughput'],
+                  results['latency_ms']['p50'], results['latency_ms']['p99'],
+                  len(errors), results['rss_bytes']['after'] / 2**20,
+                  results['persisted_bytes']['total']))
+    print('Results written to {}'.format(args.output))
+    if args.baseline:
+        compare(args.baseline, results)
+    return 1 if errors else 0
+
+
+def compare(path, results):
+    '''
+    Print how the main results changed since a results file.
+    '''
+    with open(path) as handle:
+        baseline = json.load(handle)
+    for label, keys, better in (
+            ('throughput', ('throughput',), 1),
+            ('p50 latency', ('latency_ms', 'p50'), -1),
+            ('p99 latency', ('latency_ms', 'p99'), -1),
+            ('RSS', ('rss_bytes', 'after'), -1),
+            ('persisted bytes', ('persisted_bytes', 'total'), -1)):
+        old, new = baseline, results
+        for key in keys:
+            old, new = old[key], new[key]
+        change = (new - old) / old if old else 0.0
+        verdict = 'better' if change * better > 0.05 else (
+            'WORSE' if change * better < -0.05 else 'same')
+        print('{:>15}: {} -> {} ({:+.1%}, {})'
+              .format(label, old, new, change, verdict))
+
+
+def bench_rostersync(args):
+    '''
+    Sync a roster from a fake Dropbox with large, paginated folders, then
+    apply changes incrementally and check games in progress follow them.
+    '''
+    from fakes import FakeDropbox
+    from game import Player, Roster
+    from rostersync import RosterSync
+    from storage import SQLiteStorage
+
+    roster = fake_roster(args.size)
+    fake = FakeDropbox({'/game/{}/{}.jpg'.format(gender, name): b''
+                        for gender, names in (('male', roster[::2]),
+                                              ('female', roster[1::2]))
+                        for name in names}, page_size=args.page_size)
+    storage = SQLiteStorage(':memory:')
+    Roster.load = lambda version: storage.load_meta('roster:' + version)
+
+    def switch(sync):
+        calls = fake.calls
+        start = time.perf_counter()
+        new = sync.refresh()
+        elapsed = time.perf_counter() - start
+        storage.save_meta('roster:' + new.version, new.toJSON())
+        sync.save(new)
+        Player.roster = new
+        return new, elapsed, fake.calls - calls
+
+    old = fake.files_list_folder('/game/male').entries
+    print('one list_folder call, as before: {} of {} male entries'
+          .format(len(old), len(roster[::2])))
+    sync = RosterSync(fake, '/game', storage)
+    current, elapsed, calls = switch(sync)
+    ok = set(current.names) == set(roster)
+    print('full sync: {} entries in {:.1f} ms, {} calls -> {}'
+          .format(len(current), elapsed * 1000, calls,
+                  'complete' if ok else 'WRONG'))
+
+    rng = random.Random(0)
+    players = []
+    for _ in range(args.players):
+        player = Player()
+        player.next_pick()
+        for _ in range(rng.randrange(50)):
+            player.answer('pass')
+            player.next_pick()
+        players.append(player)
+    removed = rng.sample(roster, args.changes)
+    added = ['Zz New {}'.format(i) for i in range(args.changes)]
+    for name in removed:
+        gender = 'male' if name in current.guys else 'female'
+        fake.files_delete_v2('/game/{}/{}.jpg'.format(gender, name))
+    for i, name in enumerate(added):
+        fake.files_upload(b'', '/game/{}/{}.jpg'.format(
+            ('male', 'female')[i % 2], name))
+    current, elapsed, calls = switch(sync)
+    expected = (set(roster) - set(removed)) | set(added)
+    ok = ok and set(current.names) == expected
+    print('incremental sync of {} changes: {:.2f} ms, {} calls -> {}'
+          .format(2 * args.changes, elapsed * 1000, calls,
+                  'complete' if set(current.names) == expected
+                  else 'WRONG'))
+
+    start = time.perf_counter()
+    for player in players:
+        player.sync_roster()
+    elapsed = time.perf_counter() - start
+    followed = all(all(name in player.progress for name in added) and
+                   not any(name in player.progress for name in removed)
+                   for player in players)
+    ok = ok and followed
+    print('{} games moved onto the new roster in {:.1f} ms -> {}'
+          .format(len(players), elapsed * 1000,
+                  'added and removed entries followed' if followed
+                  else 'WRONG'))
+
+    fake.files_upload(b'', '/game/male/Zz Restart.jpg')
+    restarted, elapsed, calls = switch(RosterSync(fake, '/game', storage))
+    resumed = 'Zz Restart' in restarted.ids and len(restarted) == len(
+        current) + 1
+    ok = ok and resumed
+    print('after a restart: {:.2f} ms, {} calls -> {}'
+          .format(elapsed * 1000, calls,
+                  'resumed from saved cursors' if resumed else 'WRONG'))
+
+    fake.reset()
+    fake.files_delete_v2('/game/male/Zz Restart.jpg')
+    relisted, elapsed, calls = switch(sync)
+    ok = ok and set(relisted.names) == expected
+    print('after a cursor reset: {:.1f} ms, {} calls -> {}'
+          .format(elapsed * 1000, calls,
+                  'listed again' if set(relisted.names) == expected
+                  else 'WRONG'))
+    return 0 if ok else 1
+
+
+def bench_datasets(args):
+    '''
+    Configure many named rosters, then check only the played ones are
+    listed and that their players share one copy of each roster.
+    '''
+    import tracemalloc
+    from datasets import Dataset, Datasets
+    from fakes import FakeDropbox
+    from game import Player, Roster
+    from storage import SQLiteStorage
+
+    files = {}
+    for index in range(args.rosters):
+        roster = fake_roster(args.size + index)
+        files.update({'/r{}/{}/{}.jpg'.format(index, gender, name): b''
+                      for gender, names in (('male', roster[::2]),
+                                            ('female', roster[1::2]))
+                      for name in names})
+    fake = FakeDropbox(files)
+
+    def fetch(gender, pick):
+        return 'https://example.com/{}/{}'.format(gender, pick)
+
+    ok = True
+    tracemalloc.start()
+    for count in (1, args.rosters):
+        # A fresh start each time: no saved cursors or rosters.
+        storage = SQLiteStorage(':memory:')
+        Roster.load = lambda version: storage.load_meta('roster:' + version)
+        calls = fake.calls
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        datasets = Datasets(Dataset('r0', '/r0', fake, storage, fetch))
+        for index in range(1, count):
+            datasets.add(Dataset('r{}'.format(index), '/r{}'.format(index),
+                                 fake, storage, fetch,
+                                 key='roster:sync:r{}'.format(index)))
+        Player.roster = datasets.default.current()
+        Player.find_roster = datasets.roster
+        elapsed = time.perf_counter() - start
+        used = tracemalloc.get_traced_memory()[0] - before
+        print('startup with {} rosters: {:.1f} ms, {} list calls, '
+              '{:.0f} KiB'.format(count, elapsed * 1000,
+                                  fake.calls - calls, used / 1024))
+    loaded = [dataset.name for dataset in datasets if dataset.loaded()]
+    ok = ok and loaded == ['r0']
+
+    played = ['r0', 'r1'] if args.rosters > 1 else ['r0']
+    rng = random.Random(0)
+    players = []
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for index in range(args.players):
+        name = played[index % len(played)]
+        player = Player(roster=None if name == 'r0' else name)
+        player.next_pick()
+        for _ in range(rng.randrange(20)):
+            player.answer('pass')
+            player.next_pick()
+        players.append(player)
+    elapsed = time.perf_counter() - start
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    loaded = [dataset.name for dataset in datasets if dataset.loaded()]
+    ok = ok and loaded == played
+    print('{} players of {}: {:.1f} ms, {:.0f} KiB, loaded rosters: {}'
+          .format(len(players), ', '.join(played), elapsed * 1000,
+                  used / 1024, ', '.join(loaded)))
+
+    shared = all(
+        player.progress.roster is datasets.of(player).roster and
+        player.pick is player.progress.roster.names[
+            player.progress.roster.ids[player.pick]]
+        for player in players)
+    ok = ok and shared
+    rosters = len({id(player.progress.roster) for player in players})
+    print('{} roster objects for {} players -> {}'
+          .format(rosters, len(players),
+                  'shared' if shared else 'NOT SHARED'))
+    Player.find_roster = None
+    return 0 if ok else 1
+
+
+def cache_run(count, size, requests, roster_size, path):
+    '''
+    Start a bot's registry from count saved players and serve requests,
+    keeping at most size players in memory (all if None). Run in a fresh
+    process; return (RSS growth in bytes, seconds, registry stats).
+    '''
+    from game import Player, Roster
+    from persistence import WriteBehind
+    from registry import PlayerRegistry
+    from storage import SQLiteStorage
+
+    roster = fake_roster(roster_size)
+    Player.roster = Roster(roster[::2], roster[1::2])
+    storage = SQLiteStorage(path)
+    writer = WriteBehind(storage)
+
+    def load(player_id):
+        record = storage.load_one(player_id)
+        return Player.fromJSON(record) if record is not None else None
+
+    before = rss()
+    start = time.perf_counter()
+    players = PlayerRegistry(load=load, size=size,
+                             clean=lambda player_id:
+                             not writer.pending(player_id))
+    writer.add_hook(lambda seconds, saved: players.evict())
+    records = storage.load()
+    for player_id in records:
+        players.update({player_id: Player.fromJSON(records[player_id])})
+    del records
+    # Most messages come from a few recently active chats.
+    rng = random.Random(1)
+    active = ['U{:032x}'.format(rng.randrange(count))
+              for _ in range(max(1, count // 20))]
+    for index in range(requests):
+        if rng.random() < 0.9:
+            player_id = rng.choice(active)
+        else:
+            player_id = 'U{:032x}'.format(rng.randrange(count))
+        with players.locked(player_id):
+            player = players[player_id]
+            if player.finished():
+                player = players[player_id] = Player()
+            player.next_pick()
+            player.answer('pass')
+            writer.mark(player_id, player.toJSON())
+        if index % 50 == 49:
+            writer.flush()
+    writer.flush()
+    grown, elapsed = rss() - before, time.perf_counter() - start
+    storage.conn.close()
+    return grown, elapsed, players.stats()
+
+
+def bench_cache(args):
+    '''
+    Memory of a bot's players against the number of saved players, with
+    and without a bounded player cache.
+    '''
+    import multiprocessing
+    import shutil
+    from game import Roster
+    from storage import SQLiteStorage
+
+    roster = fake_roster(args.roster)
+    rng = random.Random(0)
+    context = multiprocessing.get_context('spawn')
+    for count in args.players:
+        with tempfile.TemporaryDirectory() as directory:
+            storage = SQLiteStorage(os.path.join(directory, 'players.db'))
+            storage.save_meta('roster', Roster(roster[::2],
+                                               roster[1::2]).toJSON())
+            for first in range(0, count, 1000):
+                storage.save({'U{:032x}'.format(index):
+                              fake_record(roster, rng)
+                              for index in range(first,
+                                                 min(count, first + 1000))})
+            storage.conn.close()
+            for size in (None, args.size):
+                # Each run starts from the same saved players.
+                path = os.path.join(directory, 'run.db')
+                shutil.copy(os.path.join(directory, 'players.db'), path)
+                with context.Pool(1) as pool:
+                    grown, elapsed, stats = pool.apply(
+                        cache_run, (count, size, args.requests, args.roster,
+                                    path))
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                print('{:>7} saved players, cache {:>9}: RSS +{:6.1f} MiB, '
+                      '{:.1f} s, {} in memory, hit rate {:.2%}, {} evictions'
+                      .format(count, size or 'unbounded', grown / 2 ** 20,
+                              elapsed, stats['players'], stats['hit_rate'],
+                              stats['evictions']))
+    return 0
+
+
+def bench_tickets(args):
+    '''
+    Cost of adding /msg messages: the old list, joined and rewritten as a
+    whole on every add, against the indexed store saving each one.
+    '''
+    from storage import SQLiteStorage
+    from tickets import TicketStore
+
+    rng = random.Random(0)
+    texts = [' '.join(rng.choice(string.ascii_lowercase) * rng.randint(1, 9)
+                      for _ in range(20)) for _ in range(args.messages)]
+
+    tickets, written = [], 0
+    start = time.perf_counter()
+    for text in texts:
+        if text in tickets:
+            continue
+        len('num. \n'.join(tickets + [text]))
+        tickets.append(text)
+        written += len(json.dumps(tickets, indent=4).encode('utf-8'))
+    elapsed = time.perf_counter() - start
+    print('list:  {:.1f} us per add, {:.0f} bytes written per add'
+          .format(elapsed / len(texts) * 1e6, written / len(texts)))
+
+    storage = SQLiteStorage(':memory:')
+    store = TicketStore(storage)
+    start = time.perf_counter()
+    for text in texts:
+        if store.add(text) is not None:
+            store.flush()
+    elapsed = time.perf_counter() - start
+    print('store: {:.1f} us per add, {:.0f} bytes written per add'
+          .format(elapsed / len(texts) * 1e6, storage.written / len(texts)))
+    store.load()
+    ok = len(store) == len(set(texts)) == len(tickets)
+    pages = store.page(1)[1]
+    print('{} messages over {} /tix pages -> {}'.format(
+        len(store), pages, 'match' if ok else 'MISMATCH'))
+    return 0 if ok else 1
+
+
+def bench_ratelimit(args):
+    '''
+    One group hammering /restart while other groups play: how much of the
+    flood the rate limiter stops, whether players get through, and the
+    limiter's cost and memory over many distinct chats.
+    '''
+    import tracemalloc
+    from ratelimit import RateLimiter
+
+    now = [0.0]
+    limiter = RateLimiter({'user': (1, 20), 'group': (3, 60)},
+                          size=args.size, clock=lambda: now[0])
+    costs = {'restart': 5, 'answer': 1}
+    rng = random.Random(0)
+    sent = {'abuser': 0, 'players': 0}
+    passed = {'abuser': 0, 'players': 0}
+    replies = 0
+    # args.seconds of traffic in steps of 10 ms: the abusive group sends
+    # args.flood commands a second from 5 members, the other groups an
+    # answer every few seconds from each of 5 members.
+    for step in range(int(args.seconds * 100)):
+        now[0] = step / 100
+        for _ in range(rng.randrange(2 * args.flood // 100 + 1)):
+            user = 'Uabuser{}'.format(rng.randrange(5))
+            sent['abuser'] += 1
+            result = limiter.check([('user', user), ('group', 'Cabuse')],
+                                   costs['restart'], 'restart')
+            if result is None:
+                passed['abuser'] += 1
+            elif result[1]:
+                replies += 1
+        for group in range(args.groups):
+            if rng.random() < 5 / 300:
+                user = 'U{}-{}'.format(group, rng.randrange(5))
+                sent['players'] += 1
+                if limiter.check([('user', user), ('group', 'C{}'
+                                                   .format(group))],
+                                 costs['answer'], 'answer') is None:
+                    passed['players'] += 1
+    ok = passed['players'] == sent['players']
+    print('flooding group: {} of {} /restart let through ({:.1%}), '
+          '{} throttled replies'.format(passed['abuser'], sent['abuser'],
+                                        passed['abuser'] / sent['abuser'],
+                                        replies))
+    print('{} other groups: {} of {} answers let through -> {}'.format(
+        args.groups, passed['players'], sent['players'],
+        'unaffected' if ok else 'THROTTLED'))
+
+    keys = [[('user', 'U{:032x}'.format(index)),
+             ('group', 'C{:032x}'.format(index % 1000))]
+            for index in range(args.chats)]
+    limiter = RateLimiter({'user': (1, 20), 'group': (3, 60)},
+                          size=args.size)
+    start = time.perf_counter()
+    for each in keys:
+        limiter.check(each)
+    elapsed = time.perf_counter() - start
+    limiter = RateLimiter({'user': (1, 20), 'group': (3, 60)},
+                          size=args.size)
+    tracemalloc.start()
+    for each in keys:
+        limiter.check(each)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    bounded = len(limiter.buckets) <= args.size
+    ok = ok and bounded
+    print('{} distinct users: {:.1f} us per check, {} buckets kept, '
+          '{:.1f} MiB -> {}'.format(args.chats, elapsed / args.chats * 1e6,
+                                    len(limiter.buckets), used / 2 ** 20,
+                                    'bounded' if bounded else 'UNBOUNDED'))
+    return 0 if ok else 1
+
+
+def main(argv=None):
+    '''
+    Parse arguments and run the selected benchmark.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    sub = parser.add_subparsers(dest='benchmark')
+    sub.required = True
+
+    save = sub.add_parser('save', help='save latency against player count')
+    save.add_argument('--players', type=int, nargs='+',
+                      default=[1000, 10000, 100000])
+    save.add_argument('--repeat', type=int, default=200)
+    save.set_defaults(func=bench_save)
+
+    links = sub.add_parser('links', help='question image link latency')
+    links.add_argument('--players', type=int, default=20)
+    links.add_argument('--questions', type=int, default=30)
+    links.add_argument('--roster', type=int, default=400)
+    links.add_argument('--latency', type=float, default=0.05,
+                       help='fake Dropbox response time in seconds')
+    links.add_argument('--think', type=float, default=0.1,
+                       help='seconds between questions')
+    links.set_defaults(func=bench_links)
+
+    stress = sub.add_parser('stress', help='concurrent answers for one group')
+    stress.add_argument('--answers', type=int, default=2000)
+    stress.add_argument('--threads', type=int, default=32)
+    stress.add_argument('--workers', type=int, default=8,
+                        help='WEBHOOK_WORKERS; 0 handles webhooks inline')
+    stress.set_defaults(func=bench_stress)
+
+    load = sub.add_parser('loadtest', help='webhook throughput per worker '
+                                           'count under gunicorn')
+    load.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    load.add_argument('--threads', type=int, default=8)
+    load.add_argument('--requests', type=int, default=2000)
+    load.add_argument('--chats', type=int, default=200)
+    load.add_argument('--concurrency', type=int, default=16)
+    load.add_argument('--roster', type=int, default=400)
+    load.add_argument('--port', type=int, default=8765)
+    load.set_defaults(func=bench_loadtest)
+
+    boot = sub.add_parser('startup', help='time from process start to '
+                                          'first webhook reply')
+    boot.add_argument('--players', type=int, default=10000)
+    boot.add_argument('--roster', type=int, default=400)
+    boot.add_argument('--port', type=int, default=8766)
+    boot.add_argument('--timeout', type=float, default=60)
+    boot.set_defaults(func=bench_startup)
+
+    progress = sub.add_parser(
+        'progress', help='progress memory and save size per player')
+    progress.add_argument('--players', type=int, default=2000)
+    progress.add_argument('--roster', type=int, default=400)
+    progress.set_defaults(func=bench_progress)
+
+    match = sub.add_parser('match', help='answer matcher speed')
+    match.add_argument('--roster', type=int, default=400)
+    match.add_argument('--answers', type=int, default=50000)
+    match.set_defaults(func=bench_match)
+
+    lead = sub.add_parser('lead', help='Leaderboards read and update cost')
+    lead.add_argument('--players', type=int, default=20000)
+    lead.add_argument('--updates', type=int, default=1000)
+    lead.add_argument('--reads', type=int, default=20)
+    lead.set_defaults(func=bench_lead)
+
+    savelog = sub.add_parser('savelog', help='bytes per answer and load '
+                                             'time of the save log')
+    savelog.add_argument('--players', type=int, default=5000)
+    savelog.add_argument('--roster', type=int, default=400)
+    savelog.add_argument('--answers', type=int, default=5000)
+    savelog.add_argument('--compact-size', type=int, default=1 << 20)
+    savelog.set_defaults(func=bench_savelog)
+
+    log = sub.add_parser('events', help='event log replay and difficulty '
+                                        'report speed')
+    log.add_argument('--roster', type=int, default=400)
+    log.add_argument('--chats', type=int, default=200)
+    log.add_argument('--replay', type=int, default=20000)
+    log.add_argument('--events', type=int, default=1000000)
+    log.set_defaults(func=bench_events)
+
+    schedule = sub.add_parser('schedule', help='question scheduler '
+                                               'simulation')
+    schedule.add_argument('--players', type=int, default=10000)
+    schedule.add_argument('--roster', type=int, default=100)
+    schedule.add_argument('--questions', type=int, default=60)
+    schedule.set_defaults(func=bench_schedule)
+
+    messages = sub.add_parser('messages', help='LINE replies against a '
+                                               'failing fake API')
+    messages.add_argument('--count', type=int, default=1000)
+    messages.add_argument('--concurrency', type=int, default=16)
+    messages.add_argument('--latency', type=float, default=0.005)
+    messages.add_argument('--fail-rate', type=float, default=0.1)
+    messages.add_argument('--expired', type=float, default=0.05)
+    messages.add_argument('--server-limit', type=int, default=None,
+                          help='requests per second the fake API allows')
+    messages.add_argument('--rate', type=float, default=500,
+                          help='client-side requests per second')
+    messages.add_argument('--retries', type=int, default=3)
+    messages.set_defaults(func=bench_messages)
+
+    dispatch = sub.add_parser('dispatch', help='command dispatch cost per '
+                              'message')
+    dispatch.add_argument('--repeat', type=int, default=2000)
+    dispatch.set_defaults(func=bench_dispatch)
+
+    offline = sub.add_parser('offline', help='replay a workload through '
+                             'the bot with fake LINE and Dropbox APIs')
+    offline.add_argument('--requests', type=int, default=5000)
+    offline.add_argument('--chats', type=int, default=200)
+    offline.add_argument('--concurrency', type=int, default=8)
+    offline.add_argument('--workers', type=int, default=0,
+                         help='WEBHOOK_WORKERS')
+    offline.add_argument('--storage', choices=('sqlite', 'log', 'dropbox'),
+                         default='sqlite')
+    offline.add_argument('--roster', type=int, default=400)
+    offline.add_argument('--latency', type=float, default=0.0,
+                         help='seconds each fake API call takes')
+    offline.add_argument('--line-rate', type=float, default=100000,
+                         help='LINE_RATE; the default of 100 per second '
+                              'would cap throughput')
+    offline.add_argument('--output', default='benchmark-offline.json')
+    offline.add_argument('--baseline',
+                         help='earlier results file to compare with')
+    offline.set_defaults(func=bench_offline)
+
+    rostersync = sub.add_parser('rostersync', help='roster sync from large '
+                                'paginated folders')
+    rostersync.add_argument('--size', type=int, default=12000)
+    rostersync.add_argument('--page-size', type=int, default=1000)
+    rostersync.add_argument('--changes', type=int, default=10)
+    rostersync.add_argument('--players', type=int, default=200)
+    rostersync.set_defaults(func=bench_rostersync)
+
+    rosters = sub.add_parser('datasets', help='lazy loading and shared '
+                             'memory of named rosters')
+    rosters.add_argument('--rosters', type=int, default=8)
+    rosters.add_argument('--size', type=int, default=2000)
+    rosters.add_argument('--players', type=int, default=500)
+    rosters.set_defaults(func=bench_datasets)
+
+    cache = sub.add_parser('cache', help='memory against saved players '
+                           'with a bounded player cache')
+    cache.add_argument('--players', type=int, nargs='+',
+                       default=[1000, 10000, 50000])
+    cache.add_argument('--size', type=int, default=1000)
+    cache.add_argument('--requests', type=int, default=5000)
+    cache.add_argument('--roster', type=int, default=400)
+    cache.set_defaults(func=bench_cache)
+
+    tix = sub.add_parser('tickets', help='/msg add cost and bytes written')
+    tix.add_argument('--messages', type=int, default=5000)
+    tix.set_defaults(func=bench_tickets)
+
+    limits = sub.add_parser('ratelimit', help='rate limiting of a flooding '
+                            'group and its cost')
+    limits.add_argument('--seconds', type=float, default=60)
+    limits.add_argument('--flood', type=int, default=50,
+                        help='commands a second from the flooding group')
+    limits.add_argument('--groups', type=int, default=100)
+    limits.add_argument('--chats', type=int, default=200000)
+    limits.add_argument('--size', type=int, default=10000)
+    limits.set_defaults(func=bench_ratelimit)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
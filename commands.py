@@ -0,0 +1,161 @@
+'''
+Chat command registry and dispatch
+'''
+
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# What a command does with the text after its name: nothing may follow it,
+# anything that follows is passed on, or something must follow it.
+NO_ARGUMENT, OPTIONAL, REQUIRED = 'none', 'optional', 'required'
+
+
+class Command:
+    '''
+    A chat command: its handler, how its argument is parsed, who can use
+    it and how many rate limit tokens it costs.
+
+    The handler is called as func(context, argument), where argument is
+    the text after the command name, stripped and passed through parse if
+    given. parse may raise ValueError to reject an argument, in which case
+    the message isn't taken as this command.
+    '''
+
+    def __init__(self, name, func, argument=OPTIONAL, parse=None,
+                 admin=False, cost=1):
+        self.name = name
+        self.func = func
+        self.argument = argument
+        self.parse = parse
+        self.admin = admin
+        self.cost = cost
+
+    def accepts(self, argument, admin):
+        '''
+        Check if a message with this argument can run the command.
+        '''
+        if self.admin and not admin:
+            return False
+        if self.argument == NO_ARGUMENT:
+            return not argument
+        if self.argument == REQUIRED:
+            return bool(argument)
+        return True
+
+
+class Router:
+    '''
+    Table of chat commands, filled once at import by the command decorator.
+
+    A message is a command if it starts with '/'. Its first word is looked
+    up among exact names and aliases, then among prefix names: a prefix
+    name also matches any word that starts with it, e.g. /starting for
+    /start. A lookup takes one dictionary access per letter of the word at
+    most. Messages starting with '/' that match no command, including
+    admin commands sent by someone else, go to the fallback command with
+    the whole lowercased message after the slash.
+
+    Hooks are called as hook(name, seconds) after every command, e.g. to
+    record how long each command takes.
+    '''
+
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+        self.longest = 0
+        self.fallback = None
+        self.hooks = []
+
+    def command(self, name, aliases=(), prefix=False, argument=OPTIONAL,
+                parse=None, admin=False, cost=1):
+        '''
+        Decorator registering a function as a command. Aliases always
+        match exactly; the name matches as a prefix if prefix is set.
+        '''
+        def register(func):
+            command = Command(name, func, argument, parse, admin, cost)
+            table = self.prefixes if prefix else self.exact
+            for each in (name,) + tuple(aliases):
+                if each in self.exact or each in self.prefixes:
+                    raise ValueError("Command {} is already registered"
+                                     .format(each))
+                (table if each == name else self.exact)[each] = command
+            if prefix:
+                self.longest = max(self.longest, len(name))
+            return func
+        return register
+
+    def default(self, name, parse=None, cost=1):
+        '''
+        Decorator registering a function as the fallback command.
+        '''
+        def register(func):
+            self.fallback = Command(name, func, parse=parse, cost=cost)
+            return func
+        return register
+
+    def add_hook(self, hook):
+        '''
+        Call hook(name, seconds) after every command.
+        '''
+        self.hooks.append(hook)
+
+    def lookup(self, word, argument, admin=False):
+        '''
+        Return the command a word names that accepts the argument, or None.
+        '''
+        command = self.exact.get(word)
+        if command is not None and command.accepts(argument, admin):
+            return command
+        for length in range(min(len(word), self.longest), 0, -1):
+            command = self.prefixes.get(word[:length])
+            if command is not None and command.accepts(argument, admin):
+                return command
+        return None
+
+    def resolve(self, text, admin=False):
+        '''
+        Return the (command, parsed argument) of a message, or (None, None)
+        if it isn't a command.
+        '''
+        if not text.startswith('/'):
+            return None, None
+        words = text[1:].split(maxsplit=1)
+        word = words[0].lower() if words else ''
+        argument = words[1].strip() if len(words) > 1 else ''
+        command = self.lookup(word, argument, admin)
+        if command is not None and command.parse is not None:
+            try:
+                argument = command.parse(argument)
+            except ValueError:
+                command = None
+        if command is None:
+            command = self.fallback
+            if command is None or not text[1:].strip():
+                return None, None
+            argument = text[1:].lower().strip()
+            if command.parse is not None:
+                argument = command.parse(argument)
+        return command, argument
+
+    def dispatch(self, context, text, admin=False):
+        '''
+        Run the command of a message. Return the command, or None if the
+        message isn't one.
+        '''
+        command, argument = self.resolve(text, admin)
+        if command is None:
+            return None
+        start = time.perf_counter()
+        try:
+            command.func(context, argument)
+        finally:
+            elapsed = time.perf_counter() - start
+            for hook in self.hooks:
+                try:
+                    hook(command.name, elapsed)
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception("Command hook failed")
+        return command
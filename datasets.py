@@ -0,0 +1,186 @@
+'''
+Named rosters, e.g. one per cohort or year, played from one deployment
+'''
+
+import logging
+import threading
+
+from leaderboard import Leaderboards
+from linkcache import LinkCache
+from rostersync import RosterSync
+
+LOGGER = logging.getLogger(__name__)
+
+
+def parse_rosters(text):
+    '''
+    Return [(name, game data path)] from 'name=path,name=path'.
+    '''
+    rosters = []
+    for item in (text or '').split(','):
+        if not item.strip():
+            continue
+        name, path = item.split('=', 1)
+        rosters.append((name.strip().lower(), path.strip().rstrip('/')))
+    return rosters
+
+
+class Scores:
+    '''
+    The high score and period scores a player stashed for a dataset they
+    aren't playing, shaped like a Player for Leaderboards.update().
+    '''
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+
+class Dataset:
+    '''
+    One roster's game data folder with its own image-link cache and
+    Leaderboards.
+
+    The roster is only listed the first time a player of the dataset needs
+    it; until then a dataset costs an empty cache and empty boards. Every
+    player of a dataset shares its Roster object, names and matcher.
+    '''
+
+    def __init__(self, name, path, dbx, storage, fetch, key=RosterSync.key):
+        self.name = name
+        self.path = path
+        self.storage = storage
+        self.sync = RosterSync(dbx, path, storage, key=key)
+        self.links = LinkCache(fetch)
+        self.leaderboards = Leaderboards(size=10)
+        self.roster = None
+        self.lock = threading.Lock()
+
+    def loaded(self):
+        '''
+        Check if the roster has been loaded.
+        '''
+        return self.roster is not None
+
+    def current(self):
+        '''
+        Return the current roster, loading it first if needed.
+        '''
+        roster = self.roster
+        if roster is None:
+            with self.lock:
+                if self.roster is None:
+                    self.refresh()
+                roster = self.roster
+        return roster
+
+    def refresh(self):
+        '''
+        Fetch the changes to the game data folders. Return True if the
+        roster changed.
+        '''
+        roster = self.sync.refresh()
+        if self.roster is not None and roster.version == self.roster.version:
+            self.sync.save(roster)
+            return False
+        # Keep a copy, so progress saved against it can be read after it
+        # changes.
+        if self.storage.load_meta('roster:' + roster.version) is None:
+            self.storage.save_meta('roster:' + roster.version,
+                                   roster.toJSON())
+        self.sync.save(roster)
+        self.roster = roster
+        LOGGER.info("Roster %s: %d persons", self.name, len(roster))
+        return True
+
+
+class Datasets:
+    '''
+    Every dataset by name. The default one holds players without
+    data['roster'].
+    '''
+
+    def __init__(self, default):
+        self.default = default
+        self.datasets = {default.name: default}
+
+    def add(self, dataset):
+        '''
+        Add a dataset and return it.
+        '''
+        if dataset.name in self.datasets:
+            raise ValueError("Roster {} is configured twice"
+                             .format(dataset.name))
+        self.datasets[dataset.name] = dataset
+        return dataset
+
+    def __contains__(self, name):
+        return name in self.datasets
+
+    def __iter__(self):
+        return iter(self.datasets.values())
+
+    def names(self):
+        '''
+        Return the dataset names, default first.
+        '''
+        return list(self.datasets)
+
+    def get(self, name):
+        '''
+        Return the dataset of a name, or the default one for None.
+        '''
+        if name is None:
+            return self.default
+        return self.datasets.get(name)
+
+    def of(self, player):
+        '''
+        Return the dataset a player is playing.
+        '''
+        return self.get(player.data.get('roster')) or self.default
+
+    def roster(self, name):
+        '''
+        Return the current roster of a dataset, or None if there is no such
+        dataset. Use as Player.find_roster.
+        '''
+        dataset = self.datasets.get(name)
+        return dataset.current() if dataset is not None else None
+
+    def switch(self, player, name):
+        '''
+        Stash the player's scores for their current dataset and return
+        (high score, period scores) stashed for the named one.
+        '''
+        current = self.of(player)
+        stash = player.data.setdefault('rosters', {})
+        stash[current.name] = {'high_score': player.data['high_score'],
+                               'periods': dict(player.data.get('periods',
+                                                               {}))}
+        scores = stash.pop(name, {})
+        if not stash:
+            del player.data['rosters']
+        return scores.get('high_score', 0), scores.get('periods')
+
+    def rebuild(self, players):
+        '''
+        Rebuild every dataset's Leaderboards from (chat ID, player) pairs,
+        with the scores players stashed for datasets they left.
+        '''
+        for dataset in self:
+            dataset.leaderboards.clear()
+        self.update(players)
+
+    def update(self, players):
+        '''
+        Report the scores of (chat ID, player) pairs, e.g. players that
+        changed, to their datasets' Leaderboards.
+        '''
+        for chat, player in players:
+            self.of(player).leaderboards.update(chat, player)
+            for name, data in player.data.get('rosters', {}).items():
+                dataset = self.datasets.get(name)
+                if dataset is not None:
+                    dataset.leaderboards.update(chat,
+                                                Scores(player.name, data))
@@ -0,0 +1,137 @@
+'''
+Dropping webhook events that LINE delivers more than once
+'''
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def event_key(event):
+    '''
+    Return the key identifying a webhook event across deliveries: its
+    webhook event ID, or its reply token for events without one.
+    '''
+    return (getattr(event, 'webhook_event_id', None) or
+            getattr(event, 'reply_token', None))
+
+
+class SQLiteSeen:
+    '''
+    Event keys kept in a SQLite table, so every process sharing the
+    database sees each event once.
+    '''
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS webhook_events '
+                          '(key TEXT PRIMARY KEY, seen REAL NOT NULL)')
+        self.conn.commit()
+
+    def add(self, key, now, expired):
+        '''
+        Record a key seen at now. Return False if it was already recorded
+        after expired.
+        '''
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM webhook_events '
+                              'WHERE key = ? AND seen <= ?', (key, expired))
+            cursor = self.conn.execute('INSERT OR IGNORE INTO webhook_events '
+                                       '(key, seen) VALUES (?, ?)',
+                                       (key, now))
+            return cursor.rowcount == 1
+
+    def remove(self, key):
+        '''
+        Forget a key.
+        '''
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM webhook_events WHERE key = ?',
+                              (key,))
+
+    def purge(self, expired):
+        '''
+        Forget every key recorded at or before expired.
+        '''
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM webhook_events WHERE seen <= ?',
+                              (expired,))
+
+
+class Deduplicator:
+    '''
+    Remembers the keys of recent webhook events for ttl seconds.
+
+    At most `size` keys are kept in memory, oldest dropped first. With a
+    store (e.g. SQLiteSeen), keys not in memory are checked against it
+    too, so duplicates are caught across restarts and processes.
+    '''
+
+    def __init__(self, ttl=600.0, size=10000, store=None, clock=time.time,
+                 purge_every=1000):
+        self.ttl = ttl
+        self.size = size
+        self.store = store
+        self.clock = clock
+        self.purge_every = purge_every
+        self.keys = OrderedDict()
+        self.checked = 0
+        self.duplicates = 0
+        self.lock = threading.Lock()
+
+    def seen(self, key):
+        '''
+        Check if a key was seen in the last ttl seconds, and remember it.
+        Events without a key are never duplicates.
+        '''
+        if key is None:
+            return False
+        now = self.clock()
+        expired = now - self.ttl
+        with self.lock:
+            self.checked += 1
+            # Keys are in the order they were first seen, so expired ones
+            # are at the front.
+            while self.keys and next(iter(self.keys.values())) <= expired:
+                self.keys.popitem(last=False)
+            duplicate = key in self.keys
+            if not duplicate:
+                self.keys[key] = now
+                if len(self.keys) > self.size:
+                    self.keys.popitem(last=False)
+            purge = self.checked % self.purge_every == 0
+        if not duplicate and self.store is not None:
+            duplicate = not self.store.add(key, now, expired)
+            if purge:
+                self.store.purge(expired)
+        if duplicate:
+            with self.lock:
+                self.duplicates += 1
+        return duplicate
+
+    def forget(self, key):
+        '''
+        Forget a key, e.g. when handling its event failed and LINE should
+        be able to redeliver it.
+        '''
+        if key is None:
+            return
+        with self.lock:
+            self.keys.pop(key, None)
+        if self.store is not None:
+            self.store.remove(key)
+
+    def stats(self):
+        '''
+        Return how many events were checked and how many were duplicates.
+        '''
+        with self.lock:
+            return {'checked': self.checked, 'duplicates': self.duplicates,
+                    'hit_rate': (round(self.duplicates / self.checked, 4)
+                                 if self.checked else 0.0),
+                    'remembered': len(self.keys)}
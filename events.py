@@ -0,0 +1,326 @@
+'''
+Append-only log of game events with replay and analytics
+'''
+
+import glob
+import heapq
+import json
+import logging
+import math
+import os
+import struct
+import threading
+import time
+from array import array
+
+from game import Player, Roster
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LOGGER = logging.getLogger(__name__)
+
+# Event kinds: answer verdicts first, then game starts and ends.
+KINDS = ('exact', 'correct', 'partial', 'wrong', 'skipped', 'vague',
+         'start', 'end')
+ANSWERED = frozenset(range(KINDS.index('vague')))
+MISSED = frozenset((KINDS.index('wrong'), KINDS.index('skipped')))
+NONE = 0xFFFFFFFF
+
+# One event: time, chat, roster version, roster entry, kind, seconds taken
+# and answer. Strings are stored as indices into the segment's strings.
+COLUMNS = ('time', 'chat', 'roster', 'entry', 'kind', 'elapsed', 'answer')
+RECORD = struct.Struct('<dIIIBfI')
+TYPECODES = ('d', 'I', 'I', 'I', 'B', 'f', 'I')
+if numpy is not None:
+    DTYPE = numpy.dtype([('time', '<f8'), ('chat', '<u4'),
+                         ('roster', '<u4'), ('entry', '<u4'),
+                         ('kind', 'u1'), ('elapsed', '<f4'),
+                         ('answer', '<u4')])
+
+
+class EventLog:
+    '''
+    Game events appended to fixed-size binary records.
+
+    Each process writes its own segment in directory: <name>.events holds
+    the records and <name>.strings holds the chat IDs, roster versions and
+    answers they refer to, one JSON string per line. Strings are always
+    written before the records using them. Events are buffered in memory
+    until flush() is called, e.g. by the write-behind worker.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        name = '{:013d}-{}'.format(int(time.time() * 1000), os.getpid())
+        self.path = os.path.join(directory, name + '.events')
+        self.strings_path = os.path.join(directory, name + '.strings')
+        self.strings = {}
+        self.new_strings = []
+        self.pending = []
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def intern(self, text):
+        '''
+        Return the index of a string. Call with the lock held.
+        '''
+        try:
+            return self.strings[text]
+        except KeyError:
+            index = self.strings[text] = len(self.strings)
+            self.new_strings.append(text)
+            return index
+
+    def record(self, chat, kind, pick=None, answer=None, elapsed=None,
+               when=None, roster=None):
+        '''
+        Buffer an event. pick is a name in roster, the current default
+        roster if not given.
+        '''
+        if roster is None:
+            roster = Player.roster
+        entry = roster.ids.get(pick, NONE)
+        with self.lock:
+            self.pending.append(RECORD.pack(
+                time.time() if when is None else when,
+                self.intern(chat), self.intern(roster.version), entry,
+                KINDS.index(kind),
+                math.nan if elapsed is None else elapsed,
+                NONE if answer is None else self.intern(answer)))
+
+    def answered(self, chat, player):
+        '''
+        Buffer the event of a player's last answer.
+        '''
+        if player.outcome is not None:
+            verdict, pick, answer, elapsed = player.outcome
+            player.outcome = None
+            # The answer was judged on the roster of the player's progress.
+            self.record(chat, verdict, pick, answer, elapsed,
+                        roster=player.progress.roster)
+
+    def flush(self):
+        '''
+        Append the buffered events to the segment.
+        '''
+        with self.lock:
+            strings, self.new_strings = self.new_strings, []
+            pending, self.pending = self.pending, []
+            if strings:
+                with open(self.strings_path, 'a', encoding='utf-8') as out:
+                    out.write(''.join(json.dumps(text) + '\n'
+                                      for text in strings))
+            if pending:
+                with open(self.path, 'ab') as out:
+                    out.write(b''.join(pending))
+
+
+def segments(directory):
+    '''
+    Return the event files of a log directory, oldest first.
+    '''
+    return sorted(glob.glob(os.path.join(directory, '*.events')))
+
+
+def read_segment(path, chunk=1 << 16):
+    '''
+    Yield (strings, columns) batches of at most chunk events of a segment.
+
+    columns maps each of COLUMNS to a NumPy array if NumPy is installed,
+    or to an array.array otherwise. A partly written last event is
+    ignored.
+    '''
+    with open(path[:-len('.events')] + '.strings',
+              encoding='utf-8') as handle:
+        strings = [json.loads(line) for line in handle]
+    with open(path, 'rb') as handle:
+        while True:
+            data = handle.read(chunk * RECORD.size)
+            data = data[:len(data) - len(data) % RECORD.size]
+            if not data:
+                break
+            if numpy is not None:
+                records = numpy.frombuffer(data, dtype=DTYPE)
+                columns = {name: records[name] for name in COLUMNS}
+            else:
+                rows = zip(*RECORD.iter_unpack(data))
+                columns = {name: array(typecode, column)
+                           for name, typecode, column
+                           in zip(COLUMNS, TYPECODES, rows)}
+            yield strings, columns
+
+
+def read(directory, chunk=1 << 16):
+    '''
+    Yield (strings, columns) batches of every segment, oldest first.
+    '''
+    for path in segments(directory):
+        yield from read_segment(path, chunk)
+
+
+def segment_events(path):
+    '''
+    Yield the events of a segment as (time, chat, roster version, entry,
+    kind, seconds taken, answer) tuples with strings resolved.
+    '''
+    for strings, columns in read_segment(path):
+        for row in zip(*(columns[name].tolist() for name in COLUMNS)):
+            when, chat, roster, entry, kind, elapsed, answer = row
+            yield (when, strings[chat], strings[roster], entry, KINDS[kind],
+                   None if math.isnan(elapsed) else elapsed,
+                   None if answer == NONE else strings[answer])
+
+
+def events(directory):
+    '''
+    Yield every event of a log in time order, merging the segments of
+    processes that ran at the same time.
+    '''
+    return heapq.merge(*(segment_events(path)
+                         for path in segments(directory)),
+                       key=lambda event: event[0])
+
+
+def replay(directory):
+    '''
+    Rebuild every chat's game from the event log. Return {chat: Player}.
+
+    Names and settings aren't events, so players keep the defaults, and
+    a game that started before the log did is replayed from a new game.
+    Start events of games with another dataset's roster name it as their
+    answer.
+    '''
+    players = {}
+    for when, chat, version, entry, kind, _, answer in events(directory):
+        player = players.get(chat)
+        if kind == 'start' or player is None:
+            high_score = player.data['high_score'] if player else 0
+            player = players[chat] = Player(
+                roster=answer if kind == 'start' else None)
+            player.data['high_score'] = high_score
+            if kind == 'start':
+                continue
+        roster = Roster.find(version)
+        if kind == 'end':
+            player.end()
+        elif kind != 'vague' and roster is not None and entry != NONE:
+            player.pick = roster.names[entry]
+            player.sync_roster()
+            if player.pick in player.progress:
+                player.count(kind, when)
+                player.data['count'] = 0
+    return players
+
+
+class Difficulty:
+    '''
+    How often each roster entry is answered, missed, and how long answers
+    take, accumulated from event batches.
+
+    Counting is vectorized with NumPy if it is installed. Entries are
+    counted per roster version and merged by name at the end.
+    '''
+
+    def __init__(self):
+        # {roster version: [asked, missed, seconds, timed] per entry}
+        self.totals = {}
+
+    def add(self, strings, columns):
+        '''
+        Count a batch of events from read().
+        '''
+        if numpy is None:
+            self.add_slow(strings, columns)
+            return
+        kind = columns['kind']
+        entry = columns['entry']
+        # Answers to names missing from their roster have no entry.
+        answered = (kind < KINDS.index('vague')) & (entry != NONE)
+        missed = (kind == KINDS.index('wrong')) | (
+            kind == KINDS.index('skipped'))
+        elapsed = columns['elapsed'].astype(numpy.float64)
+        timed = answered & ~numpy.isnan(elapsed)
+        for roster in numpy.unique(columns['roster'][answered]):
+            mask = answered & (columns['roster'] == roster)
+            size = int(entry[mask].max()) + 1
+            counts = (
+                numpy.bincount(entry[mask], minlength=size),
+                numpy.bincount(entry[mask & missed], minlength=size),
+                numpy.bincount(entry[mask & timed],
+                               weights=elapsed[mask & timed],
+                               minlength=size),
+                numpy.bincount(entry[mask & timed], minlength=size))
+            totals = self.totals.setdefault(strings[roster], [
+                numpy.zeros(0) for _ in counts])
+            for i, count in enumerate(counts):
+                if len(totals[i]) < size:
+                    totals[i] = numpy.pad(totals[i],
+                                          (0, size - len(totals[i])))
+                totals[i][:size] += count
+
+    def add_slow(self, strings, columns):
+        '''
+        Count a batch of events without NumPy.
+        '''
+        for roster, entry, kind, elapsed in zip(
+                columns['roster'], columns['entry'], columns['kind'],
+                columns['elapsed']):
+            if kind not in ANSWERED or entry == NONE:
+                continue
+            totals = self.totals.setdefault(strings[roster],
+                                            [[], [], [], []])
+            if len(totals[0]) <= entry:
+                for each in totals:
+                    each.extend([0] * (entry + 1 - len(each)))
+            totals[0][entry] += 1
+            totals[1][entry] += kind in MISSED
+            if not math.isnan(elapsed):
+                totals[2][entry] += elapsed
+                totals[3][entry] += 1
+
+    def by_name(self):
+        '''
+        Return {name: (asked, missed, seconds, timed)} over every roster
+        version that is still known.
+        '''
+        result = {}
+        for version, totals in self.totals.items():
+            roster = Roster.find(version)
+            if roster is None:
+                LOGGER.warning("Unknown roster %s, skipping its events",
+                               version)
+                continue
+            for entry, counts in enumerate(zip(*totals)):
+                if entry >= len(roster) or not counts[0]:
+                    continue
+                name = roster.names[entry]
+                previous = result.get(name, (0, 0, 0.0, 0))
+                result[name] = tuple(a + b for a, b in zip(previous, counts))
+        return {name: (int(asked), int(missed), float(seconds), int(timed))
+                for name, (asked, missed, seconds, timed) in result.items()}
+
+    def miss_rates(self, prior=5):
+        '''
+        Return {name: miss rate}, smoothed towards the overall miss rate as
+        if every entry had been asked prior more times.
+        '''
+        counts = self.by_name()
+        asked = sum(each[0] for each in counts.values())
+        overall = 0.0
+        if asked:
+            overall = sum(each[1] for each in counts.values()) / asked
+        return {name: (missed + prior * overall) / (total + prior)
+                for name, (total, missed, _, _) in counts.items()}
+
+
+def difficulty(directory):
+    '''
+    Return the Difficulty of every roster entry in an event log.
+    '''
+    result = Difficulty()
+    for strings, columns in read(directory):
+        result.add(strings, columns)
+    return result
@@ -0,0 +1,362 @@
+'''
+Local stand-ins for external services, for offline benchmarks and tests
+'''
+
+import base64
+import hashlib
+import hmac
+import json
+import random
+import string
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from types import SimpleNamespace
+from urllib.parse import quote
+
+import dropbox
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    '''
+    HTTP server handling each connection in its own thread.
+    '''
+    daemon_threads = True
+
+
+class FakeServer:
+    '''
+    Base class for fake HTTP APIs running on a local port.
+    '''
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            '''
+            Route requests to the fake's handle() method.
+            '''
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                '''
+                Handle a POST request.
+                '''
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                fake.requests += 1
+                time.sleep(fake.latency)
+                code, reply = fake.handle(self.path, self.headers, body)
+                content = json.dumps(reply).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self.server = ThreadingServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, path, headers, body):
+        '''
+        Return (status code, JSON reply) for a request.
+        '''
+        raise NotImplementedError
+
+
+class FakeDropboxServer(FakeServer):
+    '''
+    Fake Dropbox API endpoint serving files/get_temporary_link.
+    '''
+
+    def handle(self, path, headers, body):
+        if path != '/2/files/get_temporary_link':
+            return 404, {'error_summary': 'not_found/'}
+        file_path = json.loads(body.decode('utf-8'))['path']
+        return 200, {'link': '{}/content{}?t={}'.format(
+            self.url, quote(file_path), time.time())}
+
+
+class FakeLineServer(FakeServer):
+    '''
+    Fake LINE Messaging API endpoint for replies, pushes and leaving chats.
+
+    Reply tokens work once, and tokens starting with 'expired' never work.
+    A push whose X-Line-Retry-Key was already accepted gets a 409. Set
+    fail_rate to answer that fraction of requests with a 500, and
+    rate_limit to answer requests over that many per second with a 429.
+    Sent messages are kept in `sent` as (kind, reply token or chat ID,
+    messages) tuples.
+    '''
+
+    def __init__(self, latency=0.0, fail_rate=0.0, rate_limit=None, seed=0):
+        super().__init__(latency)
+        self.fail_rate = fail_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.sent = []
+        self.used = set()
+        self.window = [0, 0]
+        self.lock = threading.Lock()
+
+    def handle(self, path, headers, body):
+        with self.lock:
+            second = int(time.time())
+            if self.window[0] != second:
+                self.window = [second, 0]
+            self.window[1] += 1
+            if self.rate_limit and self.window[1] > self.rate_limit:
+                return 429, {'message': 'The API rate limit has been '
+                                        'exceeded. Try again later.'}
+            if self.random.random() < self.fail_rate:
+                return 500, {'message': 'Internal server error'}
+            if path.startswith(('/v2/bot/group/', '/v2/bot/room/')):
+                return 200, {}
+            data = json.loads(body.decode('utf-8'))
+            if path == '/v2/bot/message/reply':
+                token = data['replyToken']
+                if token in self.used or token.startswith('expired'):
+                    return 400, {'message': 'Invalid reply token'}
+                self.used.add(token)
+                self.sent.append(('reply', token, data['messages']))
+                return 200, {}
+            if path == '/v2/bot/message/push':
+                key = headers.get('X-Line-Retry-Key')
+                if key is not None:
+                    if key in self.used:
+                        return 409, {'message': 'The retry key is already '
+                                                'accepted'}
+                    self.used.add(key)
+                self.sent.append(('push', data['to'], data['messages']))
+                return 200, {}
+            return 404, {'message': 'Not found'}
+
+
+class FakeDropbox:
+    '''
+    In-memory stand-in for a dropbox.Dropbox client, holding files as
+    {path: bytes}.
+
+    Supports the calls the bot makes: files_download, files_upload,
+    files_delete_v2, files_list_folder and files_list_folder_continue.
+    Listing a folder returns the files directly in it, at most page_size
+    per call, and continuing from the last cursor returns what changed
+    since. reset() makes every earlier cursor fail, as Dropbox sometimes
+    does. Uploaded bytes are counted in `uploaded` and API calls in
+    `calls`.
+    '''
+
+    def __init__(self, files=None, page_size=1000):
+        self.files = dict(files or {})
+        self.page_size = page_size
+        # Every upload and delete as (path, deleted), in order.
+        self.journal = []
+        self.pages = {}
+        self.tokens = 0
+        self.epoch = 0
+        self.uploaded = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def not_found(path):
+        '''
+        Return the ApiError Dropbox raises for a missing path.
+        '''
+        return dropbox.exceptions.ApiError(
+            'fake', dropbox.files.LookupError.not_found,
+            'not_found: {}'.format(path), 'en')
+
+    def files_download(self, path):
+        '''
+        Return (metadata, response) for a file.
+        '''
+        with self.lock:
+            self.calls += 1
+            if path not in self.files:
+                raise self.not_found(path)
+            content = self.files[path]
+        metadata = dropbox.files.FileMetadata(
+            name=path.rsplit('/', 1)[-1], path_lower=path.lower(),
+            path_display=path, size=len(content))
+        return metadata, SimpleNamespace(content=content)
+
+    def files_upload(self, content, path, mode=None):
+        '''
+        Store a file.
+        '''
+        # pylint: disable=unused-argument
+        with self.lock:
+            self.calls += 1
+            self.files[path] = bytes(content)
+            self.journal.append((path, False))
+            self.uploaded += len(content)
+
+    def files_delete_v2(self, path):
+        '''
+        Delete a file.
+        '''
+        with self.lock:
+            self.calls += 1
+            if self.files.pop(path, None) is None:
+                raise self.not_found(path)
+            self.journal.append((path, True))
+
+    def reset(self):
+        '''
+        Make every earlier cursor fail with a reset error.
+        '''
+        with self.lock:
+            self.epoch += 1
+            self.pages.clear()
+
+    @staticmethod
+    def entry(path, deleted):
+        '''
+        Return the metadata of a file or of a deleted file.
+        '''
+        name = path.rsplit('/', 1)[-1]
+        if deleted:
+            return dropbox.files.DeletedMetadata(
+                name=name, path_lower=path.lower(), path_display=path)
+        return dropbox.files.FileMetadata(
+            name=name, path_lower=path.lower(), path_display=path)
+
+    def page(self, folder, entries, position):
+        '''
+        Return a page of entries. Call with the lock held.
+
+        The rest of the entries are kept for the page's cursor. The cursor
+        of the last page points at the journal position the entries were
+        read at.
+        '''
+        first, rest = entries[:self.page_size], entries[self.page_size:]
+        if rest:
+            self.tokens += 1
+            token = self.tokens
+            self.pages[token] = (folder, rest, position)
+            cursor = 'page:{}:{}'.format(self.epoch, token)
+        else:
+            cursor = 'changes:{}:{}:{}'.format(self.epoch, position, folder)
+        return dropbox.files.ListFolderResult(entries=first, cursor=cursor,
+                                              has_more=bool(rest))
+
+    @staticmethod
+    def in_folder(folder, path):
+        '''
+        Check if a path is directly in a folder.
+        '''
+        prefix = folder.rstrip('/') + '/'
+        return path.startswith(prefix) and '/' not in path[len(prefix):]
+
+    def files_list_folder(self, path, limit=None):
+        '''
+        Return the first page of the files directly in a folder.
+        '''
+        # pylint: disable=unused-argument
+        with self.lock:
+            self.calls += 1
+            paths = sorted(each for each in self.files
+                           if self.in_folder(path, each))
+            if not paths:
+                raise self.not_found(path)
+            return self.page(path, [self.entry(each, False)
+                                    for each in paths], len(self.journal))
+
+    def files_list_folder_continue(self, cursor):
+        '''
+        Return the next page of a listing, or the changes since a listing.
+        '''
+        with self.lock:
+            self.calls += 1
+            kind, epoch, rest = cursor.split(':', 2)
+            if int(epoch) != self.epoch:
+                raise dropbox.exceptions.ApiError(
+                    'fake', dropbox.files.ListFolderContinueError.reset,
+                    'reset', 'en')
+            if kind == 'page':
+                folder, entries, position = self.pages.pop(int(rest))
+                return self.page(folder, entries, position)
+            position, folder = rest.split(':', 1)
+            # The last change of each path, in the order of those changes.
+            changes = {}
+            for path, deleted in self.journal[int(position):]:
+                if self.in_folder(folder, path):
+                    changes.pop(path, None)
+                    changes[path] = deleted
+            return self.page(folder, [self.entry(path, deleted) for
+                                      path, deleted in changes.items()],
+                             len(self.journal))
+
+
+def fake_roster(size=400):
+    '''
+    Return a list of random "Firstname Lastname" roster entries.
+    '''
+    rng = random.Random(size)
+
+    def word():
+        return ''.join(rng.choice(string.ascii_lowercase)
+                       for _ in range(rng.randint(3, 9))).title()
+
+    return sorted({'{} {}'.format(word(), word()) for _ in range(size)})
+
+
+def game_files(roster):
+    '''
+    Return the Dropbox files of a bot with a roster and nothing saved, for
+    a FakeDropbox.
+    '''
+    files = {'/game/{}/{}.jpg'.format(gender, name): b''
+             for gender, names in (('male', roster[::2]),
+                                   ('female', roster[1::2]))
+             for name in names}
+    files.update({'/save.json': b'{}', '/tix.json': b'[]'})
+    return files
+
+
+def bot_env(secret, line, links):
+    '''
+    Return the environment pointing the bot at a FakeLineServer and a
+    FakeDropboxServer, with the paths of game_files().
+    '''
+    return {'LINE_CHANNEL_SECRET': secret,
+            'LINE_CHANNEL_ACCESS_TOKEN': 'offline-token',
+            'LINE_API_URL': line.url, 'DROPBOX_API_URL': links.url,
+            'GAME_DATA_PATH': '/game', 'SAVE_FILE_PATH': '/save.json',
+            'TICKETS_FILE_PATH': '/tix.json', 'REQUEST_LOG_RATE': '0'}
+
+
+def webhook(secret, text, source, token=0):
+    '''
+    Return a signed (body, signature) LINE webhook for a text message.
+    '''
+    body = json.dumps({'destination': 'Ubot', 'events': [{
+        'type': 'message', 'mode': 'active', 'timestamp': int(time.time()),
+        'replyToken': '{:032x}'.format(token),
+        'webhookEventId': '{:026x}'.format(token),
+        'deliveryContext': {'isRedelivery': False},
+        'source': source,
+        'message': {'type': 'text', 'id': str(token), 'text': text},
+    }]})
+    signature = base64.b64encode(hmac.new(
+        secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256
+    ).digest()).decode('utf-8')
+    return body, signature
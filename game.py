@@ -0,0 +1,493 @@
+'''
+TarungBot game logic
+'''
+
+import base64
+import hashlib
+import logging
+import random
+import re
+import time
+import weakref
+from array import array
+
+from leaderboard import PERIODS
+from matching import Matcher, normalize
+from scheduler import Scheduler
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Roster:
+    '''
+    The people that can be asked about, shared by every player.
+
+    A roster never changes; a new one is made when the game data folders
+    change. Its version is derived from its entries, so saved progress can
+    be matched with the roster it was saved against.
+
+    Each entry has an index, and everything answering needs is computed
+    once per roster: ids maps names to indices, and normalized and tokens
+    hold each entry's normalized name and set of normalized words (split
+    on spaces and on punctuation). Guys come first, so gender lookups are
+    O(1). The answer matcher is built once per roster too.
+    '''
+    # Every roster in use in this process, by version. A roster is dropped
+    # once nothing refers to it, e.g. once every player has moved on from
+    # it; load() brings it back if needed.
+    versions = weakref.WeakValueDictionary()
+    # Optional function returning the JSON of an older roster by version.
+    load = None
+
+    def __init__(self, guys, gals):
+        self.guys = tuple(sorted(guys))
+        self.gals = tuple(sorted(gals))
+        self.names = self.guys + self.gals
+        self.ids = {name: index for index, name in enumerate(self.names)}
+        self.normalized = tuple(normalize(name) for name in self.names)
+        self.tokens = tuple(frozenset(name.split()) |
+                            frozenset(re.findall(r'\w+', name))
+                            for name in self.normalized)
+        self.matcher = Matcher(self)
+        # Changes from older rosters still in use, by roster.
+        self.changes_since = weakref.WeakKeyDictionary()
+        self.version = hashlib.sha1('\n'.join(
+            self.names).encode('utf-8')).hexdigest()[:12]
+        Roster.versions.setdefault(self.version, self)
+
+    def __len__(self):
+        return len(self.names)
+
+    def gender(self, name):
+        '''
+        Return the image folder of an entry: 'male' or 'female'.
+        '''
+        index = self.ids.get(name)
+        if index is not None and index < len(self.guys):
+            return 'male'
+        return 'female'
+
+    def changes(self, old):
+        '''
+        Return (new index of each entry of an older roster, or -1 if it was
+        removed; indices of the entries added since), computed once per
+        older roster.
+        '''
+        try:
+            return self.changes_since[old]
+        except KeyError:
+            pass
+        mapping = [self.ids.get(name, -1) for name in old.names]
+        added = tuple(index for index, name in enumerate(self.names)
+                      if name not in old.ids)
+        self.changes_since[old] = (mapping, added)
+        return mapping, added
+
+    @classmethod
+    def find(cls, version):
+        '''
+        Return the roster with the given version, or None if unknown.
+        '''
+        roster = cls.versions.get(version)
+        if roster is None and cls.load is not None:
+            data = cls.load(version)
+            if data is not None:
+                roster = cls.fromJSON(data)
+        return roster
+
+    def toJSON(self):
+        '''
+        Return the roster's JSON-compatible dictionary representation.
+        '''
+        return {'guys': list(self.guys), 'gals': list(self.gals)}
+
+    @classmethod
+    def fromJSON(cls, data):
+        '''
+        Return a roster from its JSON-compatible representation.
+        '''
+        return cls(data['guys'], data['gals'])
+
+
+class Progress:
+    '''
+    The roster entries a player hasn't been asked about yet.
+
+    Entries are kept as roster indices in an unordered array, with a second
+    array holding each index's position in the first, so adding, removing
+    and picking a random entry are all O(1). Progress is saved as a bitset
+    together with the roster version.
+    '''
+    __slots__ = ('roster', 'remaining', 'positions')
+
+    def __init__(self, roster, ids=()):
+        self.roster = roster
+        typecode = 'H' if len(roster) < 0xFFFF else 'I'
+        self.remaining = array(typecode)
+        self.positions = array(typecode, [self.missing]) * len(roster)
+        for index in ids:
+            self.add_id(index)
+
+    @property
+    def missing(self):
+        '''
+        Position value of entries that aren't remaining.
+        '''
+        return 0xFFFF if self.remaining.typecode == 'H' else 0xFFFFFFFF
+
+    @classmethod
+    def full(cls, roster):
+        '''
+        Return the progress of a new game.
+        '''
+        progress = cls(roster)
+        typecode = progress.remaining.typecode
+        progress.remaining = array(typecode, range(len(roster)))
+        progress.positions = array(typecode, range(len(roster)))
+        return progress
+
+    @classmethod
+    def from_names(cls, roster, names):
+        '''
+        Return progress with the given names, ignoring unknown ones.
+        '''
+        return cls(roster, (roster.ids[name] for name in names
+                            if name in roster.ids))
+
+    def moved(self, roster, added=False):
+        '''
+        Return this progress on a newer roster, without the removed
+        entries, and with the added ones if added is set.
+        '''
+        mapping, new = roster.changes(self.roster)
+        progress = Progress(roster)
+        remaining = [mapping[index] for index in self.remaining
+                     if mapping[index] >= 0]
+        if added:
+            remaining.extend(new)
+        progress.remaining.extend(remaining)
+        positions = progress.positions
+        for position, index in enumerate(remaining):
+            positions[index] = position
+        return progress
+
+    def __len__(self):
+        return len(self.remaining)
+
+    def __bool__(self):
+        return bool(self.remaining)
+
+    def __contains__(self, name):
+        index = self.roster.ids.get(name)
+        return index is not None and self.positions[index] != self.missing
+
+    def __iter__(self):
+        return (self.roster.names[index] for index in self.remaining)
+
+    def add_id(self, index):
+        '''
+        Add a roster index if it isn't remaining yet.
+        '''
+        if self.positions[index] == self.missing:
+            self.positions[index] = len(self.remaining)
+            self.remaining.append(index)
+
+    def add(self, name):
+        '''
+        Add a roster entry. Raise KeyError if it isn't in the roster.
+        '''
+        self.add_id(self.roster.ids[name])
+
+    def remove(self, name):
+        '''
+        Remove a remaining entry. Raise ValueError if it isn't remaining.
+        '''
+        if name not in self:
+            raise ValueError('{} is not remaining'.format(name))
+        index = self.roster.ids[name]
+        position = self.positions[index]
+        last = self.remaining.pop()
+        if last != index:
+            self.remaining[position] = last
+            self.positions[last] = position
+        self.positions[index] = self.missing
+
+    def clear(self):
+        '''
+        Remove every entry.
+        '''
+        for index in self.remaining:
+            self.positions[index] = self.missing
+        del self.remaining[:]
+
+    def choice(self):
+        '''
+        Return a uniformly random remaining entry.
+        '''
+        return self.roster.names[random.choice(self.remaining)]
+
+    def toJSON(self):
+        '''
+        Return the progress as a roster version and a base64 bitset.
+        '''
+        bits = bytearray((len(self.roster) + 7) // 8)
+        for index in self.remaining:
+            bits[index >> 3] |= 1 << (index & 7)
+        return {'roster': self.roster.version,
+                'bits': base64.b64encode(bytes(bits)).decode('ascii')}
+
+    @classmethod
+    def fromJSON(cls, data, roster):
+        '''
+        Return progress saved in any format, converted to the given roster.
+
+        Old saves store progress as a list of names. Progress saved against
+        an older roster keeps the entries that are still in the roster.
+        '''
+        if isinstance(data, list):
+            return cls.from_names(roster, data)
+        saved = Roster.find(data['roster'])
+        if saved is None:
+            LOGGER.warning("Unknown roster %s, starting over",
+                           data['roster'])
+            return cls.full(roster)
+        bits = base64.b64decode(data['bits'])
+        ids = (index for index in range(len(saved))
+               if bits[index >> 3] >> (index & 7) & 1)
+        if saved is roster:
+            return cls(roster, ids)
+        return cls.from_names(roster, (saved.names[index] for index in ids))
+
+
+class Player:
+    '''
+    A player
+    '''
+    # The current roster, loaded from the game data folders on startup.
+    roster = Roster([], [])
+    # Optional function returning the current roster of another named
+    # dataset, or None if there is no such dataset. Players of other
+    # datasets name theirs in data['roster'].
+    find_roster = None
+    # Chooses every player's questions, see scheduler.py.
+    scheduler = Scheduler()
+
+    def __init__(self, name='Anonymous', pick='', progress=None, data=None,
+                 roster=None):
+        self.name = name
+        self.pick = pick
+        self.upcoming = None
+        # When the current pick was asked, and the last answer's
+        # (verdict, pick, answer, seconds taken), for the event log.
+        self.asked = None
+        self.outcome = None
+        if data is None:
+            self.data = {'exact': 0, 'correct': 0, 'partial': 0,
+                         'wrong': 0, 'skipped': 0, 'count': 0,
+                         'score': 0, 'high_score': 0, 'manual': False,
+                         'periods': {}}
+            if roster is not None:
+                self.data['roster'] = roster
+        else:
+            self.data = data
+        if progress is None:
+            self.progress = Progress.full(self.current_roster())
+        else:
+            self.progress = progress
+
+    def current_roster(self):
+        '''
+        Return the current roster of the player's dataset.
+        '''
+        name = self.data.get('roster')
+        if name is None or Player.find_roster is None:
+            return Player.roster
+        roster = Player.find_roster(name)
+        if roster is None:
+            LOGGER.warning("Unknown roster %s, using the default", name)
+            return Player.roster
+        return roster
+
+    def finished(self):
+        '''
+        Check if a player has finished their game.
+        '''
+        if self.progress or Player.scheduler.waiting(self):
+            return False
+        return True
+
+    def gender(self, pick):
+        '''
+        Return the image folder of a roster entry.
+        '''
+        return self.current_roster().gender(pick)
+
+    def sync_roster(self):
+        '''
+        Move the player's progress onto the current roster if it changed.
+
+        Entries removed from the roster are dropped, and entries added to it
+        join a game in progress.
+        '''
+        roster = self.current_roster()
+        if self.progress.roster is not roster:
+            self.progress = self.progress.moved(roster,
+                                                added=bool(self.progress))
+
+    def next_pick(self, repick=False):
+        '''
+        Pick the next roster entry and return it.
+        '''
+        self.sync_roster()
+        if not repick:
+            if self.upcoming in self.progress:
+                self.pick = self.upcoming
+            else:
+                self.pick = Player.scheduler.pick(self)
+            self.asked = time.time()
+
+        # Choose the question after this one now, so its image can be
+        # prepared while this one is being answered.
+        self.upcoming = None
+        for _ in range(8):
+            if not self.progress and not Player.scheduler.waiting(self):
+                break
+            upcoming = Player.scheduler.pick(self)
+            if upcoming != self.pick:
+                self.upcoming = upcoming
+                break
+        return self.pick
+
+    def answer(self, name):
+        '''
+        Answer current pick.
+        '''
+        self.sync_roster()
+        roster = self.progress.roster
+        if roster.gender(self.pick) == 'male':
+            pronoun = ('He', 'him')
+        else:
+            pronoun = ('She', 'her')
+
+        if self.pick not in roster.ids:
+            return "That person has been removed from the game."
+        if self.pick not in self.progress:
+            return ("That question has already been answered.\n"
+                    "Use /next to get a new one.")
+
+        if name.lower() == 'pass':
+            verdict = 'skipped'
+            msg = ("{} is {}. Remember {} next time!"
+                   .format(pronoun[0], self.pick, pronoun[1]))
+        else:
+            verdict = roster.matcher.judge(name, roster.ids[self.pick])
+            if verdict == 'exact':
+                msg = ("Wow, that's exactly right! {} is {}."
+                       .format(pronoun[0], self.pick))
+            elif verdict == 'correct':
+                msg = ("You are correct! {} is {}."
+                       .format(pronoun[0], self.pick))
+            elif verdict == 'partial':
+                msg = ("You are partially correct! "
+                       "{} is actually {}, not {}."
+                       .format(pronoun[0], self.pick, name.title()))
+            elif verdict == 'wrong':
+                msg = ("You are wrong! {} is {}. Remember {} next time!"
+                       .format(pronoun[0], self.pick, pronoun[1]))
+            else:
+                msg = ("Please be more specific. Try again!")
+
+        now = time.time()
+        elapsed = now - self.asked if self.asked is not None else None
+        self.outcome = (verdict, self.pick, name, elapsed)
+        if verdict != 'vague':
+            self.count(verdict, now)
+        return msg
+
+    def end(self):
+        '''
+        End the game, leaving no questions to ask.
+        '''
+        self.pick = ''
+        self.progress.clear()
+        Player.scheduler.ended(self)
+
+    def count(self, verdict, now=None):
+        '''
+        Count an answer to the current pick and remove it from the game.
+        '''
+        self.data[verdict] += 1
+        self.progress.remove(self.pick)
+        self.data['count'] += 1
+        self.data['score'] = (5*self.data['exact'] +
+                              3*self.data['correct'] +
+                              3*self.data['partial'] -
+                              1*self.data['wrong'])
+        if self.data['score'] > self.data['high_score']:
+            self.data['high_score'] = self.data['score']
+        self.record_score(now)
+        Player.scheduler.answered(self, verdict)
+
+    def record_score(self, now=None):
+        '''
+        Keep the best score of the current day and week, for the period
+        Leaderboards.
+        '''
+        now = time.time() if now is None else now
+        # Replace rather than change the periods, as saved copies share them.
+        periods = dict(self.data.get('periods', {}))
+        for period, current in PERIODS.items():
+            key = current(now)
+            if (period not in periods or periods[period][0] != key or
+                    self.data['score'] > periods[period][1]):
+                periods[period] = [key, self.data['score']]
+        self.data['periods'] = periods
+
+    def stats(self):
+        '''
+        Return a player's current game statistics.
+        '''
+        total = (self.data['exact'] + self.data['correct'] +
+                 self.data['partial'] + self.data['wrong'] +
+                 self.data['skipped'])
+        size = len(self.current_roster())
+        return ("{}/{} persons ({:.2f}%).\n"
+                "Exact: {} ({:.2f}%)\n"
+                "Correct: {} ({:.2f}%)\n"
+                "Partial: {} ({:.2f}%)\n"
+                "Wrong: {} ({:.2f}%)\n"
+                "Skipped: {} ({:.2f}%)\n"
+                "Current Score: {}\n"
+                "Highest Score: {}\n"
+                "Name: {}"
+                .format(total, size, total/size*100,
+                        self.data['exact'], self.data['exact']/size*100,
+                        self.data['correct'], self.data['correct']/size*100,
+                        self.data['partial'], self.data['partial']/size*100,
+                        self.data['wrong'], self.data['wrong']/size*100,
+                        self.data['skipped'], self.data['skipped']/size*100,
+                        self.data['score'],
+                        self.data['high_score'],
+                        self.name))
+
+    @classmethod
+    def fromJSON(cls, record):
+        '''
+        Return a player from its JSON-compatible dictionary representation.
+        '''
+        player = cls(name=record['name'], pick=record['pick'],
+                     progress=False, data=record['data'])
+        roster = player.current_roster()
+        player.progress = Progress.fromJSON(record['progress'], roster)
+        if player.pick in roster.ids:
+            # Share the roster's copy of the name.
+            player.pick = roster.names[roster.ids[player.pick]]
+        return player
+
+    def toJSON(self):
+        '''
+        Return an instance's JSON-compatible dictionary representation.
+        '''
+        stats = {'name': self.name, 'pick': self.pick,
+                 'progress': self.progress.toJSON(), 'data': dict(self.data)}
+        return stats
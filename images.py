@@ -0,0 +1,133 @@
+'''
+Local mirror of question images with preview thumbnails
+'''
+
+import logging
+import os
+import shutil
+import threading
+from urllib.parse import quote
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+LOGGER = logging.getLogger(__name__)
+
+VARIANTS = ('original', 'preview')
+GENDERS = ('male', 'female')
+
+
+class ImageMirror:
+    '''
+    Question images downloaded once from Dropbox and served by the bot.
+
+    Images live in <directory>/<variant>/<gender>/<name>.jpg, where the
+    preview variant is resized to fit preview_size pixels. Without Pillow,
+    previews are plain copies of the originals.
+
+    update() syncs in a single background thread. Rosters that arrive
+    while a sync runs are coalesced, so only the latest is synced next.
+    '''
+
+    def __init__(self, dbx, root, directory, base_url, preview_size=240):
+        self.dbx = dbx
+        self.root = root
+        self.directory = directory
+        self.base_url = base_url.rstrip('/')
+        self.preview_size = preview_size
+        self.available = set()
+        # The roster to sync next, and whether the sync thread is running.
+        self.wanted = None
+        self.syncing = False
+        self.lock = threading.Lock()
+
+    def path(self, variant, gender, pick):
+        '''
+        Return the local path of an image.
+        '''
+        return os.path.join(self.directory, variant, gender, pick + '.jpg')
+
+    def sync(self, roster):
+        '''
+        Download missing images and build missing previews.
+
+        roster is a {gender: [names]} dictionary.
+        '''
+        if Image is None:
+            LOGGER.warning("Pillow is not installed, previews will be "
+                           "full-size copies")
+        for gender, names in roster.items():
+            for variant in VARIANTS:
+                os.makedirs(os.path.join(self.directory, variant, gender),
+                            exist_ok=True)
+            for pick in names:
+                original = self.path('original', gender, pick)
+                preview = self.path('preview', gender, pick)
+                try:
+                    if not os.path.exists(original):
+                        self.dbx.files_download_to_file(
+                            original + '.part',
+                            '{}/{}/{}.jpg'.format(self.root, gender, pick))
+                        os.replace(original + '.part', original)
+                    if not os.path.exists(preview):
+                        self.make_preview(original, preview)
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception("Mirroring %s failed", pick)
+                else:
+                    self.available.add((gender, pick))
+
+    def update(self, roster):
+        '''
+        Sync to roster in the background.
+        '''
+        with self.lock:
+            self.wanted = roster
+            if self.syncing:
+                return
+            self.syncing = True
+        threading.Thread(target=self.run, daemon=True,
+                         name='image-sync').start()
+
+    def run(self):
+        '''
+        Sync the latest wanted roster until none is left.
+        '''
+        while True:
+            with self.lock:
+                roster, self.wanted = self.wanted, None
+                if roster is None:
+                    self.syncing = False
+                    return
+            try:
+                self.sync(roster)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Mirroring failed")
+
+    def make_preview(self, original, preview):
+        '''
+        Write a resized JPEG copy of original to preview.
+        '''
+        if Image is None:
+            shutil.copyfile(original, preview + '.part')
+        else:
+            with Image.open(original) as image:
+                image.thumbnail((self.preview_size, self.preview_size))
+                image.convert('RGB').save(preview + '.part', 'JPEG',
+                                          quality=80, optimize=True)
+        os.replace(preview + '.part', preview)
+
+    def has(self, gender, pick):
+        '''
+        Check if an image has been mirrored.
+        '''
+        return (gender, pick) in self.available
+
+    def urls(self, gender, pick):
+        '''
+        Return the (original, preview) URLs of a mirrored image.
+        '''
+        return tuple('{}/images/{}/{}/{}.jpg'.format(
+            self.base_url, variant, gender, quote(pick))
+                     for variant in VARIANTS)
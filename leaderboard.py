@@ -0,0 +1,144 @@
+'''
+Incrementally maintained Leaderboards
+'''
+
+import datetime
+import threading
+import time
+
+KINDS = ('user', 'group')
+# Days and weeks start at midnight in this timezone: Western Indonesian
+# Time unless app.py is configured otherwise.
+TIMEZONE = datetime.timezone(datetime.timedelta(hours=7))
+
+
+def day(timestamp):
+    '''
+    Return the daily period of a UNIX timestamp, e.g. '2017-08-17'.
+    '''
+    return datetime.datetime.fromtimestamp(
+        timestamp, TIMEZONE).strftime('%Y-%m-%d')
+
+
+def week(timestamp):
+    '''
+    Return the ISO week period of a UNIX timestamp, e.g. '2017-W33'.
+    '''
+    year, number, _ = datetime.datetime.fromtimestamp(
+        timestamp, TIMEZONE).isocalendar()
+    return '{}-W{:02d}'.format(year, number)
+
+
+# Functions returning the current key of each period, by period name.
+PERIODS = {'daily': day, 'weekly': week}
+
+
+def kind(chat_id):
+    '''
+    Return the board a chat belongs to: 'user' for 1:1 chats, 'group' for
+    groups and rooms.
+    '''
+    return 'user' if chat_id.startswith('U') else 'group'
+
+
+class Leaderboard:
+    '''
+    The top `size` (score, name, chat ID) entries of one board.
+
+    Scores only ever go up within a board (high scores, or the best score of
+    a period), so a chat that falls out of the top can only get back in by
+    reporting a higher score. Entries are kept sorted best first, so reading
+    the board is O(size) and so is updating it.
+    '''
+
+    def __init__(self, size=10):
+        self.size = size
+        self.entries = []
+
+    def update(self, chat, score, name):
+        '''
+        Report a chat's score and name.
+        '''
+        entries = [entry for entry in self.entries if entry[2] != chat]
+        if len(entries) < self.size or (score, name) > entries[-1][:2]:
+            entries.append((score, name, chat))
+            entries.sort(reverse=True)
+            del entries[self.size:]
+        self.entries = entries
+
+    def top(self):
+        '''
+        Return the (score, name, chat ID) entries, best first.
+        '''
+        return list(self.entries)
+
+
+class Leaderboards:
+    '''
+    All-time, daily and weekly Leaderboards, separate for users and groups.
+
+    Players record their best score of each period in
+    data['periods'] = {period: [key, score]}, so the boards can be rebuilt
+    from saved players on startup and then kept up to date by calling
+    update() after a player's score changes.
+    '''
+
+    def __init__(self, size=10, clock=time.time):
+        self.size = size
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.boards = {}
+        self.keys = {}
+        self.clear()
+
+    def clear(self):
+        '''
+        Empty every board.
+        '''
+        with self.lock:
+            for each in KINDS:
+                for period in ('all',) + tuple(PERIODS):
+                    self.boards[each, period] = Leaderboard(self.size)
+            self.keys = {period: None for period in PERIODS}
+
+    def roll(self, now):
+        '''
+        Empty the boards of periods that have ended. Call with the lock held.
+        '''
+        for period, current in PERIODS.items():
+            key = current(now)
+            if self.keys[period] != key:
+                self.keys[period] = key
+                for each in KINDS:
+                    self.boards[each, period] = Leaderboard(self.size)
+
+    def update(self, chat, player):
+        '''
+        Report a player's high score, period scores and name.
+        '''
+        with self.lock:
+            self.roll(self.clock())
+            board = kind(chat)
+            self.boards[board, 'all'].update(
+                chat, player.data['high_score'], player.name)
+            periods = player.data.get('periods', {})
+            for period, key in self.keys.items():
+                if period in periods and periods[period][0] == key:
+                    self.boards[board, period].update(
+                        chat, periods[period][1], player.name)
+
+    def rebuild(self, players):
+        '''
+        Rebuild every board from (chat ID, player) pairs.
+        '''
+        self.clear()
+        for chat, player in players:
+            self.update(chat, player)
+
+    def top(self, board='user', period='all'):
+        '''
+        Return the (score, name, chat ID) entries of a board, best first.
+        '''
+        with self.lock:
+            self.roll(self.clock())
+            return self.boards[board, period].top()
@@ -0,0 +1,153 @@
+'''
+Cached Dropbox temporary links for question images
+'''
+
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+LOGGER = logging.getLogger(__name__)
+
+# Dropbox temporary links expire after four hours.
+LINK_LIFETIME = 4 * 60 * 60
+
+
+class DropboxLinks:
+    '''
+    Fetch temporary links over a shared keep-alive session.
+    '''
+
+    def __init__(self, access_token, root,
+                 api_url='https://api.dropboxapi.com', timeout=10):
+        self.root = root
+        self.url = api_url.rstrip('/') + '/2/files/get_temporary_link'
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': 'Bearer {}'.format(access_token),
+        })
+
+    def __call__(self, gender, pick):
+        path = '{}/{}/{}.jpg'.format(self.root, gender, pick)
+        response = self.session.post(self.url, json={'path': path},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['link']
+
+
+class LinkCache:
+    '''
+    Links keyed by (gender, pick), kept until shortly before they expire.
+    '''
+
+    def __init__(self, fetch, ttl=LINK_LIFETIME - 10 * 60, maxsize=4096):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.links = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cached(self, gender, pick):
+        '''
+        Return a cached, unexpired link or None.
+        '''
+        key = (gender, pick)
+        with self.lock:
+            try:
+                link, expires = self.links[key]
+            except KeyError:
+                return None
+            if expires <= time.time():
+                del self.links[key]
+                return None
+            self.links.move_to_end(key)
+            return link
+
+    def get(self, gender, pick):
+        '''
+        Return a link, fetching it if it isn't cached.
+        '''
+        link = self.cached(gender, pick)
+        if link is not None:
+            self.hits += 1
+            return link
+        self.misses += 1
+        return self.warm(gender, pick)
+
+    def warm(self, gender, pick):
+        '''
+        Fetch a link and store it in the cache.
+        '''
+        link = self.fetch(gender, pick)
+        with self.lock:
+            self.links[(gender, pick)] = (link, time.time() + self.ttl)
+            self.links.move_to_end((gender, pick))
+            if len(self.links) > self.maxsize:
+                self.evict()
+        return link
+
+    def evict(self):
+        '''
+        Drop expired links, then the least recently used ones over maxsize.
+        '''
+        now = time.time()
+        for key in [key for key, (_, expires) in self.links.items()
+                    if expires <= now]:
+            del self.links[key]
+        while len(self.links) > self.maxsize:
+            self.links.popitem(last=False)
+
+    def hit_rate(self):
+        '''
+        Return the fraction of get() calls served from the cache.
+        '''
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class Prefetcher:
+    '''
+    Background threads that warm links before they are asked for.
+    '''
+
+    def __init__(self, cache, workers=4, maxsize=256):
+        self.cache = cache
+        self.queue = queue.Queue(maxsize)
+        self.threads = [threading.Thread(target=self.run, daemon=True,
+                                         name='link-prefetch-{}'.format(i))
+                        for i in range(workers)]
+
+    def start(self):
+        '''
+        Start the prefetch threads.
+        '''
+        for thread in self.threads:
+            thread.start()
+
+    def prefetch(self, gender, pick, cache=None):
+        '''
+        Queue a link to be warmed in cache, by default the prefetcher's,
+        dropping the request if busy.
+        '''
+        try:
+            self.queue.put_nowait((cache or self.cache, gender, pick))
+        except queue.Full:
+            pass
+
+    def run(self):
+        '''
+        Warm queued links that aren't cached yet.
+        '''
+        while True:
+            cache, gender, pick = self.queue.get()
+            if cache.cached(gender, pick) is None:
+                try:
+                    cache.warm(gender, pick)
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception("Prefetching %s failed", pick)
@@ -0,0 +1,139 @@
+'''
+Answer matching for TarungBot
+'''
+
+import unicodedata
+from collections import Counter
+
+
+def normalize(text):
+    '''
+    Return text lowercased and without accents, for comparing names.
+    '''
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in decomposed
+                   if not unicodedata.combining(char))
+
+
+def bigrams(text):
+    '''
+    Return the set of pairs of adjacent letters in text.
+    '''
+    return set(zip(text, text[1:]))
+
+
+def edit_distance(first, second, limit):
+    '''
+    Return the Levenshtein distance between two words, or limit + 1 if it
+    is larger than limit.
+    '''
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    if limit == 1:
+        # Skip the common prefix and compare what follows the one edit.
+        if len(first) > len(second):
+            first, second = second, first
+        start = 0
+        while start < len(first) and first[start] == second[start]:
+            start += 1
+        if start == len(second):
+            return 0
+        after = start + 1 if len(first) == len(second) else start
+        return 1 if first[after:] == second[start + 1:] else 2
+    previous = list(range(len(second) + 1))
+    for i, char in enumerate(first, 1):
+        current = [i]
+        for j, other in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char != other)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class Matcher:
+    '''
+    Judges answers against the entries of one roster.
+
+    A word in an answer matches an entry if it is part of the entry's
+    normalized name, or if it is at least fuzzy_length letters long and at
+    most max_distance edits away from one of the entry's words. Each edit
+    changes at most two of a word's letter pairs, so the edit distance is
+    only computed for words of a fitting length sharing enough of them
+    with the entry. An entry's word lengths and letter pairs are indexed
+    the first time they are needed.
+
+    Words that are part of a common name don't make an answer specific
+    enough on their own. Common names are common_names plus every word
+    shared by at least common_fraction of the roster and by at least
+    common_minimum names, so small rosters don't stop ordinary names.
+    '''
+    common_names = ('muhammad', 'muhamad', 'naufal')
+    common_fraction = 0.05
+    common_minimum = 10
+    max_distance = 1
+    fuzzy_length = 5
+
+    def __init__(self, roster):
+        self.roster = roster
+        counts = Counter(token for tokens in roster.tokens
+                         for token in tokens)
+        threshold = max(self.common_minimum,
+                        self.common_fraction * len(roster))
+        self.common_tokens = set(self.common_names) | {
+            token for token, count in counts.items() if count >= threshold}
+        # Every part of a common name, so checking a word is a set lookup.
+        self.common = {token[start:end] for token in self.common_tokens
+                       for start in range(len(token))
+                       for end in range(start + 1, len(token) + 1)}
+        self.grams = {}
+
+    def fuzzy(self, word, index):
+        '''
+        Check if a normalized word is at most max_distance edits away from
+        one of a roster entry's words.
+        '''
+        indexed = self.grams.get(index)
+        if indexed is None:
+            lengths = [len(token) for token in self.roster.tokens[index]]
+            indexed = self.grams[index] = (
+                min(lengths), max(lengths),
+                bigrams(self.roster.normalized[index]))
+        shortest, longest, grams = indexed
+        if not (shortest - self.max_distance <= len(word) <=
+                longest + self.max_distance):
+            return False
+        own = bigrams(word)
+        if len(own & grams) < len(own) - 2 * self.max_distance:
+            return False
+        return any(edit_distance(word, token, self.max_distance) <=
+                   self.max_distance for token in self.roster.tokens[index])
+
+    def judge(self, answer, index):
+        '''
+        Judge an answer for a roster entry. Return 'exact', 'correct',
+        'partial', 'wrong', or 'vague' if it isn't specific enough.
+        '''
+        # Plain ASCII answers need no accents removed.
+        answer = answer.lower() if answer.isascii() else normalize(answer)
+        name = self.roster.normalized[index]
+        if answer == name:
+            return 'exact'
+        correct = False
+        entirely = True
+        specific = False
+        for word in answer.split():
+            if word not in self.common:
+                specific = len(word) >= 3
+            # Most words are part of the name; typos are checked last.
+            matched = word in name or (
+                self.max_distance > 0 and len(word) >= self.fuzzy_length and
+                self.fuzzy(word, index))
+            correct = correct or matched
+            entirely = entirely and matched
+        if not specific:
+            return 'vague'
+        if not correct:
+            return 'wrong'
+        return 'correct' if entirely else 'partial'
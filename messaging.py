@@ -0,0 +1,249 @@
+'''
+Outbound LINE messages with pooling, retries and rate limiting
+'''
+
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ratelimit import TokenBucket
+
+LOGGER = logging.getLogger(__name__)
+
+# A reply can hold at most this many messages.
+MAX_MESSAGES = 5
+# Responses worth retrying: rate limited or a server error.
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+
+class Metric:
+    '''
+    Call count, error count and recent latencies of one kind of call.
+    '''
+
+    def __init__(self, window=1000):
+        self.calls = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, ok):
+        '''
+        Record one HTTP call.
+        '''
+        with self.lock:
+            self.calls += 1
+            self.errors += not ok
+            self.latencies.append(seconds)
+
+    def summary(self):
+        '''
+        Return the counts, error rate and latency percentiles in seconds.
+        '''
+        with self.lock:
+            ordered = sorted(self.latencies)
+            calls, errors = self.calls, self.errors
+
+        def percentile(pct):
+            if not ordered:
+                return None
+            return round(ordered[min(len(ordered) - 1,
+                                     int(len(ordered) * pct / 100))], 4)
+
+        return {'calls': calls, 'errors': errors,
+                'error_rate': round(errors / calls, 4) if calls else 0.0,
+                'p50': percentile(50), 'p95': percentile(95),
+                'p99': percentile(99)}
+
+
+class Messenger:
+    '''
+    Sends replies and pushes to the LINE Messaging API.
+
+    Calls share a pooled keep-alive session and time out after `timeout`
+    seconds. A rate limiter keeps calls under `rate` per second.
+    Rate-limited, failed and timed out calls are retried up to `retries`
+    times, after a random delay of up to backoff * 2 ** attempt seconds.
+    Replies are safe to retry because a reply token only works once.
+    Pushes carry a retry key, so LINE drops a retried push that already
+    went through.
+
+    If a reply token has expired, the reply is pushed to the chat instead.
+    A token rejected on a retry is taken as an earlier attempt having gone
+    through, since pushing could send the reply twice; such replies are
+    logged and counted in `assumed`.
+    Replies of more than five messages send the rest as a push. Failures
+    are logged rather than raised, since the game state has already
+    changed by the time a reply is sent.
+    '''
+
+    def __init__(self, access_token, endpoint='https://api.line.me',
+                 timeout=5.0, retries=3, backoff=0.25, rate=100.0,
+                 pool=16):
+        self.endpoint = endpoint.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # Bursts of at most a tenth of a second's worth of calls.
+        self.limiter = TokenBucket(rate, max(1, rate / 10))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Authorization': 'Bearer {}'.format(access_token),
+            'Content-Type': 'application/json',
+        })
+        self.metrics = {'reply': Metric(), 'push': Metric()}
+        self.fallbacks = 0
+        self.assumed = 0
+        self.failures = 0
+        self.hooks = []
+
+    def add_hook(self, hook):
+        '''
+        Call hook(kind, seconds, ok) after every HTTP call.
+        '''
+        self.hooks.append(hook)
+
+    def post(self, kind, path, data, headers=None):
+        '''
+        POST data with retries. Return (status, error message, attempts);
+        status is None if no response arrived.
+        '''
+        body = json.dumps(data).encode('utf-8')
+        status, message, retry_after = None, None, None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                if status == 429 and retry_after is not None:
+                    delay = max(delay, retry_after)
+                time.sleep(delay)
+            self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.post(self.endpoint + path, data=body,
+                                             headers=headers,
+                                             timeout=self.timeout)
+            except requests.RequestException as error:
+                status, message, retry_after = None, repr(error), None
+            else:
+                status = response.status_code
+                message = self.error_message(response)
+                retry_after = self.retry_after(response)
+            ok = status is not None and 200 <= status < 300
+            elapsed = time.perf_counter() - start
+            self.metrics[kind].observe(elapsed, ok)
+            for hook in self.hooks:
+                hook(kind, elapsed, ok)
+            if ok or (status is not None and status not in RETRY_STATUSES):
+                return status, message, attempt + 1
+        return status, message, self.retries + 1
+
+    @staticmethod
+    def error_message(response):
+        '''
+        Return the error message of a LINE API response, if any.
+        '''
+        if 200 <= response.status_code < 300:
+            return None
+        try:
+            return response.json().get('message')
+        except ValueError:
+            return response.text[:200]
+
+    @staticmethod
+    def retry_after(response):
+        '''
+        Return the seconds a rate-limited response asks to wait, capped at
+        10, or None.
+        '''
+        try:
+            return min(10.0, float(response.headers['Retry-After']))
+        except (KeyError, ValueError):
+            return None
+
+    @staticmethod
+    def as_list(messages):
+        '''
+        Return messages as a list of JSON-compatible dictionaries.
+        '''
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        return [message.as_json_dict() if hasattr(message, 'as_json_dict')
+                else message for message in messages]
+
+    def reply(self, reply_token, messages, to=None):
+        '''
+        Reply to an event, pushing to the chat `to` instead if the reply
+        token has expired. Return True if every message was sent.
+        '''
+        messages = self.as_list(messages)
+        first, rest = messages[:MAX_MESSAGES], messages[MAX_MESSAGES:]
+        status, message, attempts = self.post(
+            'reply', '/v2/bot/message/reply',
+            {'replyToken': reply_token, 'messages': first})
+        sent = status is not None and 200 <= status < 300
+        if status == 400 and 'reply token' in (message or '').lower():
+            if attempts > 1:
+                # An earlier attempt most likely timed out but went
+                # through; the token may also have expired meanwhile.
+                self.assumed += 1
+                LOGGER.warning("Reply token used after %d attempts, "
+                               "assuming the reply was delivered", attempts)
+                sent = True
+            elif to is not None:
+                self.fallbacks += 1
+                LOGGER.info("Reply token expired, pushing to %s", to)
+                return self.push(to, messages)
+        if not sent:
+            self.failed('reply', status, message)
+            return False
+        if rest:
+            if to is None:
+                LOGGER.warning("Dropping %d messages over the reply limit",
+                               len(rest))
+                return False
+            return self.push(to, rest)
+        return True
+
+    def push(self, to, messages):
+        '''
+        Push messages to a chat. Return True if every message was sent.
+        '''
+        messages = self.as_list(messages)
+        for start in range(0, len(messages), MAX_MESSAGES):
+            status, message, _ = self.post(
+                'push', '/v2/bot/message/push',
+                {'to': to, 'messages': messages[start:start+MAX_MESSAGES]},
+                headers={'X-Line-Retry-Key': str(uuid.uuid4())})
+            # 409: a retry of a push that had already been accepted.
+            if status is None or not (200 <= status < 300 or status == 409):
+                self.failed('push', status, message)
+                return False
+        return True
+
+    def failed(self, kind, status, message):
+        '''
+        Log a call that failed for good.
+        '''
+        self.failures += 1
+        LOGGER.error("LINE %s failed: %s %s", kind, status, message)
+
+    def stats(self):
+        '''
+        Return metrics of every kind of call, for the status endpoint.
+        '''
+        stats = {kind: metric.summary()
+                 for kind, metric in self.metrics.items()}
+        stats['fallbacks'] = self.fallbacks
+        stats['assumed'] = self.assumed
+        stats['failures'] = self.failures
+        return stats
@@ -0,0 +1,203 @@
+'''
+Prometheus metrics in the text exposition format
+'''
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds.
+SECONDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0)
+
+
+def escape(value):
+    '''
+    Return a label value escaped for the exposition format.
+    '''
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_labels(names, values):
+    '''
+    Return {name="value",...} for the given labels, or '' if there are
+    none.
+    '''
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in zip(names, values)) + '}'
+
+
+def format_value(value):
+    '''
+    Return a sample value as text.
+    '''
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''
+    Base class of metrics: a name, help text and label names.
+    '''
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        '''
+        Return the label values of a sample, in label name order.
+        '''
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        '''
+        Yield (suffix, label names, label values, value) samples.
+        '''
+        raise NotImplementedError
+
+    def render(self):
+        '''
+        Return the metric as lines of text.
+        '''
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, names, values, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix,
+                                            format_labels(names, values),
+                                            format_value(value)))
+        return lines
+
+
+class Histogram(Metric):
+    '''
+    Counts of observed values in cumulative buckets, with their sum.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=SECONDS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+        # {label values: [count per bucket and +Inf, sum]}
+        self.values = {}
+
+    def observe(self, value, **labels):
+        '''
+        Count a value.
+        '''
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            try:
+                counts = self.values[key]
+            except KeyError:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Observe how many seconds the with block takes.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def wrap(self, func, **labels):
+        '''
+        Return func, observing how many seconds each call takes.
+        '''
+        def timed(*args, **kwargs):
+            with self.time(**labels):
+                return func(*args, **kwargs)
+        return timed
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts))
+                      for key, counts in self.values.items()]
+        names = self.labels + ('le',)
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield '_bucket', names, key + (format_value(bound),), total
+            yield '_sum', self.labels, key, counts[-1]
+            yield '_count', self.labels, key, total
+
+
+class Collected(Metric):
+    '''
+    A gauge or counter read when metrics are scraped, e.g. from a counter
+    another object already keeps.
+
+    func returns a number, or a {label values: number} dictionary.
+    '''
+
+    def __init__(self, name, doc, func, kind='gauge', labels=()):
+        super().__init__(name, doc, labels)
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        value = self.func()
+        if isinstance(value, dict):
+            for key, each in value.items():
+                yield '', self.labels, key, each
+        else:
+            yield '', (), (), value
+
+
+class Registry:
+    '''
+    The metrics exposed on one /metrics route.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        '''
+        Expose a metric and return it.
+        '''
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''
+        Return every metric in the text exposition format.
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class Timed:
+    '''
+    Proxy of an API client that times every method call in a histogram
+    labelled with the method name.
+    '''
+
+    def __init__(self, client, histogram):
+        self.client = client
+        self.histogram = histogram
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+        return self.histogram.wrap(attribute, method=name)
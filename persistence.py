@@ -0,0 +1,158 @@
+'''
+Write-behind persistence for TarungBot
+'''
+
+import atexit
+import logging
+import signal
+import sys
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    '''
+    Background worker that saves dirty players outside the webhook request.
+
+    Player records are coalesced by player ID, so a player who answers many
+    times between two flushes is only written once. Other writes (e.g. the
+    tickets file) can be deferred with a key, and only the latest write for
+    each key is run. A flush happens every `interval` seconds, as soon as
+    `max_pending` writes are waiting, and on SIGTERM or interpreter exit.
+    '''
+
+    def __init__(self, storage, interval=5.0, max_pending=50):
+        self.storage = storage
+        self.interval = interval
+        self.max_pending = max_pending
+        self.records = {}
+        # IDs of the records being saved by the current flush.
+        self.saving = frozenset()
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.last_flush = time.time()
+        self.hooks = []
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='write-behind')
+
+    def start(self):
+        '''
+        Start the worker and flush on SIGTERM and at exit.
+        '''
+        self.thread.start()
+        atexit.register(self.flush)
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            self.flush()
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                sys.exit(0)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+    def add_hook(self, hook):
+        '''
+        Call hook(seconds, players) after every successful save, once the
+        saved players are no longer pending.
+        '''
+        self.hooks.append(hook)
+
+    def mark(self, player_id, record):
+        '''
+        Queue a player record to be saved.
+        '''
+        with self.lock:
+            self.records[player_id] = record
+            if self.depth_unlocked() >= self.max_pending:
+                self.wakeup.set()
+
+    def defer(self, key, func):
+        '''
+        Queue func to be called on the next flush, replacing any
+        pending call with the same key.
+        '''
+        with self.lock:
+            self.tasks[key] = func
+            if self.depth_unlocked() >= self.max_pending:
+                self.wakeup.set()
+
+    def pending(self, player_id):
+        '''
+        Check if a player's latest record hasn't been saved yet.
+        '''
+        with self.lock:
+            return player_id in self.records or player_id in self.saving
+
+    def depth_unlocked(self):
+        '''
+        Return the number of pending writes without taking the lock.
+        '''
+        return len(self.records) + len(self.tasks)
+
+    def depth(self):
+        '''
+        Return the number of pending writes.
+        '''
+        with self.lock:
+            return self.depth_unlocked()
+
+    def last_flush_age(self):
+        '''
+        Return the number of seconds since the last flush.
+        '''
+        return time.time() - self.last_flush
+
+    def flush(self):
+        '''
+        Write everything that is pending.
+        '''
+        with self.flush_lock:
+            with self.lock:
+                records, self.records = self.records, {}
+                tasks, self.tasks = self.tasks, {}
+                self.saving = frozenset(records)
+            try:
+                start = time.perf_counter()
+                if records:
+                    self.storage.save(records)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Saving %d players failed", len(records))
+                with self.lock:
+                    # Keep newer records that were marked in the meantime.
+                    records.update(self.records)
+                    self.records = records
+                    self.saving = frozenset()
+            else:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.saving = frozenset()
+                if records:
+                    for hook in self.hooks:
+                        try:
+                            hook(elapsed, len(records))
+                        except Exception:  # pylint: disable=broad-except
+                            LOGGER.exception("Save hook failed")
+            for key, func in tasks.items():
+                try:
+                    func()
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception("Deferred write %r failed", key)
+                    with self.lock:
+                        self.tasks.setdefault(key, func)
+            self.last_flush = time.time()
+
+    def run(self):
+        '''
+        Flush periodically or when too many writes are pending.
+        '''
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if self.depth():
+                self.flush()
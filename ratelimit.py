@@ -0,0 +1,138 @@
+'''
+Token bucket rate limiting
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    '''
+    Allows `rate` tokens per second on average, in bursts of up to
+    `capacity` tokens.
+    '''
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        '''
+        Add the tokens earned since the last refill. Call with the lock held.
+        '''
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost=1):
+        '''
+        Take cost tokens if there are enough. Return how many seconds to
+        wait before trying again, or 0 if the tokens were taken.
+        '''
+        with self.lock:
+            self.refill()
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return 0
+            return (cost - self.tokens) / self.rate
+
+    def acquire(self, cost=1, timeout=None):
+        '''
+        Wait until cost tokens can be taken, up to timeout seconds. Return
+        False if they couldn't.
+        '''
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            wait = self.take(cost)
+            if not wait:
+                return True
+            if deadline is not None and self.clock() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class RateLimiter:
+    '''
+    Token buckets by (scope, key), e.g. one per user and one per group,
+    with the rate and capacity of each scope in limits = {scope: (rate,
+    capacity)}.
+
+    At most `size` buckets are kept, least recently used dropped first, so
+    memory is bounded however many chats send messages. A dropped bucket
+    comes back full, which only favours chats that have been quiet the
+    longest.
+    '''
+
+    def __init__(self, limits, size=10000, clock=time.monotonic):
+        self.limits = limits
+        self.size = size
+        self.clock = clock
+        self.buckets = OrderedDict()
+        # Keys whose chats have been told they are throttled.
+        self.warned = set()
+        self.allowed = 0
+        self.throttled = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, scope, key):
+        '''
+        Return the bucket of a key, creating it if needed. Call with the
+        lock held.
+        '''
+        try:
+            bucket = self.buckets[scope, key]
+        except KeyError:
+            rate, capacity = self.limits[scope]
+            bucket = self.buckets[scope, key] = TokenBucket(
+                rate, capacity, clock=self.clock)
+            if len(self.buckets) > self.size:
+                dropped, _ = self.buckets.popitem(last=False)
+                self.warned.discard(dropped)
+        else:
+            self.buckets.move_to_end((scope, key))
+        return bucket
+
+    def check(self, keys, cost=1, name=None):
+        '''
+        Take cost tokens from the bucket of every (scope, key) pair, or
+        none if one of them is short. Return None if they were taken,
+        otherwise (scope, first), where first is True the first time the
+        chat is throttled since its bucket last had enough tokens. name
+        (e.g. the command) labels the throttled count.
+        '''
+        with self.lock:
+            buckets = [(scope, key, self.bucket(scope, key))
+                       for scope, key in keys]
+            for scope, key, bucket in buckets:
+                with bucket.lock:
+                    bucket.refill()
+                    short = bucket.tokens < min(cost, bucket.capacity)
+                if short:
+                    label = (scope, name)
+                    self.throttled[label] = self.throttled.get(label, 0) + 1
+                    first = (scope, key) not in self.warned
+                    self.warned.add((scope, key))
+                    return scope, first
+            for scope, key, bucket in buckets:
+                with bucket.lock:
+                    bucket.tokens -= min(cost, bucket.capacity)
+                self.warned.discard((scope, key))
+            self.allowed += 1
+            return None
+
+    def stats(self):
+        '''
+        Return how many requests were allowed and throttled, by scope.
+        '''
+        with self.lock:
+            throttled = {}
+            for (scope, _), count in self.throttled.items():
+                throttled[scope] = throttled.get(scope, 0) + count
+            return {'allowed': self.allowed, 'throttled': throttled,
+                    'buckets': len(self.buckets)}
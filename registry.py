@@ -0,0 +1,388 @@
+'''
+Thread-safe player registry
+'''
+
+import fcntl
+import os
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class PlayerLock:
+    '''
+    Reentrant lock of one player that knows whether it is held, so the
+    player isn't evicted while a thread is using it.
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.depth = 0
+
+    def acquire(self, blocking=True):
+        '''
+        Take the lock. Return False if not blocking and it is taken.
+        '''
+        if not self.lock.acquire(blocking):
+            return False
+        self.depth += 1
+        return True
+
+    def release(self):
+        '''
+        Release the lock.
+        '''
+        self.depth -= 1
+        self.lock.release()
+
+    def held(self):
+        '''
+        Check if any thread holds the lock.
+        '''
+        return self.depth > 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class PlayerRegistry:
+    '''
+    Mapping of chat IDs to players with a lock for each player.
+
+    Dictionary operations are safe to call from any thread. Anything that
+    reads and then changes a player (answering, restarting, ...) should
+    hold that player's lock:
+
+        with players.locked(player_id):
+            players[player_id].answer(name)
+
+    If load is given, players that aren't in memory are hydrated on demand
+    by calling load(player_id), which returns a Player or None.
+
+    With load, the registry can also act as a cache of at most `size`
+    players, evicting the least recently used ones and those unused for
+    `idle` seconds. Only players whose lock isn't held and for which
+    clean(player_id) is true (e.g. nothing is waiting to be saved) are
+    evicted; the others are checked again on a later eviction.
+    '''
+
+    def __init__(self, players=None, load=None, size=None, idle=None,
+                 clean=None, clock=time.monotonic):
+        self.players = OrderedDict(players or {})
+        self.load = load
+        self.size = size
+        self.idle = idle
+        self.clean = clean
+        self.clock = clock
+        self.used = {player_id: clock() for player_id in self.players}
+        self.lock = threading.Lock()
+        # Locks are dropped once no thread uses them.
+        self.locks = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def locked(self, player_id):
+        '''
+        Return the reentrant lock of a player, creating it if needed.
+        '''
+        with self.lock:
+            lock = self.locks.get(player_id)
+            if lock is None:
+                lock = self.locks[player_id] = PlayerLock()
+            return lock
+
+    def bounded(self):
+        '''
+        Check if players are ever evicted.
+        '''
+        return (self.load is not None and
+                (self.size is not None or self.idle is not None))
+
+    def touch(self, player_id):
+        '''
+        Mark a player in memory as just used. Call with the lock held.
+        '''
+        self.players.move_to_end(player_id)
+        self.used[player_id] = self.clock()
+
+    def add(self, player_id, player, replace=True):
+        '''
+        Put a player in memory and return the one kept. Call with the lock
+        held.
+        '''
+        if replace or player_id not in self.players:
+            self.players[player_id] = player
+        self.touch(player_id)
+        self.evict_unlocked(keep=player_id)
+        return self.players[player_id]
+
+    def evictable(self, player_id):
+        '''
+        Check if a player can be dropped from memory. Call with the lock
+        held.
+        '''
+        lock = self.locks.get(player_id)
+        if lock is not None and lock.held():
+            return False
+        return self.clean is None or self.clean(player_id)
+
+    def evict_unlocked(self, keep=None):
+        '''
+        Drop players over the size or idle for too long, least recently
+        used first, except keep. Call with the lock held.
+        '''
+        if not self.bounded():
+            return
+        expired = self.clock() - self.idle if self.idle is not None else None
+        # Players that can't be evicted yet go to the back, at most once.
+        for _ in range(len(self.players)):
+            player_id = next(iter(self.players))
+            over = self.size is not None and len(self.players) > self.size
+            if not over and (expired is None or
+                             self.used[player_id] > expired):
+                return
+            if player_id != keep and self.evictable(player_id):
+                del self.players[player_id]
+                del self.used[player_id]
+                self.evictions += 1
+            else:
+                self.players.move_to_end(player_id)
+
+    def evict(self):
+        '''
+        Drop players over the size or idle for too long, e.g. after a save
+        made them clean.
+        '''
+        with self.lock:
+            self.evict_unlocked()
+
+    def cached(self, player_id):
+        '''
+        Return a player if it is in memory, without loading it, or None.
+        '''
+        with self.lock:
+            return self.players.get(player_id)
+
+    def hydrate(self, player_id):
+        '''
+        Load a player that isn't in memory, returning None if unknown.
+        '''
+        with self.lock:
+            self.misses += 1
+        if self.load is None:
+            return None
+        player = self.load(player_id)
+        if player is None:
+            return None
+        with self.lock:
+            return self.add(player_id, player, replace=False)
+
+    def update(self, players):
+        '''
+        Add players loaded in bulk, keeping any that are already in memory.
+        '''
+        with self.lock:
+            for player_id, player in players.items():
+                self.add(player_id, player, replace=False)
+
+    def __getitem__(self, player_id):
+        with self.lock:
+            if player_id in self.players:
+                self.hits += 1
+                self.touch(player_id)
+                return self.players[player_id]
+        player = self.hydrate(player_id)
+        if player is None:
+            raise KeyError(player_id)
+        return player
+
+    def __setitem__(self, player_id, player):
+        with self.lock:
+            self.add(player_id, player)
+
+    def __contains__(self, player_id):
+        with self.lock:
+            if player_id in self.players:
+                self.hits += 1
+                self.touch(player_id)
+                return True
+        return self.hydrate(player_id) is not None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.players)
+
+    def __iter__(self):
+        # Iterate over a copy, so players can join while iterating.
+        with self.lock:
+            return iter(list(self.players))
+
+    def get(self, player_id, default=None):
+        '''
+        Return a player, or default if there is no such player.
+        '''
+        try:
+            return self[player_id]
+        except KeyError:
+            return default
+
+    def items(self):
+        '''
+        Return a list of (player_id, player) pairs.
+        '''
+        with self.lock:
+            return list(self.players.items())
+
+    def stats(self):
+        '''
+        Return the cache counters and how many players are in memory.
+        '''
+        with self.lock:
+            checked = self.hits + self.misses
+            return {'players': len(self.players), 'size': self.size,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': (round(self.hits / checked, 4)
+                                 if checked else 0.0)}
+
+
+class SharedPlayerRegistry(PlayerRegistry):
+    '''
+    Player registry shared by several worker processes through storage.
+
+    Holding a player's lock also holds a file lock that other processes
+    respect. The player is reloaded from storage when the lock is taken and
+    saved back when it is released if it changed, so every process sees
+    the others' changes. The question a process asked is kept across
+    reloads, as it isn't saved. Keys that aren't players (e.g. 'tickets')
+    can be locked too.
+
+    Iterating reloads only the players saved since the last iteration.
+    Players are saved whenever their lock is released, so like
+    PlayerRegistry it keeps at most `size` players in memory and drops
+    those unused for `idle` seconds, loading them again from storage.
+    '''
+
+    def __init__(self, storage, lock_dir, decode, stripes=64, size=None,
+                 idle=None):
+        super().__init__(load=self.load_saved, size=size, idle=idle)
+        self.storage = storage
+        self.lock_dir = lock_dir
+        self.decode = decode
+        self.stripes = stripes
+        self.held = threading.local()
+        # Storage version of the last refresh_all().
+        self.version = None
+        os.makedirs(lock_dir, exist_ok=True)
+
+    @contextmanager
+    def locked(self, player_id):
+        with super().locked(player_id):
+            ids = self.held.__dict__.setdefault('ids', set())
+            if player_id in ids:
+                yield
+                return
+            stripe = zlib.crc32(player_id.encode('utf-8')) % self.stripes
+            with self.file_lock(stripe):
+                ids.add(player_id)
+                try:
+                    loaded = self.refresh(player_id)
+                    yield
+                    player = self.get(player_id)
+                    if player is not None:
+                        record = player.toJSON()
+                        if record != loaded:
+                            self.storage.save({player_id: record})
+                finally:
+                    ids.discard(player_id)
+
+    @contextmanager
+    def file_lock(self, stripe):
+        '''
+        Hold one of the lock files, allowing the same thread to nest.
+        '''
+        held = self.held.__dict__.setdefault('stripes', {})
+        if held.get(stripe):
+            held[stripe] += 1
+            try:
+                yield
+            finally:
+                held[stripe] -= 1
+            return
+        path = os.path.join(self.lock_dir, '{}.lock'.format(stripe))
+        with open(path, 'a') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            held[stripe] = 1
+            try:
+                yield
+            finally:
+                held[stripe] = 0
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def load_saved(self, player_id):
+        '''
+        Return a player decoded from storage, or None if it isn't saved.
+        '''
+        record = self.storage.load_one(player_id)
+        return self.decode(record) if record is not None else None
+
+    def refresh(self, player_id):
+        '''
+        Reload a player from storage and return its record as the reloaded
+        player would save it, or None if it isn't saved.
+        '''
+        record = self.storage.load_one(player_id)
+        if record is None:
+            return None
+        player = self.reload(player_id, record)
+        return player.toJSON()
+
+    def reload(self, player_id, record):
+        '''
+        Replace a player with one decoded from its record, keeping the
+        question this process asked and the one it prepared next.
+        '''
+        player = self.decode(record)
+        old = self.cached(player_id)
+        if old is not None:
+            if old.pick == player.pick:
+                player.asked = old.asked
+            player.upcoming = old.upcoming
+        self[player_id] = player
+        return player
+
+    def __iter__(self):
+        self.refresh_all()
+        return super().__iter__()
+
+    def items(self):
+        self.refresh_all()
+        return super().items()
+
+    def refresh_all(self):
+        '''
+        Reload the players saved since the last call, except those that
+        are locked, and return them as (chat ID, player) pairs.
+        '''
+        held = self.held.__dict__.setdefault('ids', set())
+        records, self.version = self.storage.load_since(self.version)
+        reloaded = []
+        for player_id, record in records.items():
+            if player_id in held:
+                continue
+            lock = PlayerRegistry.locked(self, player_id)
+            if lock.acquire(blocking=False):
+                try:
+                    reloaded.append((player_id,
+                                     self.reload(player_id, record)))
+                finally:
+                    lock.release()
+        return reloaded
@@ -0,0 +1,175 @@
+'''
+Incremental roster updates from the game data folders on Dropbox
+'''
+
+import logging
+import threading
+
+import dropbox
+
+from game import Roster
+from images import GENDERS
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FolderListing:
+    '''
+    The names of the images in one Dropbox folder, kept up to date with a
+    list-folder cursor.
+
+    The first sync lists the whole folder, page by page. Later syncs only
+    fetch what changed since the cursor. If Dropbox resets the cursor, the
+    folder is listed again.
+    '''
+
+    def __init__(self, dbx, path):
+        self.dbx = dbx
+        self.path = path
+        self.names = set()
+        self.cursor = None
+
+    @staticmethod
+    def name(entry):
+        '''
+        Return the roster name of a folder entry.
+        '''
+        return entry.name.replace('.jpg', '')
+
+    def list_folder(self):
+        '''
+        Return the first page of a full listing.
+        '''
+        return self.dbx.files_list_folder(self.path)
+
+    def sync(self):
+        '''
+        Apply the changes since the last sync. Return True if any name was
+        added or removed.
+
+        Names and cursor are only updated once every page has arrived, so a
+        failed sync can simply be retried.
+        '''
+        if self.cursor is None:
+            names, result = set(), self.list_folder()
+        else:
+            names = set(self.names)
+            try:
+                result = self.dbx.files_list_folder_continue(self.cursor)
+            except dropbox.exceptions.ApiError as error:
+                LOGGER.warning("Listing %s again: %s", self.path, error)
+                names, result = set(), self.list_folder()
+        while True:
+            for entry in result.entries:
+                if isinstance(entry, dropbox.files.FileMetadata):
+                    names.add(self.name(entry))
+                elif isinstance(entry, dropbox.files.DeletedMetadata):
+                    names.discard(self.name(entry))
+            if not result.has_more:
+                break
+            result = self.dbx.files_list_folder_continue(result.cursor)
+        changed = names != self.names
+        self.names, self.cursor = names, result.cursor
+        return changed
+
+
+class RosterSync:
+    '''
+    The roster of the game data folders, with one FolderListing per
+    gender.
+
+    The cursors are kept in storage meta under key together with the
+    version of the roster they lead to, so a restarted bot only fetches
+    what changed while it was down.
+    '''
+    key = 'roster:sync'
+
+    def __init__(self, dbx, root, storage, key=key):
+        self.storage = storage
+        self.key = key
+        self.listings = {gender: FolderListing(dbx, root + '/' + gender)
+                         for gender in GENDERS}
+        self.saved = None
+        self.roster = None
+        self.lock = threading.Lock()
+
+    def restore(self):
+        '''
+        Resume from the saved cursors, if their roster is known. Call with
+        the lock held.
+        '''
+        state = self.storage.load_meta(self.key)
+        roster = Roster.find(state['version']) if state else None
+        if roster is None:
+            return
+        for gender, names in (('male', roster.guys),
+                              ('female', roster.gals)):
+            self.listings[gender].names = set(names)
+            self.listings[gender].cursor = state['cursors'][gender]
+        self.saved = state
+        self.roster = roster
+
+    def refresh(self):
+        '''
+        Fetch the changes to both folders and return the resulting roster.
+        The same roster is returned while nothing changes.
+        '''
+        with self.lock:
+            if self.saved is None and all(listing.cursor is None for
+                                          listing in self.listings.values()):
+                self.restore()
+            changed = [listing.sync() for listing in self.listings.values()]
+            if any(changed) or self.roster is None:
+                self.roster = Roster(self.listings['male'].names,
+                                     self.listings['female'].names)
+            return self.roster
+
+    def save(self, roster):
+        '''
+        Save the cursors leading to a roster. The roster itself must be
+        saved first.
+        '''
+        with self.lock:
+            state = {'version': roster.version,
+                     'cursors': {gender: listing.cursor for gender, listing
+                                 in self.listings.items()}}
+            if state == self.saved:
+                return
+            self.storage.save_meta(self.key, state)
+            self.saved = state
+
+
+class RosterPoller:
+    '''
+    Background thread calling update() every interval seconds, e.g. to
+    pick up new photos without a restart.
+    '''
+
+    def __init__(self, update, interval=300.0):
+        self.update = update
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='roster-sync')
+
+    def start(self):
+        '''
+        Start polling.
+        '''
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stop polling.
+        '''
+        self.stopped.set()
+
+    def run(self):
+        '''
+        Update until stopped, logging failures.
+        '''
+        while not self.stopped.wait(self.interval):
+            try:
+                self.update()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Roster sync failed")
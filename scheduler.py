@@ -0,0 +1,282 @@
+'''
+Question schedulers: which remaining roster entry to ask next
+'''
+
+import random
+import threading
+import weakref
+
+SCHEDULERS = ('uniform', 'spaced', 'difficulty')
+MISSED = ('wrong', 'skipped')
+
+
+class Fenwick:
+    '''
+    Binary indexed tree of non-negative weights.
+
+    Changing a weight and finding the entry at a cumulative weight are both
+    O(log n), so weighted random picks are too.
+    '''
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.tree = [0.0] + list(weights)
+        for index in range(1, self.size + 1):
+            parent = index + (index & -index)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[index]
+        self.weights = list(weights)
+
+    def total(self):
+        '''
+        Return the sum of every weight.
+        '''
+        index = self.size
+        total = 0.0
+        while index:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def set(self, index, weight):
+        '''
+        Change the weight of an entry.
+        '''
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        index += 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def find(self, value):
+        '''
+        Return the entry whose cumulative weight range contains value.
+        '''
+        index = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            child = index + step
+            if child <= self.size and self.tree[child] <= value:
+                index = child
+                value -= self.tree[child]
+            step >>= 1
+        return min(index, self.size - 1)
+
+
+class Scheduler:
+    '''
+    Uniformly random questions, as the game has always asked them.
+
+    Schedulers are shared by every player. answered() is called after
+    every counted answer, including answers replayed from the event log,
+    so any state a scheduler keeps in a player's data is replayed too.
+    '''
+
+    def seed(self, counts):
+        '''
+        Learn from past answers, given as {name: (asked, missed, ...)}
+        counts, e.g. from events.Difficulty.by_name().
+        '''
+
+    def waiting(self, player):
+        '''
+        Check if a player with no remaining entries still has questions
+        coming.
+        '''
+        return False
+
+    def pick(self, player):
+        '''
+        Return the next roster entry to ask a player about.
+        '''
+        return player.progress.choice()
+
+    def answered(self, player, verdict):
+        '''
+        Learn from a player's answer to their current pick.
+        '''
+
+    def ended(self, player):
+        '''
+        Forget what is still coming for a player whose game was ended.
+        '''
+
+
+class SpacedRepetition(Scheduler):
+    '''
+    Asks missed persons again later in the same game.
+
+    A missed person comes back after `delay` more questions, and after
+    twice as many each time it is missed again, up to `repeats` times.
+    Missed persons are kept in data['review'] as [question number, name,
+    times missed] lists, where the question number is None once the person
+    is back in play, so a player only needs memory for the persons they
+    missed.
+    '''
+
+    def __init__(self, delay=5, repeats=2):
+        self.delay = delay
+        self.repeats = repeats
+
+    @staticmethod
+    def asked(player):
+        '''
+        Return how many questions a player has answered this game.
+        '''
+        return sum(player.data[verdict] for verdict in
+                   ('exact', 'correct', 'partial', 'wrong', 'skipped'))
+
+    def waiting(self, player):
+        # Only persons still in the roster can be put back in play.
+        ids = player.progress.roster.ids
+        return any(item[0] is not None and item[1] in ids
+                   for item in player.data.get('review', ()))
+
+    def release(self, player):
+        '''
+        Put missed persons that are due back in play. Once everything else
+        has been asked, every missed person is due.
+        '''
+        asked = self.asked(player)
+        for item in list(player.data.get('review', ())):
+            if item[0] is not None and (item[0] <= asked or
+                                        not player.progress):
+                if item[1] in player.progress.roster.ids:
+                    item[0] = None
+                    player.progress.add(item[1])
+                else:
+                    player.data['review'].remove(item)
+
+    def pick(self, player):
+        # Persons back in play are asked first, and missed persons are
+        # all due once nothing else remains.
+        self.release(player)
+        for item in player.data.get('review', ()):
+            if item[0] is None and item[1] in player.progress:
+                return item[1]
+        return super().pick(player)
+
+    def answered(self, player, verdict):
+        review = player.data.setdefault('review', [])
+        item = next((item for item in review if item[1] == player.pick),
+                    None)
+        if verdict in MISSED and item is None:
+            item = [None, player.pick, 0]
+            review.append(item)
+        if verdict in MISSED and item[2] < self.repeats:
+            item[0] = self.asked(player) + self.delay * 2 ** item[2]
+            item[2] += 1
+        elif item is not None:
+            review.remove(item)
+        self.release(player)
+
+    def ended(self, player):
+        player.data.pop('review', None)
+
+
+class DifficultyWeighted(Scheduler):
+    '''
+    Asks persons that are often missed more often.
+
+    Each roster entry is weighted by its miss rate over every player,
+    smoothed towards the overall miss rate as if it had been asked `prior`
+    more times, and never below `floor`. Counts are seeded from the event
+    log and updated on every answer.
+
+    The weights live in one Fenwick tree per roster shared by every
+    player. A pick draws from the tree and retries if the entry isn't
+    remaining for the player; once less than half of the roster remains,
+    it draws from the player's remaining entries instead and keeps each
+    with probability equal to its weight. Both take O(log n) expected
+    time and no memory per player. A roster's tree is dropped along with
+    the roster once no player uses it.
+    '''
+
+    def __init__(self, prior=5, floor=0.05, tries=32):
+        self.prior = prior
+        self.floor = floor
+        self.tries = tries
+        self.asked = {}
+        self.missed = {}
+        self.total_asked = 0
+        self.total_missed = 0
+        self.trees = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def seed(self, counts):
+        with self.lock:
+            self.asked = {name: each[0] for name, each in counts.items()}
+            self.missed = {name: each[1] for name, each in counts.items()}
+            self.total_asked = sum(self.asked.values())
+            self.total_missed = sum(self.missed.values())
+            self.trees = weakref.WeakKeyDictionary()
+
+    def weight(self, name, overall):
+        '''
+        Return the weight of a roster entry. Call with the lock held.
+        '''
+        rate = ((self.missed.get(name, 0) + self.prior * overall) /
+                (self.asked.get(name, 0) + self.prior))
+        return min(1.0, max(self.floor, rate))
+
+    def tree(self, roster):
+        '''
+        Return the weights of a roster and the overall miss rate they were
+        computed with. Call with the lock held.
+
+        The overall miss rate is fixed when the tree is built, so an answer
+        only changes the weight of the person it was about.
+        '''
+        if roster not in self.trees:
+            overall = 0.5
+            if self.total_asked:
+                overall = self.total_missed / self.total_asked
+            self.trees[roster] = (Fenwick(
+                [self.weight(name, overall) for name in roster.names]),
+                                          overall)
+        return self.trees[roster]
+
+    def pick(self, player):
+        progress = player.progress
+        if not progress:
+            raise IndexError('No remaining entries')
+        with self.lock:
+            tree, _ = self.tree(progress.roster)
+            if 2 * len(progress) >= len(progress.roster):
+                total = tree.total()
+                for _ in range(self.tries):
+                    index = tree.find(random.random() * total)
+                    if progress.positions[index] != progress.missing:
+                        return progress.roster.names[index]
+            for _ in range(self.tries):
+                index = random.choice(progress.remaining)
+                if random.random() < tree.weights[index]:
+                    return progress.roster.names[index]
+        return progress.choice()
+
+    def answered(self, player, verdict):
+        name = player.pick
+        roster = player.progress.roster
+        with self.lock:
+            self.asked[name] = self.asked.get(name, 0) + 1
+            self.total_asked += 1
+            if verdict in MISSED:
+                self.missed[name] = self.missed.get(name, 0) + 1
+                self.total_missed += 1
+            if roster in self.trees and name in roster.ids:
+                tree, overall = self.trees[roster]
+                tree.set(roster.ids[name], self.weight(name, overall))
+
+
+def make(name):
+    '''
+    Return a new scheduler by name, one of SCHEDULERS.
+    '''
+    if name == 'spaced':
+        return SpacedRepetition()
+    if name == 'difficulty':
+        return DifficultyWeighted()
+    if name == 'uniform':
+        return Scheduler()
+    raise ValueError("Unknown scheduler: {}".format(name))
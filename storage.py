@@ -0,0 +1,549 @@
+'''
+Save backends for TarungBot player data
+'''
+
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+
+import dropbox
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Storage:
+    '''
+    Base class for player save backends.
+
+    A backend maps player IDs to the JSON-compatible records produced by
+    Player.toJSON(). Incremental backends can cheaply save a single player,
+    so the bot saves after every answer instead of every 10 answers.
+    Backends count the bytes they have written in `written`.
+    '''
+    incremental = False
+    written = 0
+
+    def load(self):
+        '''
+        Return a dictionary of every saved player record.
+        '''
+        raise NotImplementedError
+
+    def load_one(self, player_id):
+        '''
+        Return the saved record of a player, or None.
+        '''
+        return self.load().get(player_id)
+
+    def load_since(self, version):
+        '''
+        Return (records, version): the records saved since a version
+        returned by an earlier call, and the version to pass next time.
+        None returns every record. Backends that don't track changes
+        always return every record.
+        '''
+        return self.load(), None
+
+    def save(self, records):
+        '''
+        Save the given {player_id: record} dictionary.
+        '''
+        raise NotImplementedError
+
+    def load_meta(self, key):
+        '''
+        Return a saved non-player value (e.g. an old roster), or None.
+        '''
+        raise NotImplementedError
+
+    def save_meta(self, key, value):
+        '''
+        Save a JSON-compatible non-player value.
+        '''
+        raise NotImplementedError
+
+    def load_tickets(self):
+        '''
+        Return the saved /msg messages as {ticket ID: text}.
+        '''
+        raise NotImplementedError
+
+    def save_tickets(self, changes):
+        '''
+        Save {ticket ID: text, or None to remove it}.
+        '''
+        raise NotImplementedError
+
+    def export(self, dbx, path):
+        '''
+        Upload a snapshot of every saved player to Dropbox.
+        '''
+        dbx.files_upload(json.dumps(self.load(), indent=4).encode('utf-8'),
+                         path, dropbox.files.WriteMode.overwrite)
+
+
+class DropboxStorage(Storage):
+    '''
+    Single JSON file on Dropbox, rewritten as a whole on every save.
+
+    Other values are kept in a second file next to it, e.g. save.meta.json.
+    '''
+
+    def __init__(self, dbx, path):
+        self.dbx = dbx
+        self.path = path
+        self.meta_path = os.path.splitext(path)[0] + '.meta.json'
+        self.records = None
+        self.meta = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        records = json.loads(self.dbx.files_download(self.path)[1]
+                             .content.decode('utf-8'))
+        with self.lock:
+            if self.records is None:
+                self.records = records
+            else:
+                # Keep records saved since the download started.
+                records.update(self.records)
+                self.records = records
+            return dict(self.records)
+
+    def load_one(self, player_id):
+        if self.records is None:
+            self.load()
+        return self.records.get(player_id)
+
+    def save(self, records):
+        if self.records is None:
+            self.load()
+        with self.lock:
+            self.records.update(records)
+            content = json.dumps(self.records, indent=4).encode('utf-8')
+            self.written += len(content)
+        self.dbx.files_upload(content, self.path,
+                              dropbox.files.WriteMode.overwrite)
+
+    def load_meta(self, key):
+        with self.lock:
+            if self.meta is None:
+                try:
+                    self.meta = json.loads(
+                        self.dbx.files_download(self.meta_path)[1]
+                        .content.decode('utf-8'))
+                except dropbox.exceptions.ApiError:
+                    self.meta = {}
+            return self.meta.get(key)
+
+    def save_meta(self, key, value):
+        self.load_meta(key)
+        with self.lock:
+            self.meta[key] = value
+            content = json.dumps(self.meta).encode('utf-8')
+            self.written += len(content)
+        self.dbx.files_upload(content, self.meta_path,
+                              dropbox.files.WriteMode.overwrite)
+
+
+class SQLiteStorage(Storage):
+    '''
+    Local SQLite database with one row per player.
+
+    Each save gives the saved rows the next change version, so processes
+    sharing the database can load only the players changed since they last
+    looked.
+    '''
+    incremental = True
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS players '
+                          '(id TEXT PRIMARY KEY, record TEXT NOT NULL, '
+                          'version INTEGER NOT NULL DEFAULT 0)')
+        columns = [row[1] for row in
+                   self.conn.execute('PRAGMA table_info(players)')]
+        if 'version' not in columns:
+            self.conn.execute('ALTER TABLE players ADD COLUMN '
+                              'version INTEGER NOT NULL DEFAULT 0')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS players_version '
+                          'ON players (version)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                          '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS tickets '
+                          '(id INTEGER PRIMARY KEY, text TEXT NOT NULL)')
+        self.conn.commit()
+
+    def load(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT id, record FROM players')
+            return {row[0]: json.loads(row[1]) for row in rows}
+
+    def load_one(self, player_id):
+        with self.lock:
+            row = self.conn.execute('SELECT record FROM players WHERE id = ?',
+                                    (player_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_since(self, version):
+        latest = -1 if version is None else version
+        with self.lock:
+            rows = self.conn.execute('SELECT id, record, version FROM players '
+                                     'WHERE version > ?', (latest,))
+            records = {}
+            for player_id, record, changed in rows:
+                records[player_id] = json.loads(record)
+                latest = max(latest, changed)
+        return records, latest
+
+    def save(self, records):
+        rows = [(player_id, json.dumps(record, separators=(',', ':')))
+                for player_id, record in records.items()]
+        with self.lock, self.conn:
+            # Writers are serialized, so versions grow in commit order.
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO players (id, record, version) '
+                'VALUES (?, ?, (SELECT COALESCE(MAX(version), 0) + 1 '
+                'FROM players))', rows)
+            self.written += sum(len(row[1]) for row in rows)
+
+    def load_meta(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?',
+                                    (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) '
+                              'VALUES (?, ?)', (key, json.dumps(value)))
+
+    def load_tickets(self):
+        with self.lock:
+            return dict(self.conn.execute('SELECT id, text FROM tickets'))
+
+    def save_tickets(self, changes):
+        added = [(key, text) for key, text in changes.items()
+                 if text is not None]
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM tickets WHERE id = ?',
+                                  [(key,) for key, text in changes.items()
+                                   if text is None])
+            self.conn.executemany('INSERT OR REPLACE INTO tickets (id, text) '
+                                  'VALUES (?, ?)', added)
+            self.written += sum(len(text) for _, text in added)
+
+
+def diff(old, new):
+    '''
+    Return a JSON merge patch (RFC 7386) that turns old into new.
+
+    Records must not contain nulls, as a null in a patch removes a key.
+    '''
+    patch = {key: None for key in old if key not in new}
+    for key, value in new.items():
+        if (key in old and isinstance(value, dict) and
+                isinstance(old[key], dict)):
+            inner = diff(old[key], value)
+            if inner:
+                patch[key] = inner
+        elif key not in old or old[key] != value:
+            patch[key] = value
+    return patch
+
+
+def apply_patch(target, patch):
+    '''
+    Apply a JSON merge patch to a dictionary in place.
+    '''
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            apply_patch(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+class LogStorage(Storage):
+    '''
+    Local snapshot file plus an append-only log of changes.
+
+    Both files are JSON lines, each prefixed with the CRC32 of its JSON, and
+    start with a header holding the format version. The log holds a merge
+    patch of each saved player against its previous record, so an answer
+    appends a few dozen bytes instead of rewriting every player. Once the
+    log outgrows compact_ratio times the snapshot (and at least
+    compact_size bytes), the snapshot is rewritten and the log emptied.
+    Added and removed /msg messages are logged one entry each.
+
+    Records are kept in memory as compact JSON text, so every load returns
+    fresh copies. Loading replays the snapshot and then the log. Replaying
+    is idempotent, so a crash between replacing the snapshot and emptying
+    the log loses nothing. A torn last line of the log (a write cut short)
+    is ignored, and the files are compacted right away so later writes
+    aren't appended after it. A file without its header is replayed and
+    then compacted the same way. Any other line with a bad checksum is
+    skipped, and its file is kept as a .corrupt backup before compacting.
+    '''
+    incremental = True
+    version = 1
+
+    def __init__(self, path, compact_ratio=1.0, compact_size=1 << 20):
+        self.path = path
+        self.log_path = path + '.log'
+        self.compact_ratio = compact_ratio
+        self.compact_size = compact_size
+        self.records = None
+        self.meta = {}
+        self.tickets = {}
+        self.log = None
+        self.snapshot_size = 0
+        self.written = 0
+        self.compactions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def dumps(record):
+        '''
+        Return a record as compact JSON text.
+        '''
+        return json.dumps(record, separators=(',', ':'))
+
+    @staticmethod
+    def encode(entry):
+        '''
+        Return an entry as a checksummed line.
+        '''
+        text = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+        return b'%08x %s\n' % (zlib.crc32(text), text)
+
+    @staticmethod
+    def decode(line):
+        '''
+        Return the entry of a checksummed line. Raise ValueError if it is
+        damaged.
+        '''
+        if not line.endswith(b'\n') or line[8:9] != b' ':
+            raise ValueError('Truncated line')
+        text = line[9:-1]
+        if int(line[:8], 16) != zlib.crc32(text):
+            raise ValueError('Checksum mismatch')
+        return json.loads(text.decode('utf-8'))
+
+    def header(self, kind):
+        '''
+        Return the first line of a snapshot or log file.
+        '''
+        return self.encode({'format': 'tarungbot', 'version': self.version,
+                            'kind': kind})
+
+    def replay(self, path, log=False):
+        '''
+        Apply the entries of a file. Return 'intact', 'rewrite' if its
+        header is missing or it is the log and its last line is torn, or
+        'corrupt' if any other line was damaged and skipped.
+        '''
+        try:
+            handle = open(path, 'rb')
+        except FileNotFoundError:
+            return 'intact'
+        state = 'intact'
+        with handle:
+            line = handle.readline()
+            number = 0
+            while line:
+                following = handle.readline()
+                number += 1
+                try:
+                    entry = self.decode(line)
+                except ValueError as error:
+                    if log and not following:
+                        LOGGER.warning("%s line %d: %s, ignoring the torn "
+                                       "last line", path, number, error)
+                        state = 'rewrite' if state == 'intact' else state
+                    else:
+                        LOGGER.error("%s line %d: %s, skipping it",
+                                     path, number, error)
+                        state = 'corrupt'
+                    line = following
+                    continue
+                line = following
+                if number == 1 and 'format' in entry:
+                    if entry.get('version') != self.version:
+                        raise ValueError('Unsupported save format: {}'
+                                         .format(entry))
+                    continue
+                if number == 1:
+                    LOGGER.warning("%s has no header", path)
+                    state = 'rewrite' if state == 'intact' else state
+                if 'meta' in entry:
+                    self.meta[entry['meta']] = entry['value']
+                elif 'ticket' in entry:
+                    if entry['text'] is None:
+                        self.tickets.pop(entry['ticket'], None)
+                    else:
+                        self.tickets[entry['ticket']] = entry['text']
+                elif 'patch' in entry:
+                    if entry['id'] in self.records:
+                        apply_patch(self.records[entry['id']],
+                                    entry['patch'])
+                    else:
+                        LOGGER.warning("%s line %d: no record of %s to "
+                                       "patch", path, number, entry['id'])
+                else:
+                    self.records[entry['id']] = entry['record']
+        return state
+
+    @staticmethod
+    def back_up(path):
+        '''
+        Move a damaged file aside as a .corrupt backup, never replacing an
+        earlier one.
+        '''
+        backup = path + '.corrupt'
+        copies = 0
+        while os.path.exists(backup):
+            copies += 1
+            backup = '{}.corrupt.{}'.format(path, copies)
+        os.replace(path, backup)
+        LOGGER.error("Kept the damaged %s as %s", path, backup)
+
+    def open(self):
+        '''
+        Load both files and open the log, once. Call with the lock held.
+
+        The log is replayed even if the snapshot is damaged, so whatever it
+        holds is kept when both are rewritten.
+        '''
+        if self.records is not None:
+            return
+        self.records = {}
+        states = {self.path: self.replay(self.path),
+                  self.log_path: self.replay(self.log_path, log=True)}
+        self.records = {player_id: self.dumps(record)
+                        for player_id, record in self.records.items()}
+        for path, state in states.items():
+            if state == 'corrupt':
+                self.back_up(path)
+        if (set(states.values()) == {'intact'} and
+                os.path.exists(self.path) and os.path.exists(self.log_path)):
+            self.snapshot_size = os.path.getsize(self.path)
+            self.log = open(self.log_path, 'ab')
+            if not self.log.tell():
+                self.start_log()
+        else:
+            self.compact()
+
+    def start_log(self):
+        '''
+        Write and sync the header of an empty log. Call with the lock held.
+        '''
+        self.log.write(self.header('log'))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.written += self.log.tell()
+
+    def append(self, entries):
+        '''
+        Append entries to the log and compact if it grew too large. Call
+        with the lock held.
+        '''
+        content = b''.join(self.encode(entry) for entry in entries)
+        self.log.write(content)
+        self.log.flush()
+        self.written += len(content)
+        os.fsync(self.log.fileno())
+        if self.log.tell() > max(self.compact_size,
+                                 self.compact_ratio * self.snapshot_size):
+            self.compact()
+
+    def compact(self):
+        '''
+        Rewrite the snapshot from memory and empty the log. Call with the
+        lock held.
+        '''
+        with open(self.path + '.tmp', 'wb') as handle:
+            handle.write(self.header('snapshot'))
+            for key, value in self.meta.items():
+                handle.write(self.encode({'meta': key, 'value': value}))
+            for key, text in self.tickets.items():
+                handle.write(self.encode({'ticket': key, 'text': text}))
+            for player_id, record in self.records.items():
+                handle.write(self.encode({'id': player_id,
+                                          'record': json.loads(record)}))
+            handle.flush()
+            os.fsync(handle.fileno())
+            self.snapshot_size = handle.tell()
+        os.replace(self.path + '.tmp', self.path)
+        if self.log is not None:
+            self.log.close()
+        self.log = open(self.log_path, 'wb')
+        self.start_log()
+        self.written += self.snapshot_size
+        self.compactions += 1
+
+    def load(self):
+        with self.lock:
+            self.open()
+            records = dict(self.records)
+        return {player_id: json.loads(record)
+                for player_id, record in records.items()}
+
+    def load_one(self, player_id):
+        with self.lock:
+            self.open()
+            record = self.records.get(player_id)
+        return json.loads(record) if record is not None else None
+
+    def save(self, records):
+        entries = []
+        with self.lock:
+            self.open()
+            for player_id, record in records.items():
+                text = self.dumps(record)
+                old = self.records.get(player_id)
+                if old is None:
+                    entries.append({'id': player_id, 'record': record})
+                elif old != text:
+                    patch = diff(json.loads(old), record)
+                    if patch:
+                        entries.append({'id': player_id, 'patch': patch})
+                self.records[player_id] = text
+            if entries:
+                self.append(entries)
+
+    def load_meta(self, key):
+        with self.lock:
+            self.open()
+            return copy.deepcopy(self.meta.get(key))
+
+    def save_meta(self, key, value):
+        with self.lock:
+            self.open()
+            self.meta[key] = copy.deepcopy(value)
+            self.append([{'meta': key, 'value': value}])
+
+    def load_tickets(self):
+        with self.lock:
+            self.open()
+            return dict(self.tickets)
+
+    def save_tickets(self, changes):
+        with self.lock:
+            self.open()
+            for key, text in changes.items():
+                if text is None:
+                    self.tickets.pop(key, None)
+                else:
+                    self.tickets[key] = text
+            self.append([{'ticket': key, 'text': text}
+                         for key, text in changes.items()])
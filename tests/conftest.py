@@ -0,0 +1,112 @@
+'''
+The bot running in this process against local fakes of LINE and Dropbox
+'''
+
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# pylint: disable=wrong-import-position
+from fakes import (  # noqa: E402
+    FakeDropbox, FakeDropboxServer, FakeLineServer, bot_env, fake_roster,
+    game_files, webhook)
+
+SECRET = 'test-secret'
+
+
+def pytest_configure(config):
+    '''
+    Hide the line-bot-sdk warnings about its v3 API, which the bot doesn't
+    use yet.
+    '''
+    config.addinivalue_line(
+        'filterwarnings', 'ignore::linebot.LineBotSdkDeprecatedIn30')
+
+
+class Bot:
+    '''
+    The imported app module, its fake LINE server and the roster it plays.
+
+    Webhooks are signed and posted through Flask's test client, each with
+    its own reply token and event ID.
+    '''
+
+    def __init__(self, app, line, roster):
+        self.app = app
+        self.line = line
+        self.roster = roster
+        self.tokens = itertools.count(1)
+
+    @staticmethod
+    def user(user_id):
+        '''
+        Return the webhook source of a 1:1 chat.
+        '''
+        return {'type': 'user', 'userId': user_id}
+
+    @staticmethod
+    def group(group_id, user_id):
+        '''
+        Return the webhook source of a group member.
+        '''
+        return {'type': 'group', 'groupId': group_id, 'userId': user_id}
+
+    def post(self, text, source, client=None):
+        '''
+        Post a text message and return the HTTP status code.
+        '''
+        body, signature = webhook(SECRET, text, source, next(self.tokens))
+        client = client or self.app.app.test_client()
+        return client.post(
+            '/callback', data=body.encode('utf-8'),
+            headers={'Content-Type': 'application/json',
+                     'X-Line-Signature': signature}).status_code
+
+    def wait(self, count, timeout=30):
+        '''
+        Wait until count messages have been sent and return them all.
+        '''
+        deadline = time.time() + timeout
+        while len(self.line.sent) < count and time.time() < deadline:
+            time.sleep(0.005)
+        return list(self.line.sent)
+
+    def say(self, text, source):
+        '''
+        Post a text message and return the texts and image links of its
+        reply.
+        '''
+        sent = len(self.line.sent)
+        assert self.post(text, source) == 200
+        _, _, messages = self.wait(sent + 1)[sent]
+        return [message.get('text') or message.get('originalContentUrl')
+                for message in messages]
+
+
+@pytest.fixture(scope='session')
+def bot():
+    '''
+    Import the bot once, with webhook workers and SQLite storage.
+    '''
+    import dropbox
+
+    roster = fake_roster(400)
+    fake = FakeDropbox(game_files(roster))
+    with FakeLineServer() as line, FakeDropboxServer() as links, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(bot_env(SECRET, line, links))
+        os.environ.update({'SQLITE_PATH': os.path.join(tmp, 'save.db'),
+                           'WEBHOOK_WORKERS': '4', 'LINE_RATE': '100000'})
+        dropbox.Dropbox = lambda *args, **kwargs: fake
+        import app
+
+        assert app.loaded.wait(60), app.startup['error']
+        yield Bot(app, line, roster)
+        app.writer.flush()
@@ -0,0 +1,74 @@
+'''
+The commands the bot's router picks for messages
+'''
+
+import pytest
+
+# (message, command for players, command for admins); 'answer' for
+# guesses and None for messages that aren't commands.
+DISPATCH = [
+    ('/', 'next', 'next'),
+    ('/n', 'next', 'next'),
+    ('/next', 'next', 'next'),
+    ('/ ', 'next', 'next'),
+    ('/next one', 'answer', 'answer'),
+    ('/man', 'man', 'man'),
+    ('/manual', 'answer', 'answer'),
+    ('/about', 'about', 'about'),
+    ('/aboutme', 'about', 'about'),
+    ('/info', 'info', 'info'),
+    ('/help', 'help', 'help'),
+    ('/bye', 'bye', 'bye'),
+    ('/start', 'start', 'start'),
+    ('/Starting', 'start', 'start'),
+    ('/restart', 'restart', 'restart'),
+    ('/a Budi', 'answer', 'answer'),
+    ('/answer budi santoso', 'answer', 'answer'),
+    ('/answer', 'answer', 'answer'),
+    ('/A budi', 'answer', 'answer'),
+    ('/pass', 'pass', 'pass'),
+    ('/p', 'pass', 'pass'),
+    ('/p later', 'pass', 'pass'),
+    ('/pa', 'answer', 'answer'),
+    ('/end', 'end', 'end'),
+    ('/endgame', 'end', 'end'),
+    ('/name Budi', 'name', 'name'),
+    ('/name', 'answer', 'answer'),
+    ('/stats', 'stats', 'stats'),
+    ('/lead', 'lead', 'lead'),
+    ('/lead daily groups', 'lead', 'lead'),
+    ('/leaderboard', 'lead', 'lead'),
+    ('/msg hi there', 'msg', 'msg'),
+    ('/msg', 'answer', 'answer'),
+    ('/roster', 'roster', 'roster'),
+    ('/roster y2018', 'roster', 'roster'),
+    ('/tix', 'answer', 'tix'),
+    ('/rtix 2', 'answer', 'rtix'),
+    ('/set Budi', 'answer', 'set'),
+    ('/export', 'answer', 'export'),
+    ('/reload', 'answer', 'reload'),
+    ('/cname U1 Budi', 'answer', 'cname'),
+    ('/hardest', 'answer', 'hardest'),
+    ('/tarung', 'tarung', 'tarung'),
+    ('/tarung2017', 'tarung2017', 'tarung2017'),
+    ('/tarung 2017', 'answer', 'answer'),
+    ('/budi', 'answer', 'answer'),
+    ('/Siti Aminah', 'answer', 'answer'),
+    ('hello', None, None),
+    ('good game', None, None),
+]
+
+
+@pytest.mark.parametrize('text,player,admin', DISPATCH)
+def test_dispatch(bot, text, player, admin):
+    for is_admin, expected in ((False, player), (True, admin)):
+        command, _ = bot.app.router.resolve(text, is_admin)
+        assert (command.name if command else None) == expected
+
+
+def test_replies_in_a_private_chat(bot):
+    source = bot.user('U{:032x}'.format(2))
+    *_, photo, question = bot.say('/start', source)
+    assert photo.startswith('http') and question == 'Who is this person?'
+    assert 'Remember' in bot.say('/pass', source)[0]
+    assert bot.say('/end', source)
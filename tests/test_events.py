@@ -0,0 +1,54 @@
+'''
+Reading answers back from the event log
+'''
+
+import pytest
+
+import events
+from game import Player, Roster
+
+
+@pytest.fixture(params=['numpy', 'slow'])
+def log(request, tmp_path, monkeypatch):
+    '''
+    An event log with an answer to a name missing from its roster, read
+    with and without NumPy.
+    '''
+    if request.param == 'slow':
+        monkeypatch.setattr(events, 'numpy', None)
+    elif events.numpy is None:
+        pytest.skip('NumPy is not installed')
+    roster = Roster(['Budi Santoso', 'Agus Salim'], ['Siti Aminah'])
+    monkeypatch.setattr(Player, 'roster', roster)
+    log = events.EventLog(str(tmp_path))
+    log.record('U1', 'start')
+    log.record('U1', 'wrong', 'Budi Santoso', 'agus', 2.0)
+    log.record('U1', 'skipped', 'Nobody Here', 'pass', 1.0)
+    log.flush()
+    return log
+
+
+def test_unknown_name_is_not_counted(log):
+    counts = events.difficulty(log.directory).by_name()
+    assert counts == {'Budi Santoso': (1, 1, 2.0, 1)}
+
+
+def test_unknown_name_is_not_replayed(log):
+    player = events.replay(log.directory)['U1']
+    assert player.data['wrong'] == 1 and player.data['skipped'] == 0
+
+
+def test_answer_is_logged_on_its_progress_roster(tmp_path, monkeypatch):
+    old = Roster(['Budi Santoso', 'Agus Salim'], ['Siti Aminah'])
+    monkeypatch.setattr(Player, 'roster', old)
+    player = Player()
+    player.next_pick()
+    player.answer('pass')
+    # The roster changed after the answer was judged.
+    monkeypatch.setattr(Player, 'roster', Roster(['Agus Salim'], []))
+    log = events.EventLog(str(tmp_path))
+    log.answered('U1', player)
+    log.flush()
+    (_, _, version, entry, kind, _, _), = events.events(log.directory)
+    assert version == old.version and kind == 'skipped'
+    assert old.names[entry] == player.pick
@@ -0,0 +1,66 @@
+'''
+Verdicts of the answer matcher
+'''
+
+import pytest
+
+from fakes import fake_roster
+from game import Roster
+
+# (roster entry, answer, expected verdict)
+GOLDEN_ANSWERS = [
+    ('Fatih Al-Mutawakkil', 'fatih al-mutawakkil', 'exact'),
+    ('Fatih Al-Mutawakkil', 'fati', 'correct'),
+    ('Fatih Al-Mutawakkil', 'atih', 'correct'),
+    ('Fatih Al-Mutawakkil', 'fatih a', 'correct'),
+    ('Fatih Al-Mutawakkil', 'ati al-mut', 'correct'),
+    ('Fatih Al-Mutawakkil', 'kkil', 'correct'),
+    ('Fatih Al-Mutawakkil', 'fatih al-muttaqin', 'partial'),
+    ('Fatih Al-Mutawakkil', 'budi', 'wrong'),
+    ('Fatih Al-Mutawakkil', 'fa', 'vague'),
+    ('Fatih Al-Mutawakkil', 'mutawakil', 'correct'),
+    ('Fatih Al-Mutawakkil', 'fatih mutawakil', 'correct'),
+    ('Muhammad Naufal Rizky', 'muhammad', 'vague'),
+    ('Muhammad Naufal Rizky', 'muhammad naufal', 'vague'),
+    ('Muhammad Naufal Rizky', 'muhammad naufal rizky', 'exact'),
+    ('Muhammad Naufal Rizky', 'rizky', 'correct'),
+    ('Muhammad Naufal Rizky', 'muhammad rizki', 'correct'),
+    ('Muhammad Naufal Rizky', 'muhammad budi', 'partial'),
+    ('Budi Santoso', 'budi', 'correct'),
+    ('Budi Santoso', 'bud', 'correct'),
+    ('Budi Santoso', 'santosa', 'correct'),
+    ('Budi Santoso', 'sandi', 'wrong'),
+    ('Budi Santoso', 'budi santoso', 'exact'),
+    ('Andrés Wijaya', 'andres wijaya', 'exact'),
+    ('Andrés Wijaya', 'andrés', 'correct'),
+    ('Siti Nurhaliza', 'nurhaliza siti', 'correct'),
+    ('Siti Nurhaliza', 'nur', 'correct'),
+    ('Siti Nurhaliza', 'xyz', 'wrong'),
+]
+
+
+@pytest.fixture(scope='module')
+def roster():
+    '''
+    The golden names among a generated roster.
+    '''
+    names = sorted({pick for pick, _, _ in GOLDEN_ANSWERS})
+    return Roster(names + fake_roster(400), [])
+
+
+@pytest.mark.parametrize('pick,answer,expected', GOLDEN_ANSWERS)
+def test_golden_answers(roster, pick, answer, expected):
+    assert roster.matcher.judge(answer, roster.ids[pick]) == expected
+
+
+def test_shared_name_is_specific_in_a_small_roster():
+    roster = Roster(['Budi Santoso', 'Budi Hartono', 'Agus Salim'], [])
+    assert 'budi' not in roster.matcher.common_tokens
+    assert roster.matcher.judge('budi', roster.ids['Budi Santoso']) == \
+        'correct'
+
+
+def test_common_name_in_a_large_roster():
+    names = ['Wibowo ' + name for name in fake_roster(200)]
+    roster = Roster(names + ['Budi Santoso'], [])
+    assert roster.matcher.judge('wibowo', roster.ids[names[0]]) == 'vague'
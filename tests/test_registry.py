@@ -0,0 +1,31 @@
+'''
+Players kept in memory by the registries
+'''
+
+from game import Player
+from registry import SharedPlayerRegistry
+from storage import SQLiteStorage
+
+
+def test_shared_registry_keeps_cache_size(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / 'save.db'))
+    storage.save({'U{}'.format(i): Player(name='Player{}'.format(i)).toJSON()
+                  for i in range(5)})
+    players = SharedPlayerRegistry(storage, str(tmp_path / 'locks'),
+                                   Player.fromJSON, size=2)
+    assert len(players.refresh_all()) == 5
+    assert len(players) == 2
+    # Evicted players are loaded again from storage.
+    assert players['U0'].name == 'Player0'
+    with players.locked('U1'):
+        players['U1'].name = 'Renamed'
+    assert len(players) == 2
+    assert storage.load_one('U1')['name'] == 'Renamed'
+
+
+def test_cached_players_are_the_kept_ones(bot):
+    chat = 'U{:032x}'.format(6)
+    bot.say('/start', bot.user(chat))
+    kept = bot.app.players[chat]
+    (each, player), = bot.app.cache_players({chat: kept.toJSON()})
+    assert each == chat and player is kept
@@ -0,0 +1,69 @@
+'''
+Questions of missed persons coming back with the spaced scheduler
+'''
+
+import pytest
+
+from game import Player, Roster
+from scheduler import SpacedRepetition
+
+
+@pytest.fixture
+def spaced(monkeypatch):
+    '''
+    Ask every player with the spaced scheduler.
+    '''
+    monkeypatch.setattr(Player, 'scheduler', SpacedRepetition())
+
+
+@pytest.fixture
+def roster(monkeypatch):
+    '''
+    Play a roster of three persons.
+    '''
+    monkeypatch.setattr(Player, 'roster', Roster(['Budi Santoso',
+                                                  'Agus Salim'],
+                                                 ['Siti Aminah']))
+
+
+def test_missed_person_comes_back_last(spaced, roster):
+    player = Player()
+    asked = []
+    while not player.finished():
+        asked.append(player.next_pick())
+        player.answer('pass' if len(asked) == 1 else player.pick.lower())
+    assert len(asked) == 4 and asked[-1] == asked[0]
+
+
+def test_ended_game_has_nothing_coming(spaced, roster):
+    player = Player()
+    player.next_pick()
+    player.answer('pass')
+    player.end()
+    assert player.finished()
+    assert 'review' not in player.data
+
+
+def test_removed_person_is_not_waiting(spaced, roster, monkeypatch):
+    player = Player()
+    missed = player.next_pick()
+    player.answer('pass')
+    while player.progress:
+        player.next_pick()
+        player.answer(player.pick.lower())
+    names = [name for name in Player.roster.names if name != missed]
+    monkeypatch.setattr(Player, 'roster', Roster(names, []))
+    player.sync_roster()
+    assert player.finished()
+
+
+@pytest.mark.parametrize('user,command', [(3, '/end'), (4, '/restart')])
+def test_start_after_passing(bot, spaced, user, command):
+    source = bot.user('U{:032x}'.format(user))
+    bot.say('/start', source)
+    bot.say('/pass', source)
+    bot.say(command, source)
+    *_, photo, question = bot.say('/start', source)
+    assert photo.startswith('http') and question == 'Who is this person?'
+    *_, photo, question = bot.say('/pass', source)
+    assert photo.startswith('http') and question == 'Who is this person?'
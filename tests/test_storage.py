@@ -0,0 +1,65 @@
+'''
+Loading LogStorage files with damaged lines
+'''
+
+import os
+
+import pytest
+
+from storage import LogStorage
+
+
+@pytest.fixture
+def saved(tmp_path):
+    '''
+    A snapshot of three players and a log of changes to two of them.
+    '''
+    path = str(tmp_path / 'save.jsonl')
+    storage = LogStorage(path)
+    storage.save({chat: {'score': 0} for chat in ('U1', 'U2', 'U3')})
+    storage.compact()
+    for score in (1, 2, 3):
+        storage.save({'U1': {'score': score}, 'U3': {'score': score}})
+    storage.log.close()
+    return path
+
+
+def damage(path, number, torn=False):
+    '''
+    Flip a byte in a line of a file, or cut the line short.
+    '''
+    with open(path, 'rb') as handle:
+        lines = handle.readlines()
+    line = lines[number]
+    lines[number] = line[:len(line) // 2] if torn else line[:-2] + b'#\n'
+    with open(path, 'wb') as handle:
+        handle.writelines(lines)
+
+
+def test_bad_snapshot_line_is_skipped_and_kept(saved):
+    damage(saved, 2)
+    assert LogStorage(saved).load() == {'U1': {'score': 3},
+                                        'U3': {'score': 3}}
+    assert os.path.exists(saved + '.corrupt')
+    # The rewritten snapshot loads cleanly.
+    assert LogStorage(saved).load() == {'U1': {'score': 3},
+                                        'U3': {'score': 3}}
+    assert not os.path.exists(saved + '.corrupt.1')
+
+
+def test_bad_log_line_is_skipped_and_kept(saved):
+    damage(saved + '.log', 1)
+    assert LogStorage(saved).load() == {'U1': {'score': 3},
+                                        'U2': {'score': 0},
+                                        'U3': {'score': 3}}
+    assert os.path.exists(saved + '.log.corrupt')
+    assert not os.path.exists(saved + '.corrupt')
+
+
+def test_torn_last_log_line_is_dropped(saved):
+    damage(saved + '.log', -1, torn=True)
+    assert LogStorage(saved).load() == {'U1': {'score': 3},
+                                        'U2': {'score': 0},
+                                        'U3': {'score': 2}}
+    assert not os.path.exists(saved + '.log.corrupt')
+    assert LogStorage(saved).load()['U3'] == {'score': 2}
@@ -0,0 +1,70 @@
+'''
+Answers from one group arriving on many threads at once
+'''
+
+import random
+import re
+import threading
+from urllib.parse import unquote
+
+REVEALED = re.compile(r'(?:He|She) is (.+?)\. Remember')
+
+
+def test_concurrent_answers_keep_order_and_progress(bot):
+    '''
+    Each reply names the person of the question before it, so replies
+    sent out of order break the chain, and the saved progress has to
+    count every answer once.
+    '''
+    answers, threads = 300, 8
+    group = 'C{:032x}'.format(0)
+    source = bot.group(group, 'U{:032x}'.format(1))
+    rng = random.Random(0)
+    texts = [rng.choice(('/pass', '/a zzzzzz')) for _ in range(answers)]
+
+    first = len(bot.line.sent)
+    bot.say('/start', source)
+    barrier = threading.Barrier(threads)
+    statuses = []
+
+    def work(items):
+        client = bot.app.app.test_client()
+        barrier.wait()
+        for text in items:
+            statuses.append(bot.post(text, source, client))
+
+    workers = [threading.Thread(target=work, args=(texts[index::threads],))
+               for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    sent = bot.wait(first + answers + 1, timeout=60)[first:]
+    # The last answer is saved after its reply, still holding the lock.
+    with bot.app.players.locked(group):
+        bot.app.writer.flush()
+
+    asked, answered, out_of_order = None, 0, 0
+    for _, _, messages in sent:
+        for message in messages:
+            if message['type'] == 'text':
+                match = REVEALED.search(message['text'])
+                if match:
+                    answered += 1
+                    out_of_order += match.group(1) != asked
+            elif message['type'] == 'image':
+                url = message['originalContentUrl'].split('?')[0]
+                asked = unquote(url).rsplit('/', 1)[-1][:-len('.jpg')]
+    saved = bot.app.Player.fromJSON(bot.app.storage.load_one(group))
+    data = saved.data
+    counted = sum(data[key] for key in ('exact', 'correct', 'partial',
+                                        'wrong', 'skipped'))
+
+    assert set(statuses) == {200}
+    assert len(sent) == answers + 1
+    assert out_of_order == 0
+    assert counted == answered == answers
+    assert len(saved.progress) == len(bot.roster) - counted
+    assert saved.pick == asked
+    assert data['score'] == (5*data['exact'] + 3*data['correct'] +
+                             3*data['partial'] - data['wrong'])
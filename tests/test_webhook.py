@@ -0,0 +1,27 @@
+'''
+Webhook deliveries the bot can't take right away
+'''
+
+from conftest import SECRET
+from fakes import webhook
+
+
+def test_dropped_event_is_redelivered(bot, monkeypatch):
+    source = bot.user('U{:032x}'.format(5))
+    body, signature = webhook(SECRET, '/help', source, next(bot.tokens))
+    headers = {'Content-Type': 'application/json',
+               'X-Line-Signature': signature}
+    client = bot.app.app.test_client()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(bot.app.dispatcher, 'submit',
+                      lambda key, event: False)
+        response = client.post('/callback', data=body.encode('utf-8'),
+                               headers=headers)
+    assert response.status_code == 503
+
+    sent = len(bot.line.sent)
+    response = client.post('/callback', data=body.encode('utf-8'),
+                           headers=headers)
+    assert response.status_code == 200
+    assert len(bot.wait(sent + 1)) == sent + 1
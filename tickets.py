@@ -0,0 +1,188 @@
+'''
+Messages sent to the developer with /msg
+'''
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import dropbox
+
+# LINE text messages hold at most this many characters.
+TEXT_LIMIT = 5000
+
+
+def digest(text):
+    '''
+    Return the hash messages are deduplicated by: case and runs of
+    whitespace don't matter.
+    '''
+    return hashlib.sha1(' '.join(text.lower().split())
+                        .encode('utf-8')).digest()
+
+
+def split(lines, limit=TEXT_LIMIT):
+    '''
+    Join lines into texts of at most limit characters, cutting lines that
+    are longer on their own.
+    '''
+    texts, current = [], ''
+    for line in lines:
+        line = line[:limit]
+        if current and len(current) + 1 + len(line) > limit:
+            texts.append(current)
+            current = ''
+        current = current + '\n' + line if current else line
+    if current:
+        texts.append(current)
+    return texts
+
+
+class DropboxTickets:
+    '''
+    Messages kept in one JSON file on Dropbox, rewritten on every save,
+    for storage backends that can't save them one by one.
+    '''
+
+    def __init__(self, dbx, path):
+        self.dbx = dbx
+        self.path = path
+
+    def load_tickets(self):
+        '''
+        Return {ticket ID: text}. The file may still be the old list of
+        texts.
+        '''
+        try:
+            content = json.loads(self.dbx.files_download(self.path)[1]
+                                 .content.decode('utf-8'))
+        except dropbox.exceptions.ApiError:
+            return {}
+        if isinstance(content, list):
+            return {number: text for number, text in enumerate(content, 1)}
+        return {int(key): text for key, text in content.items()}
+
+    def save_tickets(self, changes):
+        '''
+        Apply {ticket ID: text, or None to remove it}.
+        '''
+        tickets = self.load_tickets()
+        for key, text in changes.items():
+            if text is None:
+                tickets.pop(key, None)
+            else:
+                tickets[key] = text
+        self.dbx.files_upload(json.dumps(tickets, indent=4).encode('utf-8'),
+                              self.path, dropbox.files.WriteMode.overwrite)
+
+
+class TicketStore:
+    '''
+    Messages by ID, with an index of their hashes so a repeated message is
+    found without comparing it to every other one.
+
+    A message keeps its ID, so an ID shown by /tix still names the same
+    message after others are removed. Changes are queued and written by
+    flush() through a backend with load_tickets() and
+    save_tickets(changes), e.g. SQLiteStorage, which saves just the added
+    and removed messages.
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.tickets = OrderedDict()
+        self.hashes = {}
+        self.next_id = 1
+        self.changes = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        '''
+        Replace the messages in memory with the saved ones, plus changes
+        that haven't been saved yet.
+        '''
+        tickets = self.backend.load_tickets()
+        with self.lock:
+            for key, text in self.changes.items():
+                if text is None:
+                    tickets.pop(key, None)
+                else:
+                    tickets[key] = text
+            self.tickets = OrderedDict(sorted(tickets.items()))
+            self.hashes = {digest(text): key
+                           for key, text in self.tickets.items()}
+            self.next_id = max(self.tickets, default=0) + 1
+            if self.changes:
+                self.next_id = max(self.next_id, max(self.changes) + 1)
+
+    def add(self, text):
+        '''
+        Add a message. Return its ID, or None if it was already sent.
+        '''
+        key = digest(text)
+        with self.lock:
+            if key in self.hashes:
+                return None
+            ticket_id = self.next_id
+            self.next_id += 1
+            self.tickets[ticket_id] = text
+            self.hashes[key] = ticket_id
+            self.changes[ticket_id] = text
+            return ticket_id
+
+    def remove(self, ticket_id):
+        '''
+        Remove a message. Return its text, or None if there is no such
+        message.
+        '''
+        with self.lock:
+            text = self.tickets.pop(ticket_id, None)
+            if text is not None:
+                del self.hashes[digest(text)]
+                self.changes[ticket_id] = None
+            return text
+
+    def clear(self):
+        '''
+        Remove every message.
+        '''
+        with self.lock:
+            for ticket_id in self.tickets:
+                self.changes[ticket_id] = None
+            self.tickets.clear()
+            self.hashes.clear()
+
+    def flush(self):
+        '''
+        Save the queued changes. They are queued again if saving fails.
+        '''
+        with self.lock:
+            changes, self.changes = self.changes, {}
+        if not changes:
+            return
+        try:
+            self.backend.save_tickets(changes)
+        except Exception:
+            with self.lock:
+                changes.update(self.changes)
+                self.changes = changes
+            raise
+
+    def __len__(self):
+        with self.lock:
+            return len(self.tickets)
+
+    def page(self, number, messages=5, limit=TEXT_LIMIT):
+        '''
+        Return the texts of one page of '<ID>. <message>' lines, at most
+        `messages` texts of at most limit characters each, and the number
+        of pages.
+        '''
+        with self.lock:
+            lines = ['{}. {}'.format(key, text)
+                     for key, text in self.tickets.items()]
+        texts = split(lines, limit)
+        count = max(1, -(-len(texts) // messages))
+        start = (number - 1) * messages
+        return texts[start:start + messages], count
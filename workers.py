@@ -0,0 +1,84 @@
+'''
+Background processing of webhook events
+'''
+
+import logging
+import queue
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+POLICIES = ('block', 'drop')
+
+
+class Dispatcher:
+    '''
+    Pool of worker threads that handle events in per-key order.
+
+    Each key (a chat ID) always goes to the same worker, so events from one
+    chat are handled one at a time and in the order they arrived, while
+    different chats are handled concurrently. When a worker's queue is
+    full, the policy decides what happens to a new event: 'block' waits up
+    to `timeout` seconds for room before dropping it, 'drop' drops it
+    right away.
+    '''
+
+    def __init__(self, handle, workers=4, max_pending=100, policy='block',
+                 timeout=10.0):
+        if policy not in POLICIES:
+            raise ValueError("Unknown backpressure policy: {}".format(policy))
+        self.handle = handle
+        self.policy = policy
+        self.timeout = timeout
+        self.dropped = 0
+        self.queues = [queue.Queue(max_pending) for _ in range(workers)]
+        self.threads = [threading.Thread(target=self.run, args=(tasks,),
+                                         daemon=True,
+                                         name='webhook-{}'.format(i))
+                        for i, tasks in enumerate(self.queues)]
+
+    def start(self):
+        '''
+        Start the worker threads.
+        '''
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, item):
+        '''
+        Queue item to be handled after every earlier item with the same key.
+        Return False if the item was dropped.
+        '''
+        tasks = self.queues[hash(key) % len(self.queues)]
+        try:
+            if self.policy == 'block':
+                tasks.put(item, timeout=self.timeout)
+            else:
+                tasks.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            LOGGER.warning("Worker queue full, dropping event for %s", key)
+            return False
+        return True
+
+    def depth(self):
+        '''
+        Return the number of queued events.
+        '''
+        return sum(tasks.qsize() for tasks in self.queues)
+
+    def call(self, item):
+        '''
+        Handle an item, logging any error.
+        '''
+        try:
+            self.handle(item)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("Handling webhook event failed")
+
+    def run(self, tasks):
+        '''
+        Handle items from a queue forever.
+        '''
+        while True:
+            self.call(tasks.get())
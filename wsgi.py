@@ -0,0 +1,17 @@
+'''
+Production WSGI entry point for TarungBot
+
+Run with e.g. gunicorn 'wsgi:create_app()' --workers 4
+
+Each worker process imports the bot on its own. With more than one worker,
+set SQLITE_PATH and SHARED_STATE_DIR so the workers share player state
+instead of overwriting each other's saves.
+'''
+
+
+def create_app():
+    '''
+    Import the bot in the current worker process and return its Flask app.
+    '''
+    from app import app
+    return app